@@ -1,8 +1,13 @@
 import gc
+import hashlib
 import inspect
+import json
 import logging
+import multiprocessing
 import os
 import re
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from functools import partial
 from typing import Callable, List, Dict
@@ -16,7 +21,8 @@ import tqdm
 
 import models
 from calculate_log import metric
-from data import get_dataset
+from data import get_dataset, DevicePrefetcher
+from mergeable_meters import MergeableMeterDict, MergeableOnlineMeter
 from preprocess import get_transform
 from utils.log import setup_logging
 from utils.meters import MeterDict, OnlineMeter, AverageMeter, accuracy
@@ -215,6 +221,149 @@ _DEFAULT_SPATIAL_REDDUCTIONS = {
 }
 
 
+# every default reduction is a combination of a few per channel primitives, recipes keep the exact outputs of the
+# functions above (spatial_max ignores k, spatial_min returns the k-th smallest value, combined reductions are
+# channel blocks in the listed order)
+_SPATIAL_REDUCTION_RECIPES = {
+    spatial_mean: ('mean',),
+    spatial_max: ('max',),
+    spatial_min: ('min',),
+    spatial_min_max: ('max', 'min'),
+    spatial_mean_max: ('max', 'mean'),
+    spatial_min_mean_max: ('max', 'mean', 'min'),
+    spatial_l2: ('l2',),
+}
+
+
+class FusedSpatialReduction():
+    """applies all reductions of a reduction dictionary with a single read of the activation.
+    `stacked` computes the distinct primitives once (min and max with one aminmax, the k-th minimum with one topk)
+    and returns them as a [B, C, R] tensor, `split` maps it to the {reduction_name: [B, nchannels]} outputs of the
+    dictionary functions. functions without a recipe (e.g. user lambdas) are called on the activation as before.
+    calling with {reduction_name: channel ids} returns those reductions restricted to the ids, per channel
+    reductions only read the selected channels of the activation.
+    """
+    def __init__(self, reduction_dictionary):
+        self.reduction_dictionary = reduction_dictionary
+        self._subsets = {}
+        self._unions = {}
+        # (primitive, k)
+        self.primitives = []
+        # reduction_name -> (combine op, primitive ids), None when the function has no recipe
+        self.recipes = {}
+        for reduction_name, fn in reduction_dictionary.items():
+            k = 1
+            if isinstance(fn, partial) and not fn.args and set(fn.keywords) <= {'k'}:
+                fn, k = fn.func, fn.keywords.get('k', 1)
+            if fn is spatial_margin:
+                op, parts = 'margin', ('max', 'min')
+            elif fn in _SPATIAL_REDUCTION_RECIPES:
+                op, parts = 'cat', _SPATIAL_REDUCTION_RECIPES[fn]
+            else:
+                self.recipes[reduction_name] = None
+                continue
+            ids = []
+            for p in parts:
+                key = (p, k if p == 'min' else 1)
+                if key not in self.primitives:
+                    self.primitives.append(key)
+                ids.append(self.primitives.index(key))
+            self.recipes[reduction_name] = (op, ids)
+
+    def stacked(self, x):
+        if not self.primitives:
+            return None
+        if x.dim() < 3:
+            # every reduction returns 2d inputs as is
+            return x.unsqueeze(0).expand(len(self.primitives), *x.shape).permute(1, 2, 0)
+        x_ = dim_reducer(x)
+        cols = {}
+        need_max, need_min = ('max', 1) in self.primitives, ('min', 1) in self.primitives
+        if need_max and need_min:
+            cols['min', 1], cols['max', 1] = th.aminmax(x_, dim=-1)
+        elif need_max:
+            cols['max', 1] = x_.amax(-1)
+        elif need_min:
+            cols['min', 1] = x_.amin(-1)
+        for p, k in self.primitives:
+            if (p, k) in cols:
+                continue
+            if p == 'min':
+                cols[p, k] = x_.topk(k, -1, largest=False)[0][:, :, k - 1]
+            elif p == 'mean':
+                cols[p, k] = spatial_mean(x)
+            elif p == 'l2':
+                cols[p, k] = th.norm(x_, dim=-1)
+        # stored reduction major so every [B, C] slice is contiguous
+        return th.stack([cols[key] for key in self.primitives]).permute(1, 2, 0)
+
+    def split(self, stacked, x=None):
+        ret = {}
+        for reduction_name, recipe in self.recipes.items():
+            if recipe is None:
+                ret[reduction_name] = self.reduction_dictionary[reduction_name](x)
+                continue
+            op, ids = recipe
+            if op == 'margin':
+                ret[reduction_name] = stacked[:, :, ids[0]] - stacked[:, :, ids[1]]
+            elif len(ids) == 1:
+                ret[reduction_name] = stacked[:, :, ids[0]]
+            else:
+                ret[reduction_name] = th.cat([stacked[:, :, r] for r in ids], 1)
+        return ret
+
+    def channelwise(self, reduction_name):
+        # output channel j only depends on input channel j, selecting channels commutes with the reduction
+        recipe = self.recipes[reduction_name]
+        return recipe is not None and (recipe[0] == 'margin' or len(recipe[1]) == 1)
+
+    def _subset(self, reduction_names):
+        reduction_names = tuple(reduction_names)
+        if reduction_names == tuple(self.recipes):
+            return self
+        if reduction_names not in self._subsets:
+            self._subsets[reduction_names] = FusedSpatialReduction(
+                {n: self.reduction_dictionary[n] for n in reduction_names})
+        return self._subsets[reduction_names]
+
+    def _union(self, selections):
+        # selections are fixed per layer, the union of every layer's selections is computed once. the cache is keyed
+        # by the selection tensors, which are kept with the entry so their ids can't be reused
+        key = tuple((n, id(ids)) for n, ids in selections)
+        if key not in self._unions:
+            self._unions[key] = (tuple(ids for _, ids in selections),) + \
+                                channel_union([ids for _, ids in selections])
+        return self._unions[key][1], self._unions[key][2]
+
+    def __call__(self, x, channels: Dict[str, th.Tensor] = None):
+        if not channels:
+            return self.split(self.stacked(x), x)
+        pushed = [(n, channels[n]) for n in self.recipes if n in channels and self.channelwise(n)]
+        full = [n for n in self.recipes if n not in channels or not self.channelwise(n)]
+        ret = {}
+        if full:
+            ret.update(self._subset(full)(x))
+            for n in full:
+                if n in channels:
+                    # the reduction mixes channels, select after reducing
+                    ret[n] = ret[n][:, channels[n].to(ret[n].device)]
+        if len(pushed) == 1:
+            n, ids = pushed[0]
+            ret[n] = self._subset([n])(x.index_select(1, ids.to(x.device)))[n]
+        elif pushed:
+            union, positions = self._union(pushed)
+            reduced = self._subset([n for n, _ in pushed])(x.index_select(1, union.to(x.device)))
+            for (n, _), pos in zip(pushed, positions):
+                ret[n] = reduced[n][:, pos.to(x.device)]
+        return {n: ret[n] for n in self.recipes}
+
+
+def channel_union(ids_list):
+    # union of channel subsets and the positions of every subset in it
+    union, inverse = th.cat([th.as_tensor(ids).view(-1) for ids in ids_list]).unique(return_inverse=True)
+    return union, list(inverse.split([th.as_tensor(ids).numel() for ids in ids_list]))
+
+
 def _extractNormalizedQuants(layer_name, tracker_dict_per_class):
     layer_quants = []
     min_len_perc = None
@@ -321,7 +470,16 @@ class Settings:
                  # this will try to choose layers to reduce final statistic variance over H0
                  select_layer_mode: bool = False,
                  select_layer_kwargs: Dict = {},
-                 channel_selection_fn: Callable[[List[Dict]], Dict[str, th.Tensor]] = None
+                 channel_selection_fn: Callable[[List[Dict]], Dict[str, th.Tensor]] = None,
+                 # reduced activations kept per class in the first measure pass and replayed in the second one
+                 # instead of running the model again (0 runs the second pass over the data)
+                 replay_samples: int = 0,
+                 # measurement (per class, the LDA joint tracker and the joint distribution) is sharded by sample
+                 # over this many cpu processes and the shard meters are merged (<= 1 measures in process)
+                 measure_processes: int = 0,
+                 # directory of stored reduced activations (see ActivationStore), each dataset is run through the
+                 # model once and every detector configuration is measured and evaluated from the store
+                 activation_store: str = None
                  ):
 
         self._dict = {}
@@ -491,61 +649,156 @@ def plot(clean_act, fgsm_act, layer_key, reference_stats=None, nbins=256, max_ra
     pass
 
 
-def gen_inference_fn(ref_stats_dict, reduction_dict={}):
+def gen_inference_fn(ref_stats_dict, reduction_dict={}, reduced_inputs=False):
+    # every layer input is scored for all classes at once, the hook returns
+    # {reduction_name: [per input {channel_reduction_name: [B, num_classes]}]}
+    # with reduced_inputs the inputs are already spatially reduced {reduction_name: [per input tensor]}
+    stacked_scorers = {}
+    pushed_selections = {}
+    fused_reduction = FusedSpatialReduction(reduction_dict)
+
+    def _stacked_scorer(layer_name, reduction_name, e):
+        key = (layer_name, reduction_name, e)
+        if key not in stacked_scorers:
+            stacked_scorers[key] = StackedClassScorer.build(
+                [class_stat_dict[layer_name][reduction_name][e] for class_stat_dict in ref_stats_dict],
+                reduction_dict[reduction_name])
+            if stacked_scorers[key] is None:
+                logging.debug(f'{layer_name} {reduction_name}:{e} can not be stacked, scoring classes one by one')
+        return stacked_scorers[key]
+
+    def _pushed_selection(layer_name, reduction_name, e):
+        # when every class fn starts by selecting channels of a per channel reduction, the union of the selected
+        # channels is reduced once and the class fns are rewritten to select their positions in the union.
+        # classes are stacked on the union when they can be (classes sharing ids select the same positions).
+        # returns (union, [per class {channel_reduction_name: fn}], stacked scorer or None) or None
+        key = (layer_name, reduction_name, e)
+        if key not in pushed_selections:
+            pushed_selections[key] = None
+            per_class_stats = [class_stat_dict[layer_name][reduction_name][e] for class_stat_dict in ref_stats_dict]
+            if not fused_reduction.channelwise(reduction_name) or \
+                    any(stat.reduction_fn != reduction_dict[reduction_name] for stat in per_class_stats):
+                return None
+            heads = [{name: _pop_channel_select(rec['fn']) for name, rec in stat.channel_reduction_record.items()}
+                     for stat in per_class_stats]
+            if any(head is None for class_heads in heads for head in class_heads.values()):
+                return None
+            selections = [head[0] for class_heads in heads for head in class_heads.values()]
+            union, positions = channel_union(selections)
+            positions = iter(positions)
+            class_fns = []
+            rewritten = []
+            for class_heads in heads:
+                class_fns.append({})
+                rewritten.append(BatchStatsCollectorRet(reduction_name, reduction_dict[reduction_name]))
+                for name, (_, rest) in class_heads.items():
+                    select_fn = ChannelSelect(next(positions))
+                    class_fns[-1][name] = select_fn if rest is None else FunctionComposition(select_fn, rest)
+                    rewritten[-1].channel_reduction_record[name] = {'fn': class_fns[-1][name]}
+            pushed_selections[key] = (union, class_fns,
+                                      StackedClassScorer.build(rewritten, reduction_dict[reduction_name]))
+        return pushed_selections[key]
+
+    def _per_class_scores(layer_name, reduction_name, e, reduced):
+        per_class_stats = []
+        for class_stat_dict in ref_stats_dict:
+            per_input_stat = class_stat_dict[layer_name][reduction_name][e]
+            ret_channel_strategy = {}
+            assert isinstance(per_input_stat, BatchStatsCollectorRet)
+            if per_input_stat.reduction_fn != reduction_dict[reduction_name]:
+                assert per_input_stat.reduction_fn.f1 == reduction_dict[reduction_name]
+            for channle_reduction_name, rec in per_input_stat.channel_reduction_record.items():
+                if per_input_stat.reduction_fn != reduction_dict[reduction_name]:
+                    # overwrite function to match old measure file with new format, note that channels
+                    # reduction can differ between classes
+                    rec['fn'] = FunctionComposition(f1=per_input_stat.reduction_fn.f2,
+                                                    f2=per_input_stat.reduction_fn.f1)
+                ret_channel_strategy[channle_reduction_name] = rec['fn'](reduced)
+
+            if per_input_stat.reduction_fn != reduction_dict[reduction_name]:
+                # this will make sure the fn overwite will only happen once
+                per_input_stat.reduction_fn = per_input_stat.reduction_fn.f1
+            per_class_stats.append(ret_channel_strategy)
+        return {channle_reduction_name: th.cat([class_stats[channle_reduction_name] for class_stats in per_class_stats], -1)
+                for channle_reduction_name in per_class_stats[0].keys()}
+
     def _batch_calc(trace_name, m, inputs):
-        if type(inputs) != tuple:
+        if type(inputs) != tuple and not reduced_inputs:
             inputs = (inputs,)
-        class_specific_stats = [{} for _ in range(len(ref_stats_dict))]
-        for reduction_name, reduction_fn in reduction_dict.items():
-            shared_reductions_per_input = []
-            for i in inputs:
-                i_ = reduction_fn(i)
-
-                shared_reductions_per_input.append(i_)
-            for c, class_stat_dict in enumerate(ref_stats_dict):
-                reduction_stat = class_stat_dict[trace_name[:-8]][reduction_name]
-                pval_per_input = []
-                for e, per_input_stat in enumerate(reduction_stat):
-                    ret_channel_strategy = {}
-                    assert isinstance(per_input_stat, BatchStatsCollectorRet)
-                    if per_input_stat.reduction_fn != reduction_dict[reduction_name]:
-                        assert per_input_stat.reduction_fn.f1 == reduction_dict[reduction_name]
-                    reduced = shared_reductions_per_input[e]
-                    for channle_reduction_name, rec in per_input_stat.channel_reduction_record.items():
-                        if per_input_stat.reduction_fn != reduction_dict[reduction_name]:
-                            # overwrite function to match old measure file with new format, note that channels
-                            # reduction can differ between classes
-                            rec['fn'] = FunctionComposition(f1=per_input_stat.reduction_fn.f2,
-                                                            f2=per_input_stat.reduction_fn.f1)
-                        ret_channel_strategy[channle_reduction_name] = rec['fn'](reduced)
-
-                    if per_input_stat.reduction_fn != reduction_dict[reduction_name]:
-                        # this will make sure the fn overwite will only happen once
-                        per_input_stat.reduction_fn = per_input_stat.reduction_fn.f1
-                    pval_per_input.append(ret_channel_strategy)
-                class_specific_stats[c][reduction_name] = pval_per_input
-        return class_specific_stats
+        layer_name = trace_name[:-8]
+        reduced_per_input = []
+        if not reduced_inputs:
+            for e, i in enumerate(inputs):
+                # sampled channels are selected before the spatial reduction
+                channels = {}
+                for reduction_name in reduction_dict.keys():
+                    selection = _pushed_selection(layer_name, reduction_name, e)
+                    if selection is not None:
+                        channels[reduction_name] = selection[0]
+                reduced_per_input.append(fused_reduction(i, channels))
+        stacked_stats = {}
+        for reduction_name in reduction_dict.keys():
+            pval_per_input = []
+            for e, i in enumerate(inputs[reduction_name] if reduced_inputs else inputs):
+                reduced = i if reduced_inputs else reduced_per_input[e][reduction_name]
+                selection = _pushed_selection(layer_name, reduction_name, e)
+                if selection is not None:
+                    # reduced holds the union of the selected channels
+                    union, class_fns, scorer = selection
+                    if reduced_inputs:
+                        reduced = reduced[:, union.to(reduced.device)]
+                    if scorer is not None:
+                        pval_per_input.append(scorer(reduced))
+                        continue
+                    per_class_stats = [{name: fn(reduced) for name, fn in fns.items()} for fns in class_fns]
+                    pval_per_input.append({name: th.cat([class_stats[name] for class_stats in per_class_stats], -1)
+                                           for name in per_class_stats[0].keys()})
+                    continue
+                scorer = _stacked_scorer(layer_name, reduction_name, e)
+                if scorer is not None:
+                    pval_per_input.append(scorer(reduced))
+                else:
+                    pval_per_input.append(_per_class_scores(layer_name, reduction_name, e, reduced))
+            stacked_stats[reduction_name] = pval_per_input
+        return stacked_stats
     return _batch_calc
 
 
 class PvalueMatcher():
     def __init__(self, percentiles, quantiles, two_side=True, right_side=False):
         self.percentiles = percentiles
-        self.quantiles = quantiles.t().unsqueeze(0)
         self.num_percentiles = percentiles.shape[0]
+        # contiguous per channel quantile rows [C, P] (a single row is shared by all channels), sorting a row does not
+        # change how many of its quantiles are below an observation so the matched location is unaffected
+        self.quantiles = quantiles.t().reshape(-1, self.num_percentiles).sort(-1)[0].contiguous()
         self.right_side = right_side
         self.two_side = (not right_side) and two_side
 
-    ## todo document!
+    def __setstate__(self, state):
+        # matchers pickled before the searchsorted lookup hold quantiles as a [1, C, P] broadcast tensor
+        self.__dict__.update(state)
+        if self.quantiles.dim() == 3:
+            self.quantiles = self.quantiles[0].sort(-1)[0].contiguous()
+
     def __call__(self, x):
+        """map observations x [B, C] to p-values using each channel's quantile row.
+        the location of an observation is the number of quantiles <= x (found with a binary search, no B x C x P
+        comparison tensor), locations in the upper half are matched to the percentile below them.
+        two sided p-values are doubled tail probabilities, right sided ones are 1 - percentile.
+        """
         if x.device != self.quantiles.device:
                 self.percentiles=self.percentiles.to(x.device)
                 self.quantiles = self.quantiles.to(x.device)
-        stat_layer = x.unsqueeze(-1).expand(x.shape[0], x.shape[1], self.num_percentiles)
-        quant_layer = self.quantiles.expand(stat_layer.shape[0], stat_layer.shape[1], self.num_percentiles)
-
+        dtype = th.promote_types(x.dtype, self.quantiles.dtype)
+        quantiles = self.quantiles.to(dtype)
         ### find p-values based on quantiles
-        temp_location = th.sum(stat_layer < quant_layer, -1).neg_().add_(self.num_percentiles)
+        if quantiles.shape[0] == 1:
+            temp_location = th.searchsorted(quantiles[0], x.to(dtype).contiguous(), right=True)
+        else:
+            temp_location = th.searchsorted(quantiles, x.to(dtype).t().contiguous(), right=True).t()
+        return self._match_locations(temp_location)
+
+    def _match_locations(self, temp_location):
         upper_quant_ind = temp_location > (self.num_percentiles // 2)
         temp_location[upper_quant_ind] += -1
         matching_percentiles = self.percentiles[temp_location]
@@ -556,6 +809,42 @@ class PvalueMatcher():
             return 1-matching_percentiles
         return matching_percentiles
 
+class StackedPvalueMatcher(PvalueMatcher):
+    """matches all classes in one lookup, stacks K matchers sharing the percentile grid and sidedness.
+    x [B, C, K] is matched column by column with each class quantile rows, returns [B, C, K].
+    """
+    def __init__(self, matchers: List[PvalueMatcher]):
+        self.percentiles = matchers[0].percentiles
+        self.num_percentiles = matchers[0].num_percentiles
+        self.right_side = matchers[0].right_side
+        self.two_side = matchers[0].two_side
+        # [K, C, P]
+        self.quantiles = th.stack([m.quantiles.to(self.percentiles.device) for m in matchers])
+
+    def __setstate__(self, state):
+        # stacked quantiles are [K, C, P], not the legacy PvalueMatcher layout
+        self.__dict__.update(state)
+
+    @staticmethod
+    def compatible(matchers: List[PvalueMatcher]):
+        m0 = matchers[0]
+        return all(isinstance(m, PvalueMatcher) and m.two_side == m0.two_side and m.right_side == m0.right_side and
+                   m.quantiles.shape == m0.quantiles.shape and
+                   th.equal(m.percentiles.to(m0.percentiles.device), m0.percentiles) for m in matchers)
+
+    def __call__(self, x):
+        if x.device != self.quantiles.device:
+            self.percentiles = self.percentiles.to(x.device)
+            self.quantiles = self.quantiles.to(x.device)
+        B, C, K = x.shape
+        dtype = th.promote_types(x.dtype, self.quantiles.dtype)
+        # a single quantile row is shared by all channels
+        quantiles = self.quantiles.to(dtype).expand(K, C, self.num_percentiles).reshape(K * C, self.num_percentiles)
+        temp_location = th.searchsorted(quantiles, x.to(dtype).permute(2, 1, 0).reshape(K * C, B).contiguous(),
+                                        right=True)
+        return self._match_locations(temp_location.view(K, C, B).permute(2, 1, 0))
+
+
 class PvalueMatcherFromSamples(PvalueMatcher):
     def __init__(self, samples, target_percentiles=th.tensor([0.05,
                                                               0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9,
@@ -709,12 +998,181 @@ class CommonStatsRecorder(Recorder):
         super().__init__(*args, recursive=True, device_modifier='same', **kwargs)
 
 
+class ActivationStore(th.utils.data.Dataset):
+    """spatially reduced layer activations of a dataset, written once by `build` as fp16 memory maps (one array per
+    traced layer input and spatial reduction) with the labels and model outputs. detectors can be measured and
+    evaluated from the store without running the model. items are (sample index, label) pairs.
+    layout: <path>/index.json, labels.npy, logits.npy and one <array id>.npy per stored reduction
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.classes = index['classes']
+        self.tracked_modules = index['tracked_modules']
+        # (trace_name, input id, reduction name) -> array file
+        self.files = {tuple(key): file_name for key, file_name in index['arrays']}
+        self.targets = th.from_numpy(np.load(os.path.join(path, 'labels.npy')))
+        self._arrays = None
+
+    def __getstate__(self):
+        # memory maps are reopened by the receiving process
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, 'index.json'))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        return index, self.targets[index]
+
+    @property
+    def reductions(self):
+        return {key[2] for key in self.files}
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = {key: np.load(os.path.join(self.path, file_name), mmap_mode='r')
+                            for key, file_name in self.files.items()}
+            self._logits = np.load(os.path.join(self.path, 'logits.npy'), mmap_mode='r')
+
+    def select_modules(self, model=None, include_matcher_fn=None):
+        # layers the matcher would trace on the model (all stored layers without a model), they must all be stored
+        if model is None or include_matcher_fn is None:
+            return list(self.tracked_modules)
+        stored = set(self.tracked_modules)
+        selected = [n for n, m in model.named_modules() if include_matcher_fn(n, m)]
+        missing = [n for n in selected if n not in stored]
+        assert not missing, f'layers {missing} are not in the activation store {self.path}, ' \
+                            f'rebuild it with a layer matcher that includes them'
+        return selected
+
+    def rows(self, indices, keys=None):
+        self._open()
+        indices = np.asarray(indices)
+        return {key: th.from_numpy(self._arrays[key][indices].astype(np.float32)) for key in (keys or self.files)}
+
+    def outputs(self, indices):
+        self._open()
+        return th.from_numpy(self._logits[np.asarray(indices)].astype(np.float32))
+
+    @classmethod
+    def build(cls, path, model, loader, reduction_dictionary=_DEFAULT_SPATIAL_REDDUCTIONS,
+              include_matcher_fn=_default_matcher_fn, device='cuda'):
+        # loader must keep the dataset order (no shuffle, no dropped samples)
+        os.makedirs(path, exist_ok=True)
+        num_samples = len(loader.dataset)
+        arrays, files = {}, []
+        current = {'start': 0}
+        fused_reduction = FusedSpatialReduction(reduction_dictionary)
+
+        def _store_collector(trace_name, m, inputs):
+            if type(inputs) != tuple:
+                inputs = (inputs,)
+            for e, i in enumerate(inputs):
+                reduced = fused_reduction(i)
+                for reduction_name in reduction_dictionary.keys():
+                    ## make sure input is a 2d tensor [batch, nchannels]
+                    i_ = reduced[reduction_name].float().cpu().numpy()
+                    key = (trace_name, e, reduction_name)
+                    if key not in arrays:
+                        file_name = f'{len(files):04d}.npy'
+                        files.append([list(key), file_name])
+                        arrays[key] = np.lib.format.open_memmap(os.path.join(path, file_name), mode='w+',
+                                                                dtype=np.float16, shape=(num_samples, i_.shape[1]))
+                    arrays[key][current['start']:current['start'] + i_.shape[0]] = i_
+
+        def _dummy_reducer(old, new):
+            return old
+
+        model.eval()
+        model.to(device)
+        r = CommonStatsRecorder(model, include_matcher_fn=include_matcher_fn, input_fn=_store_collector,
+                                activation_reducer_fn=_dummy_reducer)
+        logging.info(f'storing reduced activations of {num_samples} samples in {path}')
+        logits, labels = [], []
+        with th.no_grad():
+            for d, l in tqdm.tqdm(DevicePrefetcher(loader, device, inputs_only=True), total=len(loader)):
+                logits.append(model(d.to(device)).float().cpu())
+                labels.append(th.as_tensor(l))
+                current['start'] += d.shape[0]
+        assert current['start'] == num_samples, 'the store loader must visit every sample once'
+        tracked_modules = list(r.tracked_modules.keys())
+        r.record.clear()
+        r.remove_model_hooks()
+        for array in arrays.values():
+            array.flush()
+        np.save(os.path.join(path, 'logits.npy'), th.cat(logits).numpy())
+        np.save(os.path.join(path, 'labels.npy'), th.cat(labels).numpy())
+        index = {'classes': list(getattr(loader.dataset, 'classes', [])), 'tracked_modules': tracked_modules,
+                 'arrays': files}
+        # the index is written last, a store without it is incomplete
+        with open(os.path.join(path, 'index.json.tmp'), 'w') as f:
+            json.dump(index, f, default=str)
+        os.replace(os.path.join(path, 'index.json.tmp'), os.path.join(path, 'index.json'))
+        return cls(path)
+
+
+class ActivationStoreRecorder():
+    """CommonStatsRecorder counterpart for an ActivationStore, `replay` passes the stored reductions of every
+    traced layer to the input function (as {reduction_name: [rows per input]}) and records its output.
+    """
+    def __init__(self, store: ActivationStore, model, include_matcher_fn, input_fn, reductions):
+        modules = dict(model.named_modules()) if model is not None else {}
+        self.tracked_modules = {n: modules.get(n) for n in store.select_modules(model, include_matcher_fn)}
+        self.keys = [key for key in store.files if key[0][:-8] in self.tracked_modules and key[2] in reductions]
+        missing = set(reductions) - store.reductions
+        assert not missing, f'reductions {missing} are not in the activation store {store.path}'
+        self.input_fn = input_fn
+        self.record = {}
+
+    def replay(self, rows_per_key):
+        per_trace = {}
+        for (trace_name, e, reduction_name), rows in rows_per_key.items():
+            per_trace.setdefault(trace_name, {}).setdefault(reduction_name, {})[e] = rows
+        for trace_name, per_reduction in per_trace.items():
+            self.record[trace_name] = self.input_fn(trace_name, None, {
+                reduction_name: [rows[e] for e in sorted(rows)] for reduction_name, rows in per_reduction.items()})
+
+    def remove_model_hooks(self):
+        pass
+
+
+class ActivationStoreReplay(th.nn.Module):
+    """stands in for the model in evaluate_data, called with a batch of store indices it replays the stored
+    reductions to the detector and returns the stored model outputs.
+    """
+    def __init__(self, store: ActivationStore, detector):
+        super().__init__()
+        self.store = store
+        self.detector = detector
+
+    def forward(self, indices):
+        rows = self.store.rows(indices.cpu(), self.detector.stats_recorder.keys)
+        self.detector.stats_recorder.replay({key: v.to(indices.device) for key, v in rows.items()})
+        return self.store.outputs(indices.cpu())
+
+
 class OODDetector():
     def __init__(self, model, all_class_ref_stats, right_sided_fisher_pvalue=True,
-                 include_matcher_fn=_default_matcher_fn, shared_reductions=_DEFAULT_SPATIAL_REDDUCTIONS):
-
-        self.stats_recorder = CommonStatsRecorder(model, include_matcher_fn=include_matcher_fn,
-                                                  input_fn=gen_inference_fn(all_class_ref_stats, shared_reductions))
+                 include_matcher_fn=_default_matcher_fn, shared_reductions=_DEFAULT_SPATIAL_REDDUCTIONS,
+                 store: ActivationStore = None):
+        # with a store the layer inputs are replayed from disk (see ActivationStoreReplay) and the model is only
+        # used to match layer names
+        if store is not None:
+            self.stats_recorder = ActivationStoreRecorder(store, model, include_matcher_fn,
+                                                          gen_inference_fn(all_class_ref_stats, shared_reductions,
+                                                                           reduced_inputs=True),
+                                                          reductions=list(shared_reductions.keys()))
+        else:
+            self.stats_recorder = CommonStatsRecorder(model, include_matcher_fn=include_matcher_fn,
+                                                      input_fn=gen_inference_fn(all_class_ref_stats, shared_reductions))
         # channle_reduction = ['simes_pval', 'cond_fisher'],
         # self.channel_reduction = channle_reduction
         for rc in all_class_ref_stats:
@@ -735,42 +1193,41 @@ class OODDetector():
                                                                filter_layer=self.filter_layer,
                                                                target_percentiles=th.linspace(0, 1, 1000))
         self.num_classes = len(all_class_ref_stats)
+        self._stacked_output_matchers = {}
 
 
-    # helper function to convert per class per reduction to per reduction per class dictionary
-    def _gen_output_dict(self,per_class_per_reduction_record):
-        # prepare a dict with pvalues per reduction per sample per class i.e. {reduction_name : (BxC)}
-        reduction_stats_collection = {}
-        for reduction_name in per_class_per_reduction_record[0].keys():
-            reduction_stats_collection[reduction_name] = []
-            for class_stats in per_class_per_reduction_record:
-                reduction_stats_collection[reduction_name].append(class_stats[reduction_name].cpu())
-            reduction_stats_collection[reduction_name] = th.cat(reduction_stats_collection[reduction_name], -1)
+    def _stacked_output_matcher(self, group_id, reduction_name, s):
+        # fisher pvalue matchers of all classes in one lookup when their percentile grids agree
+        key = (group_id, reduction_name, s)
+        if key not in self._stacked_output_matchers:
+            matchers = [self.output_pval_matcher[class_id][group_id][reduction_name][s]
+                        for class_id in range(self.num_classes)]
+            self._stacked_output_matchers[key] = StackedPvalueMatcher(matchers) \
+                if StackedPvalueMatcher.compatible(matchers) else None
+        return self._stacked_output_matchers[key]
 
-        return reduction_stats_collection
-
-    # this function should return pvalues in the format of (Batch x num_classes)
+    # the recorder holds stacked per layer results {reduction_name: [per input {channel_reduction_name: (BxC)}]}
+    # these functions should return pvalues in the format of {reduction_name : (Batch x num_classes)}
     # todo merge this with extract_output_distribution fisher compute (iterate over tracked modules
     #  instead of record entries)
     def get_fisher(self):
-        per_class_record = []
         # reduce all layers (e.g. fisher)
-        for class_id in range(self.num_classes):
-            sum_pval_per_reduction = fisher_reduce_all_layers(self.stats_recorder.record, class_id=class_id,
-                                                              using_ref_record=False)
-            fisher_pvals_per_reduction = self._extract_fisher_pvalues(sum_pval_per_reduction, class_id=class_id)
-
-            per_class_record.append(fisher_pvals_per_reduction)
+        sum_pval_per_reduction = fisher_reduce_all_layers(self.stats_recorder.record, using_ref_record=False)
+        fisher_pvals_per_reduction = self._extract_fisher_pvalues(sum_pval_per_reduction)
+        return {k: v.cpu() for k, v in fisher_pvals_per_reduction.items()}
 
-        return self._gen_output_dict(per_class_record)
-
-    def _extract_fisher_pvalues(self, sum_pval_per_reduction, class_id, group_id=-1):
+    def _extract_fisher_pvalues(self, sum_pval_per_reduction, group_id=-1):
         # update fisher pvalue per reduction
         fisher_pvals_per_reduction = {}
         for reduction_name, sum_pval_record in sum_pval_per_reduction.items():
             for s, sum_pval in sum_pval_record.items():
-                fisher_pvals_per_reduction[f'{reduction_name}_{s}'] = \
-                    self.output_pval_matcher[class_id][group_id][reduction_name][s](sum_pval)
+                matcher = self._stacked_output_matcher(group_id, reduction_name, s)
+                if matcher is not None:
+                    fisher_pvals = matcher(sum_pval.unsqueeze(1))[:, 0]
+                else:
+                    fisher_pvals = th.cat([self.output_pval_matcher[class_id][group_id][reduction_name][s](
+                        sum_pval[:, class_id:class_id + 1]) for class_id in range(self.num_classes)], -1)
+                fisher_pvals_per_reduction[f'{reduction_name}_{s}'] = fisher_pvals
 
         return fisher_pvals_per_reduction
 
@@ -778,61 +1235,54 @@ class OODDetector():
         if groups_filter is None and not isinstance(self.filter_layer, GroupWhiteListInclude):
             return self.get_fisher()
         groups_filter = groups_filter or self.filter_layer
-        per_class_record = []
+        fisher_pvals_per_reduction = {}
         # reduce all layers (e.g. fisher)
-        for class_id in range(self.num_classes):
-            fisher_pvals_per_reduction = {}
-            for g in range(groups_filter.n_groups):
-                groups_filter.set_work_group(g)
-                logging.debug(f'processing group {g} pvalues: {groups_filter.get_work_group_members()}')
-                sum_pval_per_reduction = fisher_reduce_all_layers(self.stats_recorder.record,
-                                                                  filter_layer=groups_filter,
-                                                                  using_ref_record=False, class_id=class_id)
-                for k, v in self._extract_fisher_pvalues(sum_pval_per_reduction, group_id=g, class_id=class_id).items():
-                    if k not in fisher_pvals_per_reduction:
-                        fisher_pvals_per_reduction[k] = []
-                    fisher_pvals_per_reduction[k] += [v]
-
-            ## combine groups using fisher (alternativly this can be combined outside)
-            for k in fisher_pvals_per_reduction.keys():
-                fisher_pvals_per_reduction[k] = th.cat(fisher_pvals_per_reduction[k], -1)
-                if combine_fn:
-                    fisher_pvals_per_reduction[k] = combine_fn(fisher_pvals_per_reduction[k])
-
-            per_class_record.append(fisher_pvals_per_reduction)
-
-        return self._gen_output_dict(per_class_record)
+        for g in range(groups_filter.n_groups):
+            groups_filter.set_work_group(g)
+            logging.debug(f'processing group {g} pvalues: {groups_filter.get_work_group_members()}')
+            sum_pval_per_reduction = fisher_reduce_all_layers(self.stats_recorder.record,
+                                                              filter_layer=groups_filter,
+                                                              using_ref_record=False)
+            for k, v in self._extract_fisher_pvalues(sum_pval_per_reduction, group_id=g).items():
+                if k not in fisher_pvals_per_reduction:
+                    fisher_pvals_per_reduction[k] = []
+                fisher_pvals_per_reduction[k] += [v]
+
+        ## combine groups using fisher (alternativly this can be combined outside)
+        for k in fisher_pvals_per_reduction.keys():
+            # (Batch x groups x num_classes)
+            fisher_pvals = th.stack(fisher_pvals_per_reduction[k], 1)
+            if combine_fn:
+                fisher_pvals = combine_fn(fisher_pvals)[:, 0]
+            else:
+                # class major (Batch x num_classes * groups)
+                fisher_pvals = fisher_pvals.transpose(1, 2).flatten(1)
+            fisher_pvals_per_reduction[k] = fisher_pvals.cpu()
+
+        return fisher_pvals_per_reduction
 
     def get_simes(self):
-        per_class_record = []
-        for class_id in range(self.num_classes):
-            pval_per_reduction = {}
-            for layer_name, layer_stats_dict in self.stats_recorder.record.items():
-                # if filter_layer and filter_layer(layer_name):
-                #     continue
-                if class_id is not None:
-                    layer_stats_dict = layer_stats_dict[class_id]
-                for spatial_reduction_name, record_per_input in layer_stats_dict.items():
-                    # prepare the registry
-                    if spatial_reduction_name not in pval_per_reduction:
-                        pval_per_reduction[spatial_reduction_name] = {}
-                        channel_reduction_names = record_per_input[0].keys()
-                        for channel_reduction_name in channel_reduction_names:
-                            pval_per_reduction[spatial_reduction_name][channel_reduction_name] = []
-                    # all layer inputs are reduced together
-                    for record in record_per_input:
-                        for channel_reduction_name, pval in record.items():
-                            pval_per_reduction[spatial_reduction_name][channel_reduction_name].append(pval)
-
-            # update fisher pvalue per reduction
-            pvals_per_reduction = {}
-            for reduction_name, sum_pval_record in pval_per_reduction.items():
-                for s, pval in sum_pval_record.items():
-                    pvals_per_reduction[f'{reduction_name}_{s}'] = calc_simes(th.cat(pval, -1))
-
-            per_class_record.append(pvals_per_reduction)
-
-        return self._gen_output_dict(per_class_record)
+        pval_per_reduction = {}
+        for layer_name, layer_stats_dict in self.stats_recorder.record.items():
+            for spatial_reduction_name, record_per_input in layer_stats_dict.items():
+                # prepare the registry
+                if spatial_reduction_name not in pval_per_reduction:
+                    pval_per_reduction[spatial_reduction_name] = {}
+                    channel_reduction_names = record_per_input[0].keys()
+                    for channel_reduction_name in channel_reduction_names:
+                        pval_per_reduction[spatial_reduction_name][channel_reduction_name] = []
+                # all layer inputs are reduced together
+                for record in record_per_input:
+                    for channel_reduction_name, pval in record.items():
+                        pval_per_reduction[spatial_reduction_name][channel_reduction_name].append(pval)
+
+        # simes over all layer pvalues of each class (Batch x layers x num_classes)
+        pvals_per_reduction = {}
+        for reduction_name, sum_pval_record in pval_per_reduction.items():
+            for s, pval in sum_pval_record.items():
+                pvals_per_reduction[f'{reduction_name}_{s}'] = calc_simes(th.stack(pval, 1))[:, 0].cpu()
+
+        return pvals_per_reduction
 
 
 
@@ -855,12 +1305,53 @@ class FunctionComposition():
 
 PickleableFunctionComposition = FunctionComposition
 
+
+def _pop_channel_select(fn):
+    # (channel ids, remaining fn or None) of a composition that starts by selecting channels, None otherwise
+    if isinstance(fn, ChannelSelect):
+        return fn._ids, None
+    if isinstance(fn, FunctionComposition):
+        head = _pop_channel_select(fn.f1)
+        if head is not None:
+            ids, rest = head
+            return ids, fn.f2 if rest is None else FunctionComposition(rest, fn.f2)
+    return None
+
+def _whitening_factor(inv_cov):
+    # W such that inv_cov = W @ W.t(), the cholesky factor when inv_cov is positive definite and a clamped
+    # eigen decomposition otherwise (e.g. a pseudo inverse of a singular covariance)
+    inv_cov_ = inv_cov.double()
+    L, info = th.linalg.cholesky_ex(inv_cov_)
+    if info.item() != 0:
+        eig_vals, eig_vecs = th.linalg.eigh(inv_cov_)
+        L = eig_vecs * eig_vals.clamp(min=0).sqrt().unsqueeze(0)
+    return L.to(inv_cov.dtype)
+
+
 class MahalanobisDistance():
     def __init__(self,mean,inv_cov):
         self.mean = mean
         self.inv_cov = inv_cov
-
-    def __call__(self, x):
+        self._whitening = None
+
+    @property
+    def whitening(self):
+        # factored on first use
+        if self._whitening is None:
+            self._whitening = _whitening_factor(self.inv_cov)
+        return self._whitening
+
+    @whitening.setter
+    def whitening(self, whitening):
+        self._whitening = whitening
+
+    def __setstate__(self, state):
+        # objects pickled before the whitening factor was cached, or with an eagerly computed one
+        self.__dict__.update(state)
+        if '_whitening' not in state:
+            self._whitening = self.__dict__.pop('whitening', None)
+
+    def _to(self, x):
         if x.device != self.mean.device:
             if not hasattr(self, 'use_mean_device') or self.use_mean_device != _USE_PERCENTILE_DEVICE:
                 self.use_mean_device = _USE_PERCENTILE_DEVICE
@@ -869,8 +1360,44 @@ class MahalanobisDistance():
             else:
                 self.mean = self.mean.to(x.device)
                 self.inv_cov = self.inv_cov.to(x.device)
+                if self._whitening is not None:
+                    self._whitening = self._whitening.to(x.device)
+        return x
+
+    def __call__(self, x):
+        # per row sqrt(x_c @ inv_cov @ x_c.t()) as the norm of the whitened row, no batch x batch product
+        x = self._to(x)
         x_c = x - self.mean
-        return (x_c.matmul(self.inv_cov).matmul(x_c.t())).diag().unsqueeze(1).sqrt()
+        return x_c.matmul(self.whitening).norm(dim=1, keepdim=True)
+
+
+class BatchedMahalanobisDistance():
+    """distances of a batch to all class means in one op, returns [B, num_classes].
+    classes sharing a covariance (e.g. LDA) are scored with a single whitening matmul and a cdist.
+    x is [B, C], or [B, num_classes, C] when every class scores its own channels.
+    """
+    def __init__(self, distance_fns: List[MahalanobisDistance]):
+        self.mean = th.stack([fn.mean for fn in distance_fns])
+        whitening = [fn.whitening.to(self.mean.device) for fn in distance_fns]
+        self.shared = all(w is whitening[0] or th.equal(w, whitening[0]) for w in whitening[1:])
+        self.whitening = whitening[0] if self.shared else th.stack(whitening)
+        # whitened class means [K, C]
+        self.centers = self.mean.matmul(self.whitening) if self.shared else \
+            th.einsum('kc,kcd->kd', self.mean, self.whitening)
+
+    def __call__(self, x):
+        if x.device != self.mean.device:
+            self.mean = self.mean.to(x.device)
+            self.whitening = self.whitening.to(x.device)
+            self.centers = self.centers.to(x.device)
+        x = x.to(th.promote_types(x.dtype, self.mean.dtype))
+        if x.dim() == 3:
+            whitened = x.matmul(self.whitening) if self.shared else th.einsum('bkc,kcd->bkd', x, self.whitening)
+            return (whitened - self.centers.unsqueeze(0)).norm(dim=-1)
+        if self.shared:
+            return th.cdist(x.matmul(self.whitening), self.centers,
+                            compute_mode='donot_use_mm_for_euclid_dist')
+        return (th.einsum('bc,kcd->bkd', x, self.whitening) - self.centers.unsqueeze(0)).norm(dim=-1)
 
 
 ## auxilary data containers
@@ -909,6 +1436,11 @@ class BatchStatsCollectorCfg():
                           # collect intervals for better layer reduction statistic approximation
                           0.045,0.047,0.049,0.05,0.051,0.053,0.055, 0.07, 0.1, 0.2, 0.3, 0.4, 0.5]) # percentiles will be mirrored
     num_edge_samples: int = _EDGE_SAMPLES
+    # part 1 keeps a uniform sample of the reduced activations that part 2 replays instead of a second model
+    # forward (0 disables the replay)
+    replay_samples: int = 0
+    # part 1 trackers support merge (mergeable_meters), required to combine sharded or incremental measurements
+    mergeable: bool = False
 
     def __init__(self,batch_size,reduction_dictionary = None,include_matcher_fn = None,
                  sampled_channels : Dict[str,th.Tensor] = None):
@@ -925,9 +1457,131 @@ class BatchStatsCollectorCfg():
         logging.info(f'measure target percentiles {self.target_percentiles.numpy()}')
 
 
+class StackedClassScorer():
+    """scores a reduced layer input against all classes in a few batched ops instead of calling every class fn.
+    returns {channel_reduction_name: [B, num_classes]}, the same values the per class fns produce.
+    a channel selection leading the class fns is applied once, shared ids select [B, c] and per class ids of equal
+    size gather [B, c, num_classes]. build returns None when the class records can't be stacked.
+    """
+    def __init__(self):
+        self.pval_matcher = None
+        self.channel_select = None
+        self.channel_reductions = {}
+
+    @staticmethod
+    def _strip_channel_select(per_class_fns):
+        # per_class_fns [K][channel reductions] -> (selection or None, fns without it), None if it can't be stacked
+        heads = [[_pop_channel_select(fn) for fn in fns] for fns in per_class_fns]
+        if all(head is None for class_heads in heads for head in class_heads):
+            return None, per_class_fns
+        if any(head is None or head[1] is None for class_heads in heads for head in class_heads):
+            return None
+        class_ids = []
+        for class_heads in heads:
+            ids = th.as_tensor(class_heads[0][0]).cpu().view(-1)
+            if any(not th.equal(th.as_tensor(head[0]).cpu().view(-1), ids) for head in class_heads[1:]):
+                return None
+            class_ids.append(ids)
+        if all(th.equal(ids, class_ids[0]) for ids in class_ids[1:]):
+            selection = class_ids[0]
+        elif all(ids.numel() == class_ids[0].numel() for ids in class_ids[1:]):
+            selection = th.stack(class_ids)
+        else:
+            return None
+        return selection, [[head[1] for head in class_heads] for class_heads in heads]
+
+    @staticmethod
+    def _unpack(fn, f1_type):
+        # FunctionComposition(f1=<f1_type>, f2=<f2>) -> (f1, f2)
+        if type(fn) != FunctionComposition or type(fn.f1) != f1_type:
+            return None
+        return fn.f1, fn.f2
+
+    @classmethod
+    def build(cls, per_class_stats: List[BatchStatsCollectorRet], reduction_fn):
+        scorer = cls()
+        if any(stat.reduction_fn != reduction_fn for stat in per_class_stats):
+            return None
+        names = list(per_class_stats[0].channel_reduction_record.keys())
+        if any(list(stat.channel_reduction_record.keys()) != names for stat in per_class_stats):
+            return None
+        stripped = cls._strip_channel_select([[stat.channel_reduction_record[name]['fn'] for name in names]
+                                              for stat in per_class_stats])
+        if stripped is None:
+            return None
+        scorer.channel_select, per_class_fns = stripped
+        spatial_matchers = []
+        for n, name in enumerate(names):
+            fns = [class_fns[n] for class_fns in per_class_fns]
+            if name == 'simes_c':
+                # pval matcher -> simes
+                parts = [cls._unpack(fn, PvalueMatcher) for fn in fns]
+                if any(p is None or p[1] != calc_simes for p in parts):
+                    return None
+                spatial_matchers.append([p[0] for p in parts])
+                scorer.channel_reductions[name] = (calc_simes, None)
+            elif name == 'fisher_c':
+                # (pval matcher -> cond fisher) -> output pval matcher
+                parts = [cls._unpack(fn, FunctionComposition) for fn in fns]
+                if any(p is None for p in parts):
+                    return None
+                inner = [cls._unpack(p[0], PvalueMatcher) for p in parts]
+                if any(p is None or p[1] != calc_cond_fisher for p in inner):
+                    return None
+                spatial_matchers.append([p[0] for p in inner])
+                out_matchers = [p[1] for p in parts]
+                if not StackedPvalueMatcher.compatible(out_matchers):
+                    return None
+                scorer.channel_reductions[name] = (calc_cond_fisher, StackedPvalueMatcher(out_matchers))
+            elif name == 'mahalanobis':
+                # distance -> output pval matcher
+                parts = [cls._unpack(fn, MahalanobisDistance) for fn in fns]
+                if any(p is None for p in parts) or not StackedPvalueMatcher.compatible([p[1] for p in parts]):
+                    return None
+                scorer.channel_reductions[name] = (BatchedMahalanobisDistance([p[0] for p in parts]),
+                                                   StackedPvalueMatcher([p[1] for p in parts]))
+            else:
+                return None
+        if spatial_matchers:
+            # simes and cond fisher match the spatial reduction with the same per class meter
+            if any(any(m is not m0 for m, m0 in zip(matchers, spatial_matchers[0])) for matchers in spatial_matchers) \
+                    or not StackedPvalueMatcher.compatible(spatial_matchers[0]):
+                return None
+            scorer.pval_matcher = StackedPvalueMatcher(spatial_matchers[0])
+        return scorer
+
+    def __call__(self, x):
+        per_class_x = None
+        if self.channel_select is not None:
+            if x.device != self.channel_select.device:
+                self.channel_select = self.channel_select.to(x.device)
+            if self.channel_select.dim() == 1:
+                x = x[:, self.channel_select]
+            else:
+                # [B, c, K]
+                per_class_x = x[:, self.channel_select.t()]
+        pval = None
+        if self.pval_matcher is not None:
+            # [B, C, K]
+            pval = self.pval_matcher(per_class_x if per_class_x is not None else
+                                     x.unsqueeze(-1).expand(*x.shape, self.pval_matcher.quantiles.shape[0]))
+        ret = {}
+        for name, (reduce_fn, out_matcher) in self.channel_reductions.items():
+            if name == 'mahalanobis':
+                ret[name] = out_matcher(reduce_fn(x if per_class_x is None else per_class_x.transpose(1, 2))
+                                        .unsqueeze(1))[:, 0]
+            elif name == 'fisher_c':
+                # cond fisher modifies its input
+                ret[name] = out_matcher(reduce_fn(pval.clone()))[:, 0]
+            else:
+                ret[name] = reduce_fn(pval)[:, 0]
+        return ret
+
+
 class SimpleOnlineMeterFactory():
     def __init__(self, target_percentiles=None, number_edge_samples=0, track_cov=False, batched=True,
-                 track_percentiles=None, per_channel=False):
+                 track_percentiles=None, per_channel=False, mergeable=False):
+        self.mergeable = mergeable
         self.target_percentiles = target_percentiles
         self.num_edge_samples = number_edge_samples
         self.track_cov = track_cov
@@ -936,9 +1590,89 @@ class SimpleOnlineMeterFactory():
         self.per_channel = per_channel
 
     def __call__(self, k, v):
-        return OnlineMeter(batched=self.batched, track_percentiles=self.track_percentiles,
-                           per_channel=self.per_channel, target_percentiles=self.target_percentiles,
-                           number_edge_samples=self.num_edge_samples, track_cov=self.track_cov)
+        meter_cls = MergeableOnlineMeter if self.mergeable else OnlineMeter
+        return meter_cls(batched=self.batched, track_percentiles=self.track_percentiles,
+                         per_channel=self.per_channel, target_percentiles=self.target_percentiles,
+                         number_edge_samples=self.num_edge_samples, track_cov=self.track_cov)
+
+
+class ActivationReservoir():
+    """uniform sample (algorithm R) of at most `capacity` observations of every tracked spatial reduction.
+    the slots of each batch are drawn once by `plan` and shared by all layers, so replayed rows of different layers
+    belong to the same samples (required for the layer fusion of the part 2 records).
+    """
+    def __init__(self, capacity, seed=0):
+        self.capacity = capacity
+        self.num_seen = 0
+        self.generator = th.Generator().manual_seed(seed)
+        # (trace_name, input id, reduction name) -> [capacity, nchannels]
+        self.rows = {}
+        self.tracked_modules = []
+        self._slots = self._src = None
+
+    def __len__(self):
+        return min(self.num_seen, self.capacity)
+
+    def plan(self, num_observations):
+        # observation t is kept with probability capacity / (t + 1) and replaces a random slot
+        t = th.arange(self.num_seen, self.num_seen + num_observations)
+        slots = th.where(t < self.capacity, t,
+                         (th.rand(num_observations, generator=self.generator) * (t + 1)).long())
+        src = th.nonzero(slots < self.capacity)[:, 0]
+        # a later observation replaces an earlier one drawn to the same slot
+        winner = th.full((self.capacity,), -1, dtype=th.long).scatter_reduce_(0, slots[src], src, 'amax')
+        self._slots = th.nonzero(winner >= 0)[:, 0]
+        self._src = winner[self._slots]
+        self.num_seen += num_observations
+
+    def update(self, key, rows):
+        if key not in self.rows:
+            self.rows[key] = rows.new_zeros((self.capacity, rows.shape[1]))
+        self.rows[key][self._slots.to(rows.device)] = rows[self._src.to(rows.device)]
+
+    def replay(self, batch_size):
+        for start in range(0, len(self), batch_size):
+            yield {key: rows[start:min(start + batch_size, len(self))] for key, rows in self.rows.items()}
+
+    def merge(self, other):
+        # uniform sample of the union of both streams: draw the sample positions over all the observations seen,
+        # the count falling in each stream is taken uniformly from its own (uniform) sample
+        if other.num_seen == 0:
+            return self
+        num_seen = self.num_seen + other.num_seen
+        size = min(self.capacity, num_seen)
+        from_self = int((th.randperm(num_seen, generator=self.generator)[:size] < self.num_seen).sum())
+        ids = th.randperm(len(self), generator=self.generator)[:from_self]
+        other_ids = th.randperm(len(other), generator=self.generator)[:size - from_self]
+        for key, rows in other.rows.items():
+            merged = th.cat([self.rows[key][ids], rows[other_ids].to(self.rows[key].device)]) if key in self.rows \
+                else rows[other_ids]
+            self.rows[key] = th.cat([merged, merged.new_zeros((self.capacity - size, merged.shape[1]))])
+        self.num_seen = num_seen
+        self.tracked_modules = self.tracked_modules or other.tracked_modules
+        return self
+
+
+def _new_part1_tracker(measure_settings: BatchStatsCollectorCfg, seed=0):
+    compute_cov_on_partial_stats = measure_settings.partial_stats and not measure_settings.cov_off
+    ## bypass the simple recorder dictionary with a meter dictionary to track per layer statistics
+    meter_dict_cls = MergeableMeterDict if measure_settings.mergeable else MeterDict
+    tracker = meter_dict_cls(meter_factory=SimpleOnlineMeterFactory(batched=True, track_percentiles=True, per_channel=True,
+                                                                    target_percentiles=measure_settings.target_percentiles,
+                                                                    number_edge_samples=measure_settings.num_edge_samples,
+                                                                    track_cov=compute_cov_on_partial_stats,
+                                                                    mergeable=measure_settings.mergeable))
+    if measure_settings.replay_samples:
+        tracker.reservoir = ActivationReservoir(measure_settings.replay_samples, seed=seed)
+    return tracker
+
+
+def _merge_part1_tracker(tracker, other):
+    # combine part 1 trackers (mergeable meters) measured on disjoint samples
+    tracker.merge(other)
+    if getattr(tracker, 'reservoir', None) is not None:
+        tracker.reservoir.merge(other.reservoir)
+    return tracker
 
 
 def measure_data_statistics_part1(loader, model, epochs=5, model_device='cuda', collector_device='same',
@@ -946,26 +1680,27 @@ def measure_data_statistics_part1(loader, model, epochs=5, model_device='cuda',
                                   measure_settings: BatchStatsCollectorCfg = None):
     measure_settings = measure_settings or BatchStatsCollectorCfg(batch_size)
     compute_cov_on_partial_stats = measure_settings.partial_stats and not measure_settings.cov_off
-    ## bypass the simple recorder dictionary with a meter dictionary to track per layer statistics
-    tracker = MeterDict(meter_factory=SimpleOnlineMeterFactory(batched=True, track_percentiles=True, per_channel=True,
-                                                               target_percentiles=measure_settings.target_percentiles,
-                                                               number_edge_samples=measure_settings.num_edge_samples,
-                                                               track_cov=compute_cov_on_partial_stats))
+    tracker = _new_part1_tracker(measure_settings)
+    reservoir = getattr(tracker, 'reservoir', None)
+    fused_reduction = FusedSpatialReduction(measure_settings.reduction_dictionary)
 
     # function collects statistics of a batched tensors, return the collected statistics per input tensor
     def _batch_stats_collector_part1(trace_name, m, inputs):
         if type(inputs) != tuple:
             inputs = (inputs,)
         for e, i in enumerate(inputs):
-            for reduction_name, reduction_fn in measure_settings.reduction_dictionary.items():
+            reduced = fused_reduction(i)
+            for reduction_name in measure_settings.reduction_dictionary.keys():
                 tracker_name = f'{trace_name}_{reduction_name}:{e}'
                 ## make sure input is a 2d tensor [batch, nchannels]
-                i_ = reduction_fn(i)
+                i_ = reduced[reduction_name]
                 if collector_device != 'same' and collector_device != model_device:
                     i_ = i_.to(collector_device)
 
                 num_observations, channels = i_.shape
                 tracker.update({tracker_name: i_})
+                if reservoir is not None:
+                    reservoir.update((trace_name, e, reduction_name), i_)
     def _dummy_reducer(old, new):
         return old
 
@@ -974,7 +1709,9 @@ def measure_data_statistics_part1(loader, model, epochs=5, model_device='cuda',
         model.eval()
         with th.no_grad():
             for _ in tqdm.trange(epochs):
-                for d, l in loader:
+                for d, l in DevicePrefetcher(loader, model_device, inputs_only=True):
+                    if reservoir is not None:
+                        reservoir.plan(d.shape[0])
                     _ = model(d.to(model_device))
 
     model.to(model_device)
@@ -983,15 +1720,199 @@ def measure_data_statistics_part1(loader, model, epochs=5, model_device='cuda',
 
     logging.info(f'\t\tmeasuring {"covariance " if compute_cov_on_partial_stats else ""} mean and percentiles')
     _loop_over_data()
+    if reservoir is not None:
+        reservoir.tracked_modules = list(r.tracked_modules.keys())
     r.record.clear()
     r.remove_model_hooks()
     return tracker
 
 
+def _collect_part2_reduction(tracker, measure_settings: BatchStatsCollectorCfg, tracker_name, reduction_name,
+                             reduction_fn, i_, model_device='cuda', collector_device='same', channels_selected=False):
+    # channel reductions of a spatially reduced [batch, nchannels] tensor, see measure_data_statistics_part2
+    # with channels_selected i_ only holds the sampled channels (selected before the spatial reduction)
+    if measure_settings.sample_channels and tracker_name in measure_settings.sample_channels:
+        sample_channels = measure_settings.sample_channels[tracker_name]
+        # the stored functions select the sampled channels of the full spatial reduction output (reductions may
+        # change the number of channels), inference pushes the selection before the reduction when it can
+        # reduction_fn = PickleableFunctionComposition(f1=reduction_fn,f2=ChannelSelect(sample_channels.clone()))
+        sample_channels_fn = ChannelSelect(sample_channels.clone())
+        if not channels_selected:
+            i_ = sample_channels_fn(i_)
+    else:
+        sample_channels = None
+
+    if collector_device != 'same' and collector_device != model_device:
+        i_ = i_.to(collector_device)
+
+    num_observations, channels = i_.shape
+    reduction_ret_obj = BatchStatsCollectorRet(reduction_name, reduction_fn,
+                                               num_observations=num_observations)
+
+    # save a reference to the meter for convenience
+    reduction_ret_obj.meter = tracker[tracker_name]
+    ## typically second phase measurements
+    # this requires first collecting reduction statistics (covariance), then in a second pass we can collect
+    if measure_settings.mahalanobis:
+        if measure_settings.LDA_tracker and tracker_name in measure_settings.LDA_tracker:
+            cov_tracker = measure_settings.LDA_tracker
+        else:
+            cov_tracker = tracker
+
+        # part 1 stats are fixed during part 2, the inverse covariance and its whitening factor are computed once
+        # per meter and reused by every batch
+        if not hasattr(reduction_ret_obj.meter, 'mahalanobis_fn'):
+            if sample_channels is not None:
+                mean, inv_cov = tracker[tracker_name].mean[sample_channels], cov_tracker[tracker_name].inv_cov(
+                    sample_channels)
+            else:
+                mean, inv_cov = tracker[tracker_name].mean, cov_tracker[tracker_name].inv_cov()
+            reduction_ret_obj.meter.mahalanobis_fn = MahalanobisDistance(mean, inv_cov)
+        mahalanobis_fn = reduction_ret_obj.meter.mahalanobis_fn
+        # reduce all per channels stats to a single score
+        i_m = mahalanobis_fn(i_)
+        # measure the distribution per layer
+        tracker.update({f'{tracker_name}-@mahalabobis': i_m})
+        if sample_channels is not None:
+            # update function channel selection for inference time # todo move all fns outside of the loop
+            mahalanobis_fn = FunctionComposition(f1=sample_channels_fn, f2=mahalanobis_fn)
+        reduction_ret_obj.channel_reduction_record.update({'mahalanobis':
+                                                           # used for layer fusion (concatinate over all batches)
+                                                               {'record': i_m,
+                                                                ## used to extract the pval from the output of the spatial reduction output
+                                                                # channel reduction transformation
+                                                                'right_side_pval': True,
+                                                                'fn': mahalanobis_fn,
+                                                                # meter for the channel reduction (used to create pval matcher)
+                                                                'meter': tracker[
+                                                                    f'{tracker_name}-@mahalabobis'],
+                                                                }
+                                              } )
+
+    if measure_settings.find_simes or measure_settings.find_cond_fisher:
+        if not hasattr(reduction_ret_obj.meter,'pval_matcher'):
+            p,q=reduction_ret_obj.meter.get_distribution_histogram()
+            if sample_channels is not None:
+                # need to slice pvalues to sampled channels
+                q = q[:,sample_channels]
+            reduction_ret_obj.meter.pval_matcher = PvalueMatcher(percentiles=p,quantiles=q)
+        # here we first seek the pvalue for the observated reduction value
+        pval = reduction_ret_obj.meter.pval_matcher(i_)
+
+        if measure_settings.find_simes:
+            i_s = calc_simes(pval)
+            # tracker.update({f'{tracker_name}-@simes_c': i_})
+            simes_fn = FunctionComposition(f1=reduction_ret_obj.meter.pval_matcher, f2=calc_simes)
+            if sample_channels is not None:
+                simes_fn = FunctionComposition(f1=sample_channels_fn, f2=simes_fn)
+
+            reduction_ret_obj.channel_reduction_record.update({'simes_c':
+                {
+                    'right_side_pval': False,
+                    'record': i_s,
+                    'fn': simes_fn
+                }
+            })
+
+        if measure_settings.find_cond_fisher:
+            i_f = calc_cond_fisher(pval)
+            # result is not normalized as pvalues, we need to measure the distribution
+            # of this value to return to pval terms
+            tracker.update({f'{tracker_name}-@fisher_c': i_f})
+            fisher_fn = FunctionComposition(f1=reduction_ret_obj.meter.pval_matcher,
+                                            f2=calc_cond_fisher)
+            if sample_channels is not None:
+                fisher_fn = FunctionComposition(f1=sample_channels_fn, f2=fisher_fn)
+            reduction_ret_obj.channel_reduction_record.update({'fisher_c':
+                                                                   {'record': i_f,
+                                                                    'meter': tracker[
+                                                                        f'{tracker_name}-@fisher_c'],
+                                                                    'right_side_pval': True,
+                                                                    'fn': fisher_fn
+                                                                    }
+                                                               })
+    return reduction_ret_obj
+
+
+# this functionality is used to calculate a more accurate covariance estimate
+def _merge_part2_records(old_record, new_entry):
+    stats_per_input = []
+    for input_id, reduction_stats_record_n in enumerate(new_entry):
+        reductions_per_input = []
+        for reduction_id, new_reduction_ret_obj in enumerate(reduction_stats_record_n):
+            reduction_ret_obj = old_record[input_id][reduction_id]
+            assert reduction_ret_obj.reduction_name == new_reduction_ret_obj.reduction_name
+            # aggregate all observed channel reduction values per method
+            for channel_reduction_name in new_reduction_ret_obj.channel_reduction_record.keys():
+                reduction_ret_obj.channel_reduction_record[channel_reduction_name]['record'] = \
+                    th.cat([reduction_ret_obj.channel_reduction_record[channel_reduction_name]['record'],
+                            new_reduction_ret_obj.channel_reduction_record[channel_reduction_name]['record']])
+
+            reductions_per_input.append(reduction_ret_obj)
+        stats_per_input.append(reductions_per_input)
+    return stats_per_input
+
+
+def _add_part2_record(record, trace_name, input_id, reduction_id, reduction_ret_obj):
+    # record: {trace_name: {(input id, reduction id): BatchStatsCollectorRet}}, chunks of the same entry are merged
+    per_input = record.setdefault(trace_name, {})
+    key = (input_id, reduction_id)
+    per_input[key] = _merge_part2_records([[per_input[key]]], [[reduction_ret_obj]])[0][0] if key in per_input \
+        else reduction_ret_obj
+
+
+def _nested_part2_record(record, num_reductions):
+    # the per input, per reduction layout collected by the part 2 recorder
+    return {trace_name: [[per_input[(e, r)] for r in range(num_reductions)]
+                         for e in sorted({e for e, _ in per_input})]
+            for trace_name, per_input in record.items()}
+
+
+def _build_ref_stat_dict(tracked_modules, record):
+    ## build reference dictionary with per layer information per reduction (reversing collection order)
+    ret_stat_dict = {}
+    for k in tracked_modules:
+        ret_stat_dict[k] = {}
+        for kk, stats_per_input in record.items():
+            if kk.startswith(k):
+                for inp_id, reduction_records in enumerate(stats_per_input):
+                    for reduction_record in reduction_records:
+                        assert isinstance(reduction_record,BatchStatsCollectorRet)
+                        # #todo create a channel reduction pval matcher right here
+                        for channel_reduction_entry in reduction_record.channel_reduction_record.values():
+                            channel_reduction_entry['record'] = channel_reduction_entry['record'].cpu()
+                            if 'meter' in channel_reduction_entry:
+                                p,q = channel_reduction_entry['meter'].get_distribution_histogram()
+                                pval_matcher = PvalueMatcher(quantiles=q,percentiles=p,right_side=channel_reduction_entry['right_side_pval'])
+                                channel_reduction_entry['pval_matcher'] = pval_matcher
+                                # create the final function to retrive the layer pvalue from a given spatial reduction
+                                channel_reduction_entry['fn'] = FunctionComposition(channel_reduction_entry['fn'],
+                                                                                    pval_matcher)
+
+                        if reduction_record.reduction_name in ret_stat_dict[k]:
+                            ret_stat_dict[k][reduction_record.reduction_name] += [reduction_record]
+                        else:
+                            ret_stat_dict[k][reduction_record.reduction_name] = [reduction_record]
+    return ret_stat_dict
+
+
+def _sampled_channels(measure_settings: BatchStatsCollectorCfg, trace_name, e):
+    # {reduction_name: sampled channel ids} of a layer input
+    if not measure_settings.sample_channels:
+        return {}
+    channels = {}
+    for reduction_name in measure_settings.reduction_dictionary.keys():
+        tracker_name = f'{trace_name}_{reduction_name}:{e}'
+        if tracker_name in measure_settings.sample_channels:
+            channels[reduction_name] = measure_settings.sample_channels[tracker_name]
+    return channels
+
+
 def measure_data_statistics_part2(tracker, loader, model,epochs=5, model_device='cuda', collector_device='same', batch_size=1000,
                             measure_settings : BatchStatsCollectorCfg = None):
 
     measure_settings = measure_settings or BatchStatsCollectorCfg(batch_size)
+    fused_reduction = FusedSpatialReduction(measure_settings.reduction_dictionary)
     # function collects statistics of a batched tensors, return the collected statistics per input tensor
     def _batch_stats_collector_part2(trace_name, m, inputs):
         stats_per_input = []
@@ -999,144 +1920,35 @@ def measure_data_statistics_part2(tracker, loader, model,epochs=5, model_device=
             inputs = (inputs,)
         for e, i in enumerate(inputs):
             reduction_specific_record = []
+            # sampled channels are selected before the spatial reduction
+            channels = _sampled_channels(measure_settings, trace_name, e)
+            reduced = fused_reduction(i, channels)
             for reduction_name, reduction_fn in measure_settings.reduction_dictionary.items():
                 tracker_name = f'{trace_name}_{reduction_name}:{e}'
                 ## make sure input is a 2d tensor [batch, nchannels]
-                i_ = reduction_fn(i)
-
-                if measure_settings.sample_channels and tracker_name in measure_settings.sample_channels:
-                    sample_channels = measure_settings.sample_channels[tracker_name]
-                    # we update reduction_fn and leverage BatchStatsCollectorRet keep layer specific modifications
-                    # Note that sampling before reduction is more efficient, however we reverse the order to simplify
-                    # the case where spatial reductions may change the number of channels
-                    # reduction_fn = PickleableFunctionComposition(f1=reduction_fn,f2=ChannelSelect(sample_channels.clone()))
-                    sample_channels_fn = ChannelSelect(sample_channels.clone())
-                    i_ = sample_channels_fn(i_)
-                else:
-                    sample_channels = None
-
-                if collector_device != 'same' and collector_device != model_device:
-                    i_ = i_.to(collector_device)
-
-                num_observations, channels = i_.shape
-                reduction_ret_obj = BatchStatsCollectorRet(reduction_name, reduction_fn,
-                                                           num_observations=num_observations)
-
-                # save a reference to the meter for convenience
-                reduction_ret_obj.meter = tracker[tracker_name]
-                ## typically second phase measurements
-                # this requires first collecting reduction statistics (covariance), then in a second pass we can collect
-                if measure_settings.mahalanobis:
-                    if measure_settings.LDA_tracker and tracker_name in measure_settings.LDA_tracker:
-                        cov_tracker = measure_settings.LDA_tracker
-                    else:
-                        cov_tracker = tracker
-
-                    if sample_channels is not None:
-                        mean, inv_cov = tracker[tracker_name].mean[sample_channels], cov_tracker[tracker_name].inv_cov(
-                            sample_channels)
-                    else:
-                        mean, inv_cov = tracker[tracker_name].mean, cov_tracker[tracker_name].inv_cov()
+                i_ = reduced[reduction_name]
 
-                    mahalanobis_fn = MahalanobisDistance(mean, inv_cov)
-                    # reduce all per channels stats to a single score
-                    i_m = mahalanobis_fn(i_)
-                    # measure the distribution per layer
-                    tracker.update({f'{tracker_name}-@mahalabobis': i_m})
-                    if sample_channels is not None:
-                        # update function channel selection for inference time # todo move all fns outside of the loop
-                        mahalanobis_fn = FunctionComposition(f1=sample_channels_fn, f2=mahalanobis_fn)
-                    reduction_ret_obj.channel_reduction_record.update({'mahalanobis':
-                                                                       # used for layer fusion (concatinate over all batches)
-                                                                           {'record': i_m,
-                                                                            ## used to extract the pval from the output of the spatial reduction output
-                                                                            # channel reduction transformation
-                                                                            'right_side_pval': True,
-                                                                            'fn': mahalanobis_fn,
-                                                                            # meter for the channel reduction (used to create pval matcher)
-                                                                            'meter': tracker[
-                                                                                f'{tracker_name}-@mahalabobis'],
-                                                                            }
-                                                          } )
-
-                if measure_settings.find_simes or measure_settings.find_cond_fisher:
-                    if not hasattr(reduction_ret_obj.meter,'pval_matcher'):
-                        p,q=reduction_ret_obj.meter.get_distribution_histogram()
-                        if sample_channels is not None:
-                            # need to slice pvalues to sampled channels
-                            q = q[:,sample_channels]
-                        reduction_ret_obj.meter.pval_matcher = PvalueMatcher(percentiles=p,quantiles=q)
-                    # here we first seek the pvalue for the observated reduction value
-                    pval = reduction_ret_obj.meter.pval_matcher(i_)
-
-                    if measure_settings.find_simes:
-                        i_s = calc_simes(pval)
-                        # tracker.update({f'{tracker_name}-@simes_c': i_})
-                        simes_fn = FunctionComposition(f1=reduction_ret_obj.meter.pval_matcher, f2=calc_simes)
-                        if sample_channels is not None:
-                            simes_fn = FunctionComposition(f1=sample_channels_fn, f2=simes_fn)
-
-                        reduction_ret_obj.channel_reduction_record.update({'simes_c':
-                            {
-                                'right_side_pval': False,
-                                'record': i_s,
-                                'fn': simes_fn
-                            }
-                        })
-
-                    if measure_settings.find_cond_fisher:
-                        i_f = calc_cond_fisher(pval)
-                        # result is not normalized as pvalues, we need to measure the distribution
-                        # of this value to return to pval terms
-                        tracker.update({f'{tracker_name}-@fisher_c': i_f})
-                        fisher_fn = FunctionComposition(f1=reduction_ret_obj.meter.pval_matcher,
-                                                        f2=calc_cond_fisher)
-                        if sample_channels is not None:
-                            fisher_fn = FunctionComposition(f1=sample_channels_fn, f2=fisher_fn)
-                        reduction_ret_obj.channel_reduction_record.update({'fisher_c':
-                                                                               {'record': i_f,
-                                                                                'meter': tracker[
-                                                                                    f'{tracker_name}-@fisher_c'],
-                                                                                'right_side_pval': True,
-                                                                                'fn': fisher_fn
-                                                                                }
-                                                                           })
-
-                reduction_specific_record.append(reduction_ret_obj)
+                reduction_specific_record.append(
+                    _collect_part2_reduction(tracker, measure_settings, tracker_name, reduction_name, reduction_fn, i_,
+                                             model_device, collector_device,
+                                             channels_selected=reduction_name in channels))
 
             stats_per_input.append(reduction_specific_record)
 
         return stats_per_input
 
-    # this functionality is used to calculate a more accurate covariance estimate
-    def _batch_stats_reducer_part2(old_record, new_entry):
-        stats_per_input = []
-        for input_id, reduction_stats_record_n in enumerate(new_entry):
-            reductions_per_input = []
-            for reduction_id, new_reduction_ret_obj in enumerate(reduction_stats_record_n):
-                reduction_ret_obj = old_record[input_id][reduction_id]
-                assert reduction_ret_obj.reduction_name == new_reduction_ret_obj.reduction_name
-                # aggregate all observed channel reduction values per method
-                for channel_reduction_name in new_reduction_ret_obj.channel_reduction_record.keys():
-                    reduction_ret_obj.channel_reduction_record[channel_reduction_name]['record'] = \
-                        th.cat([reduction_ret_obj.channel_reduction_record[channel_reduction_name]['record'],
-                                new_reduction_ret_obj.channel_reduction_record[channel_reduction_name]['record']])
-
-                reductions_per_input.append(reduction_ret_obj)
-            stats_per_input.append(reductions_per_input)
-        return stats_per_input
 
     # simple loop over measure data to collect statistics
     def _loop_over_data():
         model.eval()
         with th.no_grad():
             for _ in tqdm.trange(epochs):
-                for d, l in loader:
+                for d, l in DevicePrefetcher(loader, model_device, inputs_only=True):
                     _ = model(d.to(model_device))
 
     model.to(model_device)
     r = CommonStatsRecorder(model, include_matcher_fn=measure_settings.include_matcher_fn,
-                            input_fn=_batch_stats_collector_part2, activation_reducer_fn=_batch_stats_reducer_part2)
+                            input_fn=_batch_stats_collector_part2, activation_reducer_fn=_merge_part2_records)
 
     logging.info(f'\t\tcalculating layer pvalues using measured mean and quantiles')
     measure_settings.mahalanobis = True
@@ -1144,35 +1956,300 @@ def measure_data_statistics_part2(tracker, loader, model,epochs=5, model_device=
     measure_settings.find_cond_fisher = False
     _loop_over_data()
 
-    ## build reference dictionary with per layer information per reduction (reversing collection order)
-    ret_stat_dict = {}
-    for k in r.tracked_modules.keys():
-        ret_stat_dict[k] = {}
-        for kk, stats_per_input in r.record.items():
-            if kk.startswith(k):
-                for inp_id, reduction_records in enumerate(stats_per_input):
-                    for reduction_record in reduction_records:
-                        assert isinstance(reduction_record,BatchStatsCollectorRet)
-                        # #todo create a channel reduction pval matcher right here
-                        for channel_reduction_entry in reduction_record.channel_reduction_record.values():
-                            channel_reduction_entry['record'] = channel_reduction_entry['record'].cpu()
-                            if 'meter' in channel_reduction_entry:
-                                p,q = channel_reduction_entry['meter'].get_distribution_histogram()
-                                pval_matcher = PvalueMatcher(quantiles=q,percentiles=p,right_side=channel_reduction_entry['right_side_pval'])
-                                channel_reduction_entry['pval_matcher'] = pval_matcher
-                                # create the final function to retrive the layer pvalue from a given spatial reduction
-                                channel_reduction_entry['fn'] = FunctionComposition(channel_reduction_entry['fn'],
-                                                                                    pval_matcher)
-
-                        if reduction_record.reduction_name in ret_stat_dict[k]:
-                            ret_stat_dict[k][reduction_record.reduction_name] += [reduction_record]
-                        else:
-                            ret_stat_dict[k][reduction_record.reduction_name] = [reduction_record]
+    ret_stat_dict = _build_ref_stat_dict(r.tracked_modules.keys(), r.record)
     r.record.clear()
     r.remove_model_hooks()
     return ret_stat_dict
 
 
+def replay_data_statistics_part2(tracker, batch_size=1000, model_device='cuda', collector_device='same',
+                                 measure_settings: BatchStatsCollectorCfg = None):
+    """measure_data_statistics_part2 without a model forward, the channel reductions are computed on the
+    activations sampled by part 1 (tracker.reservoir), replayed in chunks of `batch_size`.
+    """
+    measure_settings = measure_settings or BatchStatsCollectorCfg(batch_size)
+    reservoir = tracker.reservoir
+    reduction_names = list(measure_settings.reduction_dictionary.keys())
+    logging.info(f'\t\tcalculating layer pvalues using measured mean and quantiles '
+                 f'(replaying {len(reservoir)}/{reservoir.num_seen} observations)')
+    measure_settings.mahalanobis = True
+    measure_settings.find_simes = True
+    measure_settings.find_cond_fisher = False
+    record = {}
+    for rows_per_key in reservoir.replay(batch_size):
+        for (trace_name, e, reduction_name), rows in rows_per_key.items():
+            ret = _collect_part2_reduction(tracker, measure_settings, f'{trace_name}_{reduction_name}:{e}',
+                                           reduction_name, measure_settings.reduction_dictionary[reduction_name],
+                                           rows, model_device, collector_device)
+            _add_part2_record(record, trace_name, e, reduction_names.index(reduction_name), ret)
+    return _build_ref_stat_dict(reservoir.tracked_modules, _nested_part2_record(record, len(reduction_names)))
+
+
+class ClassGroupedBatchSampler(th.utils.data.Sampler):
+    """Batches over the samples of `class_ids` with the classes laid out one after the other (shuffled within each
+    class), so a batch mixes at most a few classes and per class buffers are released as soon as a class is done.
+    """
+    def __init__(self, targets, class_ids, batch_size, epochs=1, shuffle=True):
+        self.targets = th.as_tensor(targets)
+        self.class_ids = list(class_ids)
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.shuffle = shuffle
+        self.class_samples = [th.where(self.targets == c)[0] for c in self.class_ids]
+        self.num_samples = sum(len(ids) for ids in self.class_samples) * epochs
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = []
+        for _ in range(self.epochs):
+            for ids in self.class_samples:
+                order.append(ids[th.randperm(len(ids))] if self.shuffle else ids)
+        order = th.cat(order) if order else th.zeros(0, dtype=th.long)
+        return iter(order.split(self.batch_size))
+
+
+def measure_per_class_statistics(model, measure_ds, targets, class_ids, class_settings: List[BatchStatsCollectorCfg],
+                                 part=1, trackers=None, epochs=1, batch_size=1000, model_device='cuda',
+                                 collector_device='same', num_workers=_NUM_LOADER_WORKERS, build_ref_stats=True):
+    """Single pass replacement for running measure_data_statistics_part1/part2 on a per class loader.
+    every spatial reduction runs once on the mixed class batch, the reduced rows are split by label and
+    buffered per class, and each class receives chunks of `batch_size` rows (and a final remainder per epoch)
+    exactly like its own shuffled loader would produce, keeping the batch based meter estimates unchanged.
+    when measure_ds is an ActivationStore the stored reductions are used and the model is never run.
+    returns the part 1 trackers (given trackers are updated) or the part 2 reference stat dicts, one per class id.
+    without build_ref_stats part 2 returns the raw (tracked_modules, records, trackers) to be merged across shards.
+    """
+    store = measure_ds if isinstance(measure_ds, ActivationStore) else None
+    settings = class_settings[0]
+    targets = th.as_tensor(targets)
+    class_pos = {c: n for n, c in enumerate(class_ids)}
+    class_size = [int((targets == c).sum()) for c in class_ids]
+    if part == 1:
+        if trackers is None:
+            trackers = [_new_part1_tracker(cfg) for cfg in class_settings]
+    else:
+        for cfg in class_settings:
+            cfg.mahalanobis = True
+            cfg.find_simes = True
+            cfg.find_cond_fisher = False
+    reservoirs = [getattr(tracker, 'reservoir', None) for tracker in trackers]
+    records = [{} for _ in class_ids]
+    # per class: {(trace_name, input id, reduction id): [row chunks]}
+    buffers = [{} for _ in class_ids]
+    pending = [0] * len(class_ids)
+    seen = [0] * len(class_ids)
+    reductions = list(settings.reduction_dictionary.items())
+    fused_reduction = FusedSpatialReduction(settings.reduction_dictionary)
+    # (trace_name, input id, reduction name) -> (union of the class channel samples, per class positions) or None
+    class_channels = {}
+    current = {}
+
+    def _class_channels(trace_name, e, reduction_name):
+        # classes sample different channels, the union is reduced once and every class slices its own channels
+        key = (trace_name, e, reduction_name)
+        if key not in class_channels:
+            tracker_name = f'{trace_name}_{reduction_name}:{e}'
+            ids = [(cfg.sample_channels or {}).get(tracker_name) for cfg in class_settings]
+            class_channels[key] = channel_union(ids) if part == 2 and fused_reduction.channelwise(reduction_name) \
+                and all(i is not None for i in ids) else None
+        return class_channels[key]
+
+    def _buffer_rows(trace_name, e, r, i_):
+        # split a reduced [batch, nchannels] tensor by label into the per class buffers
+        i_ = i_[current['order'].to(i_.device)]
+        for c, rows in zip(current['ids'], i_.split(current['counts'])):
+            buffers[class_pos[c]].setdefault((trace_name, e, r), []).append(rows)
+
+    def _split_collector(trace_name, m, inputs):
+        if type(inputs) != tuple:
+            inputs = (inputs,)
+        for e, i in enumerate(inputs):
+            channels = {}
+            for reduction_name, _ in reductions:
+                selection = _class_channels(trace_name, e, reduction_name)
+                if selection is not None:
+                    channels[reduction_name] = selection[0]
+            reduced = fused_reduction(i, channels)
+            for r, (reduction_name, _) in enumerate(reductions):
+                ## make sure input is a 2d tensor [batch, nchannels]
+                _buffer_rows(trace_name, e, r, reduced[reduction_name])
+
+    def _dispatch(n, trace_name, e, r, rows):
+        reduction_name, reduction_fn = reductions[r]
+        tracker_name = f'{trace_name}_{reduction_name}:{e}'
+        if part == 1:
+            if collector_device != 'same' and collector_device != model_device:
+                rows = rows.to(collector_device)
+            trackers[n].update({tracker_name: rows})
+            if reservoirs[n] is not None:
+                reservoirs[n].update((trace_name, e, reduction_name), rows)
+            return
+        selection = _class_channels(trace_name, e, reduction_name)
+        if selection is not None:
+            rows = rows[:, selection[1][n].to(rows.device)]
+        ret = _collect_part2_reduction(trackers[n], class_settings[n], tracker_name, reduction_name, reduction_fn,
+                                       rows, model_device, collector_device, channels_selected=selection is not None)
+        _add_part2_record(records[n], trace_name, e, r, ret)
+
+    def _flush(n, num_rows):
+        if part == 1 and reservoirs[n] is not None:
+            reservoirs[n].plan(num_rows)
+        for (trace_name, e, r), chunks in buffers[n].items():
+            rows = th.cat(chunks) if len(chunks) > 1 else chunks[0]
+            chunks[:] = [rows[num_rows:]] if rows.shape[0] > num_rows else []
+            _dispatch(n, trace_name, e, r, rows[:num_rows])
+        pending[n] -= num_rows
+
+    sampler = ClassGroupedBatchSampler(targets, class_ids, batch_size, epochs=epochs, shuffle=True)
+    if store is not None:
+        tracked_modules = store.select_modules(model, settings.include_matcher_fn)
+        reduction_ids = {reduction_name: r for r, (reduction_name, _) in enumerate(reductions)}
+        stored_keys = [key for key in store.files if key[0][:-8] in tracked_modules and key[2] in reduction_ids]
+
+        def _batches():
+            for indices in sampler:
+                # sorted reads are sequential in the memory maps
+                indices = indices.sort()[0]
+                yield store.rows(indices, stored_keys), targets[indices]
+        batches = _batches()
+    else:
+        loader = th.utils.data.DataLoader(measure_ds, batch_sampler=sampler, num_workers=num_workers,
+                                          pin_memory=False)
+        model.to(model_device)
+        recorder = CommonStatsRecorder(model, include_matcher_fn=settings.include_matcher_fn,
+                                       input_fn=_split_collector, activation_reducer_fn=lambda old, new: old)
+        model.eval()
+        batches = DevicePrefetcher(loader, model_device, inputs_only=True)
+    with th.no_grad():
+        for d, l in tqdm.tqdm(batches, total=len(sampler)):
+            current['labels'] = th.as_tensor(l)
+            current['order'] = th.argsort(current['labels'], stable=True)
+            ids, counts = th.unique_consecutive(current['labels'][current['order']], return_counts=True)
+            current['ids'], current['counts'] = ids.tolist(), counts.tolist()
+            if store is not None:
+                for (trace_name, e, reduction_name), rows in d.items():
+                    rows = rows.to(model_device)
+                    selection = _class_channels(trace_name, e, reduction_name)
+                    if selection is not None:
+                        rows = rows[:, selection[0].to(rows.device)]
+                    _buffer_rows(trace_name, e, reduction_ids[reduction_name], rows)
+            else:
+                _ = model(d.to(model_device))
+            for c, k in zip(current['ids'], current['counts']):
+                n = class_pos[c]
+                pending[n] += k
+                seen[n] += k
+                while pending[n] >= batch_size:
+                    _flush(n, batch_size)
+                # the last (partial) batch of this class in the current epoch
+                if pending[n] and seen[n] % class_size[n] == 0:
+                    _flush(n, pending[n])
+    if store is None:
+        tracked_modules = list(recorder.tracked_modules.keys())
+        recorder.record.clear()
+        recorder.remove_model_hooks()
+    if part == 1:
+        for reservoir in reservoirs:
+            if reservoir is not None:
+                reservoir.tracked_modules = tracked_modules
+        return trackers
+    if not build_ref_stats:
+        return tracked_modules, records, trackers
+    ret = []
+    for record in records:
+        ret.append(_build_ref_stat_dict(tracked_modules, _nested_part2_record(record, len(reductions))))
+    return ret
+
+
+def _measure_class_shard(model, measure_ds, targets, class_ids, class_settings, part, trackers, epochs, batch_size,
+                         num_threads):
+    # process pool entry point, measures a shard of the samples on cpu
+    th.set_num_threads(num_threads)
+    return measure_per_class_statistics(model, measure_ds, targets, class_ids, class_settings, part=part,
+                                        trackers=trackers, epochs=epochs, batch_size=batch_size, model_device='cpu',
+                                        collector_device='cpu', num_workers=0, build_ref_stats=False)
+
+
+def measure_per_class_statistics_sharded(model, measure_ds, targets, class_ids,
+                                         class_settings: List[BatchStatsCollectorCfg], part=1, trackers=None,
+                                         epochs=1, batch_size=1000, num_processes=None):
+    """measure_per_class_statistics over a process pool, every worker runs the model on cpu over a shard of the
+    samples of every class. the part 1 trackers (mergeable meters and reservoirs) and the part 2 records of the
+    shards are merged, means and covariances equal a single pass and the batch based percentile estimates are
+    averaged over the shard batches.
+    """
+    num_processes = num_processes or os.cpu_count()
+    if part == 2 and not all(isinstance(tracker, MergeableMeterDict) for tracker in trackers):
+        # e.g. part 1 trackers loaded from a cache written before the meters were mergeable
+        logging.warning('part 1 trackers can not be merged, measuring part 2 in process')
+        return measure_per_class_statistics(model, measure_ds, targets, class_ids, class_settings, part=part,
+                                            trackers=trackers, epochs=epochs, batch_size=batch_size,
+                                            model_device='cpu', collector_device='cpu')
+    targets = th.as_tensor(targets)
+    # every class is split evenly over the shards, samples outside the shard are labeled -1 (measured by no class)
+    shard_targets = th.full((num_processes,) + targets.shape, -1, dtype=targets.dtype)
+    for c in class_ids:
+        for n, ids in enumerate(th.where(targets == c)[0].tensor_split(num_processes)):
+            shard_targets[n, ids] = c
+    if part == 1:
+        for cfg in class_settings:
+            cfg.mergeable = True
+        # independent reservoir draws per shard
+        shard_trackers = [[_new_part1_tracker(cfg, seed=n) for cfg in class_settings] for n in range(num_processes)]
+    else:
+        shard_trackers = [trackers] * num_processes
+    num_threads = max(os.cpu_count() // num_processes, 1)
+    model.to('cpu')
+    logging.info(f'\tmeasuring {len(class_ids)} classes on {num_processes} processes ({num_threads} threads each)')
+    with ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_measure_class_shard, model, measure_ds, shard_targets[n], class_ids, class_settings,
+                               part, shard_trackers[n], epochs, batch_size, num_threads)
+                   for n in range(num_processes)]
+        results = [future.result() for future in futures]
+    if part == 1:
+        ret = trackers if trackers is not None else results.pop(0)
+        for shard in results:
+            for tracker, shard_tracker in zip(ret, shard):
+                _merge_part1_tracker(tracker, shard_tracker)
+        return ret
+
+    # modules are only listed by the shards that ran the model
+    tracked_modules = max((shard_modules for shard_modules, _, _ in results), key=len)
+    num_reductions = len(class_settings[0].reduction_dictionary)
+    ret = []
+    for n, tracker in enumerate(trackers):
+        part1_keys = set(tracker.keys())
+        record = {}
+        for _, shard_records, part2_trackers in results:
+            # meters added by part 2 (e.g. the mahalanobis distance distribution) are merged into the input tracker
+            shard_tracker = part2_trackers[n]
+            tracker.merge({key: shard_tracker[key] for key in shard_tracker.keys() - part1_keys})
+            meter_keys = {id(meter): key for key, meter in shard_tracker.items()}
+            for trace_name, per_input in shard_records[n].items():
+                for (e, r), reduction_ret_obj in per_input.items():
+                    # records refer to the shard copies of the meters
+                    reduction_ret_obj.meter = tracker[meter_keys[id(reduction_ret_obj.meter)]]
+                    for channel_reduction_entry in reduction_ret_obj.channel_reduction_record.values():
+                        if 'meter' in channel_reduction_entry:
+                            channel_reduction_entry['meter'] = tracker[meter_keys[id(channel_reduction_entry['meter'])]]
+                    _add_part2_record(record, trace_name, e, r, reduction_ret_obj)
+        ret.append(_build_ref_stat_dict(tracked_modules, _nested_part2_record(record, num_reductions)))
+    return ret
+
+
+def _measure_per_class(model, measure_ds, targets, class_ids, class_settings, args: Settings, part=1, trackers=None):
+    # a store holds a single (possibly augmented) view of every sample
+    epochs = 5 if args.augment_measure and not isinstance(measure_ds, ActivationStore) else 1
+    kwargs = dict(part=part, trackers=trackers, epochs=epochs, batch_size=args.batch_size_measure)
+    if args.measure_processes > 1:
+        return measure_per_class_statistics_sharded(model, measure_ds, targets, class_ids, class_settings,
+                                                    num_processes=args.measure_processes, **kwargs)
+    return measure_per_class_statistics(model, measure_ds, targets, class_ids, class_settings, model_device=args.device,
+                                        collector_device=args.collector_device, **kwargs)
+
+
 def measure_v2(model, measure_ds, args: Settings, measure_cache_part1=None):
     if not hasattr(measure_ds, 'classes'):
         measure_ds.classes = list(range(args.num_classes))
@@ -1198,17 +2275,36 @@ def measure_v2(model, measure_ds, args: Settings, measure_cache_part1=None):
     if need_recompute and os.path.exists(measure_cache_part1):
         logging.info(f'loading cached class statistics (first measure step) from file: {measure_cache_part1}')
         all_class_stat_trackers = th.load(measure_cache_part1, map_location=args.collector_device)
+        if args.replay_samples:
+            logging.info(f'cached statistics hold no sampled activations, part 2 runs a model forward instead of replay')
     elif need_recompute and valid_LDA_cache_part1:
         all_class_stat_trackers = th.load(legacy_raw_path, map_location=args.collector_device)
         all_class_stat_trackers += th.load(joint_raw_path, map_location=args.collector_device)
     else:
         logging.info(f'Measure part 1')
+        class_ids = [class_id for class_id, class_name in enumerate(classes) if class_name != 'joint_distribution']
+        if class_ids:
+            logging.info(f'\tcollecting stats for {len(class_ids)} classes in a single pass')
+            class_settings = []
+            for class_id in class_ids:
+                measure_settings = BatchStatsCollectorCfg(args.batch_size_measure,
+                                                          reduction_dictionary=args.spatial_reductions,
+                                                          include_matcher_fn=args.include_matcher_fn_measure)
+                if (targets == class_id).sum() <= args.batch_size_measure:
+                    measure_settings.num_edge_samples = 0
+                ## disable per-class covariance compute for speedup measuring and reduce memory usage
+                if args.LDA:
+                    measure_settings.cov_off = True
+                measure_settings.replay_samples = args.replay_samples
+                class_settings.append(measure_settings)
+            all_class_stat_trackers += _measure_per_class(model, measure_ds, targets, class_ids, class_settings, args,
+                                                          part=1)
         for class_id, class_name in enumerate(classes):
+            if class_name != 'joint_distribution':
+                continue
             logging.info(f'\t{class_id}/{len(classes)}\tcollecting stats for class {class_name}')
             ds_ = measure_ds
-            if class_name != 'joint_distribution':
-                ds_ = th.utils.data.Subset(measure_ds, th.where(targets == class_id)[0])
-            elif args.LDA and not args.recompute and os.path.exists(joint_raw_path):
+            if args.LDA and not args.recompute and os.path.exists(joint_raw_path):
                 all_class_stat_trackers += th.load(joint_raw_path, map_location=args.collector_device)
                 continue
 
@@ -1224,10 +2320,15 @@ def measure_v2(model, measure_ds, args: Settings, measure_cache_part1=None):
                                                       include_matcher_fn=args.include_matcher_fn_measure)
             if len(ds_) <= args.batch_size_measure:
                 measure_settings.num_edge_samples = 0
-
-            ## disable per-class covariance compute for speedup measuring and reduce memory usage
-            if args.LDA and class_name != 'joint_distribution':
-                measure_settings.cov_off = True
+            # the LDA joint tracker only provides the shared covariance
+            if args.measure_joint_distribution:
+                measure_settings.replay_samples = args.replay_samples
+
+            if isinstance(ds_, ActivationStore) or args.measure_processes > 1:
+                # all samples as a single class
+                all_class_stat_trackers += _measure_per_class(model, ds_, th.zeros_like(targets), [0],
+                                                              [measure_settings], args, part=1)
+                continue
             # collect basic reduction stats
             class_stats = measure_data_statistics_part1(train_loader, model, epochs=5 if args.augment_measure else 1,
                                                         model_device=args.device,
@@ -1237,7 +2338,12 @@ def measure_v2(model, measure_ds, args: Settings, measure_cache_part1=None):
             all_class_stat_trackers.append(class_stats)
         if measure_cache_part1 is not None:
             assert type(measure_cache_part1) == str
+            # the sampled activations are not part of the cache, replay_samples is honoured per run
+            reservoirs = [tracker.__dict__.pop('reservoir', None) for tracker in all_class_stat_trackers]
             th.save(all_class_stat_trackers, measure_cache_part1)
+            for tracker, reservoir in zip(all_class_stat_trackers, reservoirs):
+                if reservoir is not None:
+                    tracker.reservoir = reservoir
 
     if args.LDA:
         assert len(all_class_stat_trackers) == len(measure_ds.classes) + 1
@@ -1253,13 +2359,30 @@ def measure_v2(model, measure_ds, args: Settings, measure_cache_part1=None):
         sampled_channels_dict = None
 
     logging.info(f'Measure part 2')
+    if not args.measure_joint_distribution:
+        logging.info(f'\tcollecting stats for {len(classes)} classes in a single pass')
+        class_settings = []
+        for class_id in range(len(classes)):
+            measure_settings = BatchStatsCollectorCfg(args.batch_size_measure,
+                                                      reduction_dictionary=args.spatial_reductions,
+                                                      include_matcher_fn=args.include_matcher_fn_measure,
+                                                      sampled_channels=sampled_channels_dict[class_id] if \
+                                                          type(sampled_channels_dict) == list else sampled_channels_dict)
+            measure_settings.LDA_tracker = LDA_tracker
+            if (targets == class_id).sum() <= args.batch_size_measure:
+                measure_settings.num_edge_samples = 0
+            class_settings.append(measure_settings)
+        if all(getattr(tracker, 'reservoir', None) is not None for tracker in all_class_stat_trackers):
+            return [replay_data_statistics_part2(tracker, batch_size=args.batch_size_measure, model_device=args.device,
+                                                 collector_device=args.collector_device, measure_settings=cfg)
+                    for tracker, cfg in zip(all_class_stat_trackers, class_settings)]
+        return _measure_per_class(model, measure_ds, targets, list(range(len(classes))), class_settings, args,
+                                  part=2, trackers=all_class_stat_trackers)
+
     all_class_ref_stats = []
     for class_id, class_name in enumerate(classes):
         logging.info(f'\t{class_id}/{len(classes)}\tcollecting stats for class {class_name}')
-        if not args.measure_joint_distribution:
-            ds_ = th.utils.data.Subset(measure_ds, th.where(targets == class_id)[0])
-        else:
-            ds_ = measure_ds
+        ds_ = measure_ds
 
         sampler = None  # th.utils.data.RandomSampler(ds_,replacement=True,num_samples=epochs*args.batch_size)
         train_loader = th.utils.data.DataLoader(
@@ -1277,6 +2400,18 @@ def measure_v2(model, measure_ds, args: Settings, measure_cache_part1=None):
             measure_settings.num_edge_samples = 0
 
         # collect basic reduction stats
+        if getattr(all_class_stat_trackers[class_id], 'reservoir', None) is not None:
+            all_class_ref_stats.append(replay_data_statistics_part2(all_class_stat_trackers[class_id],
+                                                                    batch_size=args.batch_size_measure,
+                                                                    model_device=args.device,
+                                                                    collector_device=args.collector_device,
+                                                                    measure_settings=measure_settings))
+            continue
+        if isinstance(ds_, ActivationStore) or args.measure_processes > 1:
+            # all samples as a single class
+            all_class_ref_stats += _measure_per_class(model, ds_, th.zeros_like(targets), [0], [measure_settings],
+                                                      args, part=2, trackers=[all_class_stat_trackers[class_id]])
+            continue
         class_stats = measure_data_statistics_part2(all_class_stat_trackers[class_id], train_loader, model,
                                                     epochs=5 if args.augment_measure else 1,
                                                     model_device=args.device,
@@ -1420,7 +2555,7 @@ def measure_data_statistics(loader, model, epochs=5, model_device='cuda', collec
         model.eval()
         with th.no_grad():
             for _ in tqdm.trange(epochs):
-                for d, l in loader:
+                for d, l in DevicePrefetcher(loader, model_device, inputs_only=True):
                     _ = model(d.to(model_device))
 
     model.to(model_device)
@@ -1596,7 +2731,7 @@ def evaluate_data(loader, model, detector, model_device, alpha_list=None, in_dis
     model.to(model_device)
     batch_count = 0
     with th.no_grad():
-        for d, l in tqdm.tqdm(loader, total=len(loader)):
+        for d, l in tqdm.tqdm(DevicePrefetcher(loader, model_device, inputs_only=True), total=len(loader)):
             if limit and batch_count * d.shape[0] >= limit:
                 break
             batch_count += 1
@@ -1811,20 +2946,239 @@ def report_from_file(path, skip_pattern=r'(^simes)|(^fusion)|(.*export*)', inclu
     df(result_collection).to_csv(f'{output}.csv')
 
 
-def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, cache_measure=True,
-                     keep_intermidiate_pvalues=False):
-    from datetime import datetime
-    TIME_START = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    rejection_results = {}  # dataset , out
-    model = getattr(models, args.model)(**(args.model_cfg))
-    checkpoint = th.load(args.ckt_path, map_location='cpu')
-    if 'state_dict' in checkpoint:
-        checkpoint = checkpoint['state_dict']
-
-    model.load_state_dict(checkpoint)
-    expected_transform_measure = get_transform(args.transform_dataset or args.dataset, augment=args.augment_measure)
-    expected_transform_test = get_transform(args.transform_dataset or args.dataset, augment=args.augment_test)
-
+## reference statistics storage
+# measured reference stats are stored as a versioned directory instead of a pickle of the collector objects:
+# <path>/index.json lists the layers, every layer has a json spec (<layer id>.json) and flat per dtype arrays
+# (<layer id>-<dtype>.npy) holding the records, means, inverse covariances and quantiles of all classes.
+# channel reduction functions are stored as op lists and rebuilt on load, layers are read (memory mapped) on first use.
+REF_STATS_VERSION = 1
+_REF_STATS_SUFFIX = '.refstats'
+_REF_STATS_FNS = {'simes': calc_simes, 'cond_fisher': calc_cond_fisher, 'mean_fisher': calc_mean_fisher}
+
+
+class _RefStatsArrayWriter():
+    # appends tensors to flat per dtype buffers, tensors shared between entries (e.g. LDA inverse covariance) are
+    # stored once
+    def __init__(self):
+        self.chunks = {}
+        self.sizes = {}
+        self.written = {}
+
+    def __call__(self, t):
+        if id(t) in self.written:
+            return self.written[id(t)][1]
+        a = t.detach().cpu().contiguous().numpy()
+        dtype = a.dtype.name
+        offset = self.sizes.get(dtype, 0)
+        self.chunks.setdefault(dtype, []).append(a.reshape(-1))
+        self.sizes[dtype] = offset + a.size
+        # keep the tensor alive so its id is not reused
+        self.written[id(t)] = (t, {'dtype': dtype, 'offset': offset, 'shape': list(a.shape)})
+        return self.written[id(t)][1]
+
+    def save(self, prefix):
+        for dtype, chunks in self.chunks.items():
+            np.save(f'{prefix}-{dtype}.npy', np.concatenate(chunks))
+        return list(self.chunks.keys())
+
+
+def _ref_stats_op_spec(fn, write):
+    if isinstance(fn, ChannelSelect):
+        return {'op': 'select', 'ids': write(th.as_tensor(fn._ids))}
+    if isinstance(fn, MahalanobisDistance):
+        return {'op': 'mahalanobis', 'mean': write(fn.mean), 'inv_cov': write(fn.inv_cov),
+                'whitening': write(fn.whitening)}
+    if isinstance(fn, PvalueMatcher) and not isinstance(fn, StackedPvalueMatcher):
+        return {'op': 'pval', 'percentiles': write(fn.percentiles), 'quantiles': write(fn.quantiles),
+                'two_side': fn.two_side, 'right_side': fn.right_side}
+    for name, f in _REF_STATS_FNS.items():
+        if fn is f:
+            return {'op': name}
+    raise TypeError(f'reference stats can not store channel reduction op {fn}')
+
+
+def _flatten_composition(fn):
+    if isinstance(fn, FunctionComposition):
+        return _flatten_composition(fn.f1) + _flatten_composition(fn.f2)
+    return [fn]
+
+
+def _ref_stats_entry_spec(ret: BatchStatsCollectorRet, write):
+    # ops are shared between channel reductions (simes and cond fisher use the same spatial pval matcher), the
+    # channel reductions refer to them by index so the rebuilt objects are shared the same way
+    ops, op_ids = [], {}
+
+    def _op_index(fn):
+        if id(fn) not in op_ids:
+            op_ids[id(fn)] = len(ops)
+            ops.append(_ref_stats_op_spec(fn, write))
+        return op_ids[id(fn)]
+
+    prefix = []
+    if isinstance(ret.reduction_fn, FunctionComposition):
+        # old measurements selected channels inside the spatial reduction, move the selection to the channel fns
+        prefix = _flatten_composition(ret.reduction_fn.f2)
+    channel_reductions = {}
+    for name, rec in ret.channel_reduction_record.items():
+        spec = {'record': write(rec['record']), 'right_side_pval': rec['right_side_pval'],
+                'fn': [_op_index(f) for f in prefix + _flatten_composition(rec['fn'])]}
+        if 'pval_matcher' in rec:
+            spec['pval_matcher'] = _op_index(rec['pval_matcher'])
+        channel_reductions[name] = spec
+    return {'reduction_name': ret.reduction_name, 'num_observations': ret.num_observations, 'ops': ops,
+            'channel_reductions': channel_reductions}
+
+
+def save_ref_stats(all_class_ref_stats, path):
+    """write per class reference stats ([{layer: {reduction_name: [BatchStatsCollectorRet per input]}}]) to a
+    ref stats directory, the spatial reduction functions are stored by name. meters are not stored.
+    """
+    layers = list(all_class_ref_stats[0].keys())
+    assert all(list(class_stats.keys()) == layers for class_stats in all_class_ref_stats), \
+        'all classes must hold the same layers'
+    os.makedirs(path, exist_ok=True)
+    layer_files = []
+    for layer_id, layer_name in enumerate(layers):
+        write = _RefStatsArrayWriter()
+        classes = [{reduction_name: [_ref_stats_entry_spec(ret, write) for ret in per_input]
+                    for reduction_name, per_input in class_stats[layer_name].items()}
+                   for class_stats in all_class_ref_stats]
+        prefix = os.path.join(path, f'{layer_id:04d}')
+        dtypes = write.save(prefix)
+        with open(f'{prefix}.json', 'w') as f:
+            json.dump({'layer': layer_name, 'dtypes': dtypes, 'classes': classes}, f)
+        layer_files.append([layer_name, f'{layer_id:04d}'])
+    index = {'version': REF_STATS_VERSION, 'num_classes': len(all_class_ref_stats), 'layers': layer_files}
+    # the index is written last, a directory without it is incomplete
+    with open(os.path.join(path, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(path, 'index.json.tmp'), os.path.join(path, 'index.json'))
+
+
+class _RefStatsReader():
+    # builds the per class stats of a layer on first use, shared by the class views of load_ref_stats
+    def __init__(self, path, reduction_dictionary, device='cpu'):
+        self.path = path
+        self.reduction_dictionary = reduction_dictionary
+        self.device = device
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        if index['version'] > REF_STATS_VERSION:
+            raise ValueError(f'{path} has ref stats version {index["version"]}, '
+                             f'this code reads up to version {REF_STATS_VERSION}')
+        self.num_classes = index['num_classes']
+        self.files = dict(index['layers'])
+        self.layers = [layer_name for layer_name, _ in index['layers']]
+        self._layers = {}
+
+    def _build_layer(self, layer_name):
+        prefix = os.path.join(self.path, self.files[layer_name])
+        with open(f'{prefix}.json') as f:
+            spec = json.load(f)
+        buffers = {dtype: np.load(f'{prefix}-{dtype}.npy', mmap_mode='r') for dtype in spec['dtypes']}
+        tensors = {}
+
+        def _tensor(a):
+            key = (a['dtype'], a['offset'])
+            if key not in tensors:
+                size = int(np.prod(a['shape']))
+                tensors[key] = th.from_numpy(np.array(buffers[a['dtype']][a['offset']:a['offset'] + size])
+                                             .reshape(a['shape'])).to(self.device)
+            return tensors[key]
+
+        def _op(op):
+            if op['op'] == 'select':
+                return ChannelSelect(_tensor(op['ids']))
+            if op['op'] == 'mahalanobis':
+                fn = MahalanobisDistance.__new__(MahalanobisDistance)
+                fn.mean, fn.inv_cov, fn.whitening = _tensor(op['mean']), _tensor(op['inv_cov']), \
+                    _tensor(op['whitening'])
+                return fn
+            if op['op'] == 'pval':
+                # quantiles are stored as the sorted [C, P] rows
+                fn = PvalueMatcher.__new__(PvalueMatcher)
+                fn.percentiles, fn.quantiles = _tensor(op['percentiles']), _tensor(op['quantiles'])
+                fn.num_percentiles = fn.percentiles.shape[0]
+                fn.two_side, fn.right_side = op['two_side'], op['right_side']
+                return fn
+            return _REF_STATS_FNS[op['op']]
+
+        def _entry(entry):
+            ret = BatchStatsCollectorRet(entry['reduction_name'], self.reduction_dictionary[entry['reduction_name']],
+                                         num_observations=entry['num_observations'])
+            ops = [_op(op) for op in entry['ops']]
+            for name, rec in entry['channel_reductions'].items():
+                fn = ops[rec['fn'][0]]
+                for op_id in rec['fn'][1:]:
+                    fn = FunctionComposition(fn, ops[op_id])
+                ret.channel_reduction_record[name] = {'record': _tensor(rec['record']),
+                                                      'right_side_pval': rec['right_side_pval'], 'fn': fn}
+                if 'pval_matcher' in rec:
+                    ret.channel_reduction_record[name]['pval_matcher'] = ops[rec['pval_matcher']]
+            return ret
+
+        return [{reduction_name: [_entry(e) for e in per_input] for reduction_name, per_input in class_spec.items()}
+                for class_spec in spec['classes']]
+
+    def layer(self, layer_name, class_id):
+        if layer_name not in self._layers:
+            self._layers[layer_name] = self._build_layer(layer_name)
+        return self._layers[layer_name][class_id]
+
+
+class RefStatsView(MutableMapping):
+    """{layer: {reduction_name: [BatchStatsCollectorRet per input]}} of a single class, layers are loaded on first
+    access. deleting a layer (e.g. OODDetector dropping untested layers) means it is never read.
+    """
+    def __init__(self, reader: _RefStatsReader, class_id):
+        self._reader = reader
+        self._class_id = class_id
+        self._layers = list(reader.layers)
+        self._loaded = {}
+
+    def __getitem__(self, layer_name):
+        if layer_name not in self._loaded:
+            if layer_name not in self._layers:
+                raise KeyError(layer_name)
+            self._loaded[layer_name] = self._reader.layer(layer_name, self._class_id)
+        return self._loaded[layer_name]
+
+    def __setitem__(self, layer_name, value):
+        if layer_name not in self._layers:
+            self._layers.append(layer_name)
+        self._loaded[layer_name] = value
+
+    def __delitem__(self, layer_name):
+        self._layers.remove(layer_name)
+        self._loaded.pop(layer_name, None)
+
+    def __iter__(self):
+        return iter(list(self._layers))
+
+    def __len__(self):
+        return len(self._layers)
+
+
+def _legacy_ref_stats_path(path):
+    return os.path.splitext(path)[0] + '.pth'
+
+
+def ref_stats_exist(path):
+    return os.path.isfile(os.path.join(path, 'index.json')) or os.path.isfile(_legacy_ref_stats_path(path))
+
+
+def load_ref_stats(path, reduction_dictionary=_DEFAULT_SPATIAL_REDDUCTIONS, device='cpu'):
+    # per class views of a ref stats directory, a pickled stats file from before the format is converted first
+    if not os.path.isfile(os.path.join(path, 'index.json')):
+        legacy_path = _legacy_ref_stats_path(path)
+        logging.info(f'converting {legacy_path} to {path}')
+        save_ref_stats(th.load(legacy_path, map_location='cpu', weights_only=False), path)
+    reader = _RefStatsReader(path, reduction_dictionary, device)
+    return [RefStatsView(reader, class_id) for class_id in range(reader.num_classes)]
+
+
+def get_stats_cache_paths(args: Settings):
+    # returns the experiment tag, the raw per class stats cache and the calibrated reference stats path
     exp_tag = f'{args.model}-{args.dataset}'
     if args.augment_measure:
         exp_tag += f'-augment'
@@ -1834,6 +3188,9 @@ def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, c
         exp_tag += f'-LDA'
     if _MONITOR_OP_OUTPUTS:
         exp_tag += '-OUTMODE'
+    if args.activation_store:
+        # measured from the fp16 store rows instead of a model forward
+        exp_tag += '-store'
     if 'layer_select' in args.tag:
         sub_tags = args.tag.split('+')
         if len(sub_tags) == 1:
@@ -1852,25 +3209,86 @@ def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, c
 
     calib_tag = f'{exp_tag}-{calib_tag}'
     part1_cache = f'measured_stats_per_class-{exp_tag}-raw.pth'
-    calibrated_path = f'measured_stats_per_class-{calib_tag}.pth'
+    calibrated_path = f'measured_stats_per_class-{calib_tag}{_REF_STATS_SUFFIX}'
     exp_tag += f'-{args.tag}'
-    if args.select_layer_mode and not args.recompute:
-        import time
-        while (not os.path.exists(calibrated_path)):
-            print(f'waiting for file: {calibrated_path}')
-            time.sleep(500)
-
-    if not args.recompute and os.path.exists(calibrated_path):
-        ref_stats = th.load(calibrated_path,
-                            map_location=args.collector_device)
+    return exp_tag, part1_cache, calibrated_path
+
+
+def _config_tag(obj):
+    # description of a matcher or transform without object addresses, stable between runs
+    if isinstance(obj, partial):
+        return f'{_config_tag(obj.func)}{obj.args}{sorted(obj.keywords.items())}'
+    if hasattr(obj, '__qualname__'):
+        return f'{obj.__module__}.{obj.__qualname__}'
+    if hasattr(obj, '__dict__') and type(obj).__repr__ is object.__repr__:
+        return f'{type(obj).__name__}{json.dumps(vars(obj), default=_config_tag, sort_keys=True)}'
+    return re.sub(r' at 0x[0-9a-fA-F]+', '', repr(obj))
+
+
+def get_activation_store(args: Settings, model, dataset, split, transform, augment=False, **dataset_kwargs):
+    # one store per model checkpoint, stored layers, dataset split and transform, shared by all detector
+    # configurations using these layers
+    model_tag = hashlib.sha1(f'{args.ckt_path}{args.model_cfg}{_config_tag(args.include_matcher_fn_measure)}'
+                             f'{args.transform_dataset}{_config_tag(transform)}'.encode()).hexdigest()[:8]
+    limit_tag = f'-limit{dataset_kwargs["limit"]}' if dataset_kwargs.get('limit') else ''
+    path = os.path.join(args.activation_store, f'{args.model}-{model_tag}-{dataset.replace("/", "_")}-{split}'
+                                               f'{"-augment" if augment else ""}{limit_tag}')
+    if ActivationStore.exists(path):
+        store = ActivationStore(path)
+        if set(args.spatial_reductions.keys()) <= store.reductions:
+            return store
+        logging.info(f'activation store {path} is missing reductions, rebuilding')
+    ds = get_dataset(dataset, split, transform, **dataset_kwargs)
+    loader = th.utils.data.DataLoader(ds, batch_size=args.batch_size_test, shuffle=False,
+                                      num_workers=_NUM_LOADER_WORKERS, pin_memory=False, drop_last=False)
+    return ActivationStore.build(path, model, loader, args.spatial_reductions, args.include_matcher_fn_measure,
+                                 args.device)
+
+
+def _eval_loader(args: Settings, ds, model, detector):
+    # the loader and model evaluate_data runs, stores are replayed instead of running the model
+    loader = th.utils.data.DataLoader(ds, batch_size=args.batch_size_test, shuffle=False,
+                                      num_workers=0 if isinstance(ds, ActivationStore) else _NUM_LOADER_WORKERS,
+                                      pin_memory=False, drop_last=False)
+    if isinstance(ds, ActivationStore):
+        model = ActivationStoreReplay(ds, detector)
+    return loader, model
+
+
+def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, cache_measure=True,
+                     keep_intermidiate_pvalues=False):
+    from datetime import datetime
+    TIME_START = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    rejection_results = {}  # dataset , out
+    model = getattr(models, args.model)(**(args.model_cfg))
+    checkpoint = th.load(args.ckt_path, map_location='cpu')
+    if 'state_dict' in checkpoint:
+        checkpoint = checkpoint['state_dict']
+
+    model.load_state_dict(checkpoint)
+    expected_transform_measure = get_transform(args.transform_dataset or args.dataset, augment=args.augment_measure)
+    expected_transform_test = get_transform(args.transform_dataset or args.dataset, augment=args.augment_test)
+
+    exp_tag, part1_cache, calibrated_path = get_stats_cache_paths(args)
+    if args.select_layer_mode and not args.recompute and not ref_stats_exist(calibrated_path):
+        # layer selection reuses the stats measured by another experiment, schedule it first (see sweep_jobs)
+        raise FileNotFoundError(f'missing reference stats {calibrated_path}, run the measure job first')
+
+    if not args.recompute and ref_stats_exist(calibrated_path):
+        ref_stats = load_ref_stats(calibrated_path, args.spatial_reductions,
+                                   device=args.collector_device)
     else:
-        ds = get_dataset(args.dataset, 'train', expected_transform_measure, limit=args.limit_measure,
-                         per_class_limit=True)
+        if args.activation_store:
+            ds = get_activation_store(args, model, args.dataset, 'train', expected_transform_measure,
+                                      augment=args.augment_measure, limit=args.limit_measure, per_class_limit=True)
+        else:
+            ds = get_dataset(args.dataset, 'train', expected_transform_measure, limit=args.limit_measure,
+                             per_class_limit=True)
         # ref_stats = measure(model, ds, args)
         ref_stats = measure_v2(model, ds, args, part1_cache)
         if cache_measure:
             logging.info('saving reference stats dict')
-            th.save(ref_stats, calibrated_path)
+            save_ref_stats(ref_stats, calibrated_path)
         if measure_only:
             return
     if args.select_layer_mode:
@@ -1894,23 +3312,25 @@ def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, c
 
         logging.info(f'selected {len(selected_layers_names)}/{len(ref_stats[0])} layers: {selected_layers_names}')
 
+    test_dataset_kwargs = dict(limit=args.limit_test, per_class_limit=False, shuffle_before_limit=True,
+                               limit_shuffle_seed=0)
+    if args.activation_store:
+        val_ds = get_activation_store(args, model, args.dataset, 'val', expected_transform_test,
+                                      augment=args.augment_test, **test_dataset_kwargs)
+    else:
+        val_ds = get_dataset(args.dataset, 'val', expected_transform_test, **test_dataset_kwargs)
     logging.info(f'building OOD detector')
     detector = OODDetector(model, ref_stats, right_sided_fisher_pvalue=args.right_sided_fisher_pvalue,
-                           include_matcher_fn=args.include_matcher_fn_test, shared_reductions=args.spatial_reductions)
+                           include_matcher_fn=args.include_matcher_fn_test, shared_reductions=args.spatial_reductions,
+                           store=val_ds if args.activation_store else None)
     gc.collect()
     logging.info(f'evaluating inliers')
-    val_ds = get_dataset(args.dataset, 'val', expected_transform_test, limit=args.limit_test, per_class_limit=False,
-                         shuffle_before_limit=True, limit_shuffle_seed=0)
     # todo add adversarial samples test
     # optional run in-dist data evaluate per class to simplify analysis
     # for class_id,class_name in enumerate(val_ds.classes):
     #    sampler = th.utils.data.SubsetRandomSampler(th.where(targets==class_id)[0]) #th.utils.data.RandomSampler(ds, replacement=True,num_samples=5000)
-    sampler = None
-    val_loader = th.utils.data.DataLoader(
-        val_ds, sampler=sampler,
-        batch_size=args.batch_size_test, shuffle=False,
-        num_workers=_NUM_LOADER_WORKERS, pin_memory=False, drop_last=False)
-    e_ret = evaluate_data(val_loader, model, detector, args.device, alpha_list=args.alphas, in_dist=True,
+    val_loader, eval_model = _eval_loader(args, val_ds, model, detector)
+    e_ret = evaluate_data(val_loader, eval_model, detector, args.device, alpha_list=args.alphas, in_dist=True,
                           save_pvalues=export_pvalues, limit=args.limit_test,
                           keep_intermidiate_pvalues=keep_intermidiate_pvalues)
     if export_pvalues:
@@ -1920,15 +3340,15 @@ def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, c
     logging.info(f'evaluating outliers')
 
     for ood_dataset in args.ood_datasets:
-        ood_ds = get_dataset(ood_dataset, 'val', expected_transform_test, limit=args.limit_test,
-                             per_class_limit=False, shuffle_before_limit=True, limit_shuffle_seed=0)
+        if args.activation_store:
+            ood_ds = get_activation_store(args, model, ood_dataset, 'val', expected_transform_test,
+                                          augment=args.augment_test, **test_dataset_kwargs)
+        else:
+            ood_ds = get_dataset(ood_dataset, 'val', expected_transform_test, **test_dataset_kwargs)
 
-        ood_loader = th.utils.data.DataLoader(
-            ood_ds, sampler=None,
-            batch_size=args.batch_size_test, shuffle=False,
-            num_workers=_NUM_LOADER_WORKERS, pin_memory=False, drop_last=False)
+        ood_loader, eval_model = _eval_loader(args, ood_ds, model, detector)
         logging.info(f'evaluating {ood_dataset}')
-        e_ret = evaluate_data(ood_loader, model, detector, args.device, alpha_list=args.alphas,
+        e_ret = evaluate_data(ood_loader, eval_model, detector, args.device, alpha_list=args.alphas,
                               save_pvalues=export_pvalues, limit=args.limit_test,
                               keep_intermidiate_pvalues=keep_intermidiate_pvalues)
         if export_pvalues:
@@ -1944,6 +3364,39 @@ def measure_and_eval(args: Settings, export_pvalues=False, measure_only=False, c
     result_summary(rejection_results, args.get_args_dict())
 
 
+def run_experiment(args: Settings, **measure_kwargs):
+    # sweep job entry, large label spaces keep the percentile tensors on their own device
+    global _USE_PERCENTILE_DEVICE
+    _USE_PERCENTILE_DEVICE = args.num_classes > 300
+    logging.info(args)
+    return measure_and_eval(args, **measure_kwargs)
+
+
+def sweep_jobs(experiments: List[Settings], cores=1, mem=0, retries=0, **measure_kwargs):
+    # one measure job per reference stats file, every evaluation depends on the job producing its stats
+    from copy import copy
+    from sweep import Job
+    jobs = {}
+    for i, exp in enumerate(experiments):
+        exp_tag, _, calibrated_path = get_stats_cache_paths(exp)
+        measure_name = f'measure-{os.path.splitext(calibrated_path)[0]}'
+        if measure_name not in jobs and (exp.recompute or not ref_stats_exist(calibrated_path)):
+            measure_exp = copy(exp)
+            measure_exp.select_layer_mode = False
+            jobs[measure_name] = Job(measure_name, {'measure': calibrated_path, 'settings': measure_exp.get_args_dict()},
+                                     fn=run_experiment, fn_kwargs=dict(args=measure_exp, measure_only=True,
+                                                                       cache_measure=True),
+                                     cores=cores, mem=mem, retries=retries)
+        eval_exp = copy(exp)
+        eval_exp.recompute = False
+        deps = [measure_name] if measure_name in jobs else []
+        eval_name = f'eval{i}-{exp_tag}'
+        jobs[eval_name] = Job(eval_name, {'eval': exp_tag, 'settings': exp.get_args_dict(), **measure_kwargs},
+                              fn=run_experiment, fn_kwargs=dict(args=eval_exp, **measure_kwargs),
+                              cores=cores, mem=mem, deps=deps, retries=retries)
+    return list(jobs.values())
+
+
 ### 'maxclust' is used to choose number of clusters, 'distance' to choose according to threshold
 def findCluster(h0_data, spatial_reduction_name, name_data_set, t=0.8, criterion='distance', plot_layer=False,
                 plot_summary=False, channle_reduction_method='simes_c'):
@@ -2124,6 +3577,11 @@ if __name__ == '__main__':
                           cache_measure=False,
                           keep_intermidiate_pvalues=False)
 
+    # experiments run as sweep jobs, measure jobs cache the reference stats their evaluations depend on.
+    # one core (the default) runs the jobs one at a time (all experiments share the device), SWEEP_CORES runs them
+    # concurrently. finished jobs are recorded in SWEEP_RESULTS and skipped when the sweep is relaunched
+    sweep_cores = int(os.environ.get('SWEEP_CORES', 1))
+    sweep_results = os.environ.get('SWEEP_RESULTS', 'sweep_results')
     limit_test = None  # 1000 if measure_kwargs['export_pvalues'] else None
     cut = 0.5  # 0.05
     seed = 0 + device_id
@@ -2404,13 +3862,13 @@ if __name__ == '__main__':
                    densenet_svhn, oe_cifar10, oe_cifar100, oe_svhn, r18_places, r18_lsun, r18_domainnet]
     experiments = [experiments[exp_id] for exp_id in exp_ids]
     setup_logging()
-    for args in experiments:
-        logging.info(args)
-        if args.num_classes > 300:
-            _USE_PERCENTILE_DEVICE = True
-        else:
-            _USE_PERCENTILE_DEVICE = False
-        measure_and_eval(args, **measure_kwargs)
+    from sweep import Scheduler, ResultsStore
+    scheduler = Scheduler(sweep_cores, store=ResultsStore(sweep_results))
+    for job in sweep_jobs(experiments, **measure_kwargs):
+        scheduler.add(job)
+    done, failed = scheduler.run()
+    if failed:
+        logging.error(f'failed jobs: {sorted(failed)}')
     # report_from_file('./Final_results_baseine_2020-10-08/*/*', skip_pattern=None, include_pattern=r'.*')
     report_from_file(f'*experiment_results-*{tag_}*',
                      skip_pattern=r'(^simes)|(^fusion)',
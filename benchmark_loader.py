@@ -0,0 +1,99 @@
+import argparse
+import logging
+import time
+
+import torch
+import torchvision
+
+from data import get_dataset, DevicePrefetcher
+from preprocess import get_transform
+
+# measures the time the training step waits on data (loader + host to device copy),
+# with the synchronous .to(device) at the top of the step and with DevicePrefetcher.
+
+parser = argparse.ArgumentParser(description='data stall benchmark')
+parser.add_argument('--dataset', default='fake', type=str,
+                    help='dataset name passed to get_dataset, "fake" uses torchvision FakeData')
+parser.add_argument('--datasets-dir', default=None, type=str,
+                    help='datasets root passed to get_dataset')
+parser.add_argument('--input-size', default=224, type=int,
+                    help='image size')
+parser.add_argument('--model', default='resnet', type=str,
+                    help='model architecture run in the step, "none" measures the loader alone')
+parser.add_argument('--model-config', default='', type=str,
+                    help='additional architecture configuration')
+parser.add_argument('--model-dataset', default=None, type=str,
+                    help='dataset the model is configured for (default: --dataset, imagenet for "fake")')
+parser.add_argument('-b', '--batch-size', default=64, type=int,
+                    help='mini-batch size')
+parser.add_argument('-j', '--workers', default=4, type=int,
+                    help='number of data loading workers')
+parser.add_argument('--steps', default=50, type=int,
+                    help='number of measured steps')
+parser.add_argument('--depth', default=2, type=int,
+                    help='batches prepared ahead by the prefetcher')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str,
+                    help='device used for the step')
+parser.add_argument('--dtype', default='float', type=str,
+                    help='input dtype')
+
+
+def run(loader, model, device, dtype, steps, prefetch=False, depth=2):
+    if prefetch:
+        loader = DevicePrefetcher(loader, device, dtype, depth=depth)
+    stall, total = 0., time.time()
+    end = time.time()
+    for i, (inputs, target) in enumerate(loader):
+        inputs = inputs.to(device, dtype=dtype)
+        target = target.to(device)
+        if device.type == 'cuda':
+            # the copy must land before the step can use it
+            torch.cuda.current_stream(device).synchronize()
+        stall += time.time() - end
+        if model is not None:
+            with torch.no_grad():
+                model(inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        end = time.time()
+        if i + 1 == steps:
+            break
+    return stall, time.time() - total, i + 1
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    transform = get_transform('imagenet' if args.dataset == 'fake' else args.dataset,
+                              input_size=args.input_size, augment=True)
+    if args.dataset == 'fake':
+        num_samples = args.batch_size * (args.steps + 1)
+        dataset = torchvision.datasets.FakeData(num_samples, (3, args.input_size, args.input_size), transform=transform)
+    else:
+        dataset_kwargs = {'datasets_path': args.datasets_dir} if args.datasets_dir else {}
+        dataset = get_dataset(args.dataset, 'train', transform, **dataset_kwargs)
+
+    model = None
+    if args.model != 'none':
+        import models
+        model_dataset = args.model_dataset or ('imagenet' if args.dataset == 'fake' else args.dataset)
+        model_config = {'input_size': args.input_size, 'dataset': model_dataset}
+        if args.model_config != '':
+            model_config = dict(model_config, **eval(args.model_config))
+        model = models.__dict__[args.model](**model_config).to(device, dtype).eval()
+
+    for prefetch in (False, True):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                             num_workers=args.workers, pin_memory=False, drop_last=True)
+        # first pass warms up workers, cudnn and the allocator
+        run(loader, model, device, dtype, 2, prefetch, args.depth)
+        stall, total, steps = run(loader, model, device, dtype, args.steps, prefetch, args.depth)
+        logging.info(f'{"prefetch" if prefetch else "sync"}:\tsteps {steps}\t'
+                     f'data stall {stall:.3f}s ({1e3 * stall / steps:.1f}ms/step, {100 * stall / total:.1f}%)\t'
+                     f'total {total:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import argparse
+import io
+import json
+import logging
+import os
+import tarfile
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from data import get_dataset, get_targets
+
+# converts a dataset to the pre-decoded '-mmap' format read by data.MemmapImageDataset:
+#   <output>/<split>_images.npy   uint8 (N,H,W,C)
+#   <output>/<split>_labels.npy   int64 (N,)
+#   <output>/classes.json
+# or to the '-shards' format streamed by data.ShardedImageDataset:
+#   <output>/<split>-%05d.tar     '<stream index>.<ext>' image bytes followed by '<stream index>.cls'
+#   <output>/<split>_index.json   shard names, sample counts and class names
+#   <output>/<split>_labels.npy   int64 (N,) in stream order
+# the dataset is then available to get_dataset as '<output dir name>' (must end with '-mmap' or '-shards')
+
+parser = argparse.ArgumentParser(description='convert a dataset to a memory mapped uint8 array')
+parser.add_argument('--dataset', required=True, type=str,
+                    help='any dataset name supported by get_dataset, e.g. cifar10-raw')
+parser.add_argument('--splits', nargs='+', default=['train', 'val'],
+                    help='splits to convert')
+parser.add_argument('--size', default=None, type=int,
+                    help='resize (shorter side) and center crop images to size x size, required for folders with'
+                         ' mixed image sizes')
+parser.add_argument('--output', default=None, type=str,
+                    help='output directory, the suffix selects the format (default: Datasets/<dataset>-mmap)')
+parser.add_argument('--shard-mb', default=256, type=int,
+                    help='approximate size of a tar shard in MB (-shards only)')
+parser.add_argument('--image-format', default='png', type=str, choices=['png', 'jpeg'],
+                    help='encoding of decoded images (-shards only), image files are copied as is unless --size is set')
+parser.add_argument('--shuffle-seed', default=0, type=int,
+                    help='train samples are written in a random order so shard streams mix classes (-shards only)')
+parser.add_argument('--datasets-path', default='Datasets', type=str,
+                    help='datasets root directory')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    help='conversion batch size')
+parser.add_argument('-j', '--workers', default=8, type=int,
+                    help='number of decoding workers')
+
+
+def to_uint8_hwc(img):
+    return torch.from_numpy(np.asarray(img.convert('RGB'), dtype=np.uint8).copy())
+
+
+def convert_split(dataset, path, batch_size=256, workers=8):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+    images, labels = None, np.zeros(len(dataset), dtype=np.int64)
+    offset = 0
+    for x, y in loader:
+        if images is None:
+            images = np.lib.format.open_memmap(path + '_images.npy.tmp', mode='w+', dtype=np.uint8,
+                                               shape=(len(dataset),) + tuple(x.shape[1:]))
+        images[offset:offset + x.size(0)] = x.numpy()
+        labels[offset:offset + x.size(0)] = np.asarray(y)
+        offset += x.size(0)
+        logging.info(f'{path}: {offset}/{len(dataset)}')
+    images.flush()
+    del images
+    os.replace(path + '_images.npy.tmp', path + '_images.npy')
+    np.save(path + '_labels.npy', labels)
+
+
+class EncodeImage(object):
+    def __init__(self, image_format='png'):
+        self.image_format = image_format
+
+    def __call__(self, img):
+        buffer = io.BytesIO()
+        img.convert('RGB').save(buffer, format=self.image_format, **({'quality': 95} if self.image_format == 'jpeg' else {}))
+        return buffer.getvalue()
+
+
+def _list_collate(batch):
+    return batch
+
+
+def _sample_paths(dataset):
+    # image file of every sample when the dataset is (a subset of) an image folder, else None
+    ids = np.arange(len(dataset))
+    while isinstance(dataset, torch.utils.data.Subset):
+        ids = np.asarray(dataset.indices)[ids]
+        dataset = dataset.dataset
+    if hasattr(dataset, 'get_path'):
+        return [dataset.get_path(i) for i in ids]
+    if hasattr(dataset, 'samples'):
+        return [dataset.samples[i][0] for i in ids]
+    return None
+
+
+def _encoded_samples(dataset, order, paths, image_format, workers=8):
+    # yields (ext, image bytes) in the given order
+    if paths is not None:
+        for i in order:
+            with open(paths[i], 'rb') as f:
+                yield os.path.splitext(paths[i])[1].lstrip('.').lower(), f.read()
+        return
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, order), batch_size=64, shuffle=False,
+                                         num_workers=workers, collate_fn=_list_collate)
+    ext = 'jpg' if image_format == 'jpeg' else image_format
+    for batch in loader:
+        for data, _ in batch:
+            yield ext, data
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def convert_split_shards(dataset, root, split, shard_bytes, paths=None, image_format='png', shuffle_seed=None,
+                         workers=8):
+    labels = get_targets(dataset)
+    order = np.arange(len(dataset))
+    if shuffle_seed is not None:
+        order = np.random.RandomState(shuffle_seed).permutation(len(dataset))
+    shards = []
+    tar, size = None, 0
+    for index, (ext, data) in enumerate(_encoded_samples(dataset, order, paths, image_format, workers)):
+        if tar is None or size >= shard_bytes:
+            if tar is not None:
+                tar.close()
+                os.replace(shard_path + '.tmp', shard_path)
+                logging.info(f'{shard_path}: {shards[-1]["count"]} samples, {index}/{len(dataset)}')
+            shards.append({'name': f'{split}-{len(shards):05d}.tar', 'count': 0})
+            shard_path = os.path.join(root, shards[-1]['name'])
+            tar, size = tarfile.open(shard_path + '.tmp', 'w'), 0
+        _add_member(tar, f'{index:09d}.{ext}', data)
+        _add_member(tar, f'{index:09d}.cls', str(int(labels[order[index]])).encode())
+        shards[-1]['count'] += 1
+        size += len(data)
+    if tar is not None:
+        tar.close()
+        os.replace(shard_path + '.tmp', shard_path)
+    np.save(os.path.join(root, f'{split}_labels.npy'), labels[order].astype(np.int64))
+    return shards
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    args = parser.parse_args()
+    output = args.output or os.path.join(args.datasets_path, args.dataset + '-mmap')
+    shards = output.rstrip('/').endswith('-shards')
+    assert shards or output.rstrip('/').endswith('-mmap'), 'output directory name must end with -mmap or -shards'
+    os.makedirs(output, exist_ok=True)
+    t_list = [EncodeImage(args.image_format) if shards else to_uint8_hwc]
+    if args.size:
+        t_list = [transforms.Resize(args.size), transforms.CenterCrop(args.size)] + t_list
+    transform = transforms.Compose(t_list)
+    classes = None
+    for split in args.splits:
+        ds = get_dataset(args.dataset, split, transform, datasets_path=args.datasets_path)
+        classes = classes or list(getattr(ds, 'classes', []))
+        if shards:
+            # original files are copied without decoding when no resize is requested
+            paths = None if args.size else _sample_paths(ds)
+            shard_list = convert_split_shards(ds, output, split, args.shard_mb << 20, paths, args.image_format,
+                                              args.shuffle_seed if split == 'train' else None, args.workers)
+            with open(os.path.join(output, f'{split}_index.json'), 'w') as f:
+                json.dump({'shards': shard_list, 'classes': list(getattr(ds, 'classes', []))}, f, indent=1)
+        else:
+            convert_split(ds, os.path.join(output, split), args.batch_size, args.workers)
+    if not shards:
+        with open(os.path.join(output, 'classes.json'), 'w') as f:
+            json.dump(classes, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,20 @@
+import copy
+import functools
+import hashlib
+import io
+import json
 import os
+import queue
+import random
+import tarfile
+import threading
+import time
 import warnings
 
+import numpy as np
 import torch
 import torchvision.datasets as datasets
+from PIL import Image
 
 from utils.dataset import RandomDatasetGenerator
 from utils.misc import _META
@@ -20,6 +32,7 @@ class _DS_META(_META):
         return {'mean': self.mean, 'std': self.std}
 
 __DATASETS_DEFAULT_PATH = 'Datasets'
+_FOLDER_INDEX_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'quantized.pytorch', 'folder_index')
 _CIFAR10=_DS_META(nclasses=10,shape=(3,32,32),mean=[.491, .482, .446],std=[.247, .243, .261])
 _CIFAR100=_DS_META(nclasses=100,shape=(3,32,32),mean=[.491, .482, .446],std=[.247, .243, .261])
 _STL10=_DS_META(nclasses=10,shape=(3,32,32),mean=[.491, .482, .446],std=[.247, .243, .261])
@@ -44,30 +57,40 @@ _IMAGINE_CONFIGS=[
     'dd-exp_kl','dd-ce_kl','dd-exp_mse',
     'dd-exp', 'dd-ce']
 
-def get_dataset(name, split='train', transform=None,
-                target_transform=None, download=True, datasets_path=__DATASETS_DEFAULT_PATH,
-                limit=None,shuffle_before_limit=False,limit_shuffle_seed=None,class_ids=None,
-                per_class_limit=True):
-    train = (split == 'train')
+class DatasetSpec(object):
+    """A parsed dataset name. base specs name a dataset kind and directory (plus an optional class filter),
+    'concat' and 'redirect' specs resolve to their children, called with the caller's limit and
+    shuffle_before_limit and with child_kwargs overriding the remaining get_dataset arguments.
+    """
+    def __init__(self, kind, name, dir_name=None, class_ids=None, children=(), child_kwargs=None):
+        self.kind = kind
+        self.name = name
+        self.dir_name = dir_name
+        self.class_ids = class_ids
+        self.children = children
+        self.child_kwargs = child_kwargs or {}
+
+    def __repr__(self):
+        if self.children:
+            return f'{self.kind}({", ".join(repr(c) for c in self.children)})'
+        return f'{self.kind}:{self.dir_name or self.name}' + (' [class filter]' if self.class_ids is not None else '')
+
+
+@functools.lru_cache(maxsize=None)
+def parse_dataset_name(name, train=True):
     if '+' in name:
-        ds=None
-        for ds_name in name.split('+'):
-            ds_=get_dataset(ds_name, split, transform, target_transform,download, limit=limit,
-                            shuffle_before_limit=shuffle_before_limit,datasets_path=__DATASETS_DEFAULT_PATH)
-            if ds is None:
-                ds=ds_
-            else:
-                ds += ds_
-        return ds
+        return DatasetSpec('concat', name, children=tuple(parse_dataset_name(n, train) for n in name.split('+')))
+    if name.endswith('-mmap') or name.endswith('-shards'):
+        # pre-decoded / sharded formats written by convert_dataset.py
+        return DatasetSpec(name.rsplit('-', 1)[1], name, dir_name=name)
+    class_ids = None
     if name.endswith('-raw'):
-        ds_dir_name = name[:-4]
+        return DatasetSpec('split_folder', name, dir_name=name[:-4])
     elif name.startswith('folder-'):
-        ds_dir_name = name[7:]
+        return DatasetSpec('folder', name, dir_name=name[7:])
     elif name == 'places365_standard-lsun':
-        ds_dir_name = 'places365_standard'
-        name = ds_dir_name
-        class_ids = filter(lambda x: x not in [52, 66, 91, 92, 102, 121, 203, 215, 284, 334], range(365))
-
+        class_ids = tuple(x for x in range(365) if x not in [52, 66, 91, 92, 102, 121, 203, 215, 284, 334])
+        return DatasetSpec('split_folder', 'places365_standard', dir_name='places365_standard', class_ids=class_ids)
     elif name.startswith('DomainNet-'):
         parts = name.split('-')
         domain = parts[1]
@@ -77,146 +100,168 @@ def get_dataset(name, split='train', transform=None,
             ds_dir_name = os.path.join('DomainNet', 'train' if train else 'test', domain)
         name = name.replace('-measure', '')
         if name.endswith('-A') or name.endswith('-B'):
-            set = parts[2]
-            class_ids = range(173) if set == 'A' else range(173, 345)
-
-
-
+            class_ids = tuple(range(173) if parts[2] == 'A' else range(173, 345))
+        return DatasetSpec('folder', name, dir_name=ds_dir_name, class_ids=class_ids)
     elif name.endswith('-dogs') or name.endswith('-cats'):
         if name.startswith('imagenet-'):
-            if name.endswith('dogs'):
-                _ids = _imagenet_dogs.keys()
-            else:
-                _ids = _imagenet_cats.keys()
+            _ids = _imagenet_dogs.keys() if name.endswith('dogs') else _imagenet_cats.keys()
         else:
             _ids = [1] if name.endswith('dogs') else [0]
-
-        return get_dataset(name[:-5], split, transform, target_transform, download, limit=limit,
-                       shuffle_before_limit=True, datasets_path=__DATASETS_DEFAULT_PATH,
-                       class_ids=_ids,per_class_limit=False,limit_shuffle_seed=0)
+        return DatasetSpec('redirect', name, children=(parse_dataset_name(name[:-5], train),),
+                           child_kwargs=dict(shuffle_before_limit=True, class_ids=tuple(_ids), per_class_limit=False,
+                                             limit_shuffle_seed=0))
     elif name.startswith('imagine-'):
-        if train:
-            ds_dir_name=None
-            for i_cfg in _IMAGINE_CONFIGS:
-                idx=name.find(i_cfg)
-                if idx >0:
-                    ds_dir_name=os.path.join(name[:idx-1],i_cfg,name[idx+len(i_cfg)+1:])
-                    #print(ds_dir_name)
-                    break
-            assert ds_dir_name is not None
-        else:
-            return get_dataset(name.split('-')[1], split, transform, target_transform,download, limit=limit,
-                               shuffle_before_limit=shuffle_before_limit,
-                               datasets_path=__DATASETS_DEFAULT_PATH)
-    else:
-        ds_dir_name = name
-
-    root = os.path.join(datasets_path, ds_dir_name)
-    if name == 'cifar10':
-        return datasets.CIFAR10(root=root,
-                                train=train,
-                                transform=transform,
-                                target_transform=target_transform,
-                                download=download)
-    elif name == 'cifar100':
-        return datasets.CIFAR100(root=root,
-                                 train=train,
-                                 transform=transform,
-                                 target_transform=target_transform,
-                                 download=download)
-    elif name == 'mnist' or name == 'mnist_3c':
-        return datasets.MNIST(root=root,
-                              train=train,
-                              transform=transform,
-                              target_transform=target_transform,
-                              download=download)
-    elif name == 'SVHN':
-        return datasets.SVHN(root=root,
-                              split= 'test' if not train else split,
-                              transform=transform,
-                              target_transform=target_transform,
-                              download=download)
+        if not train:
+            return DatasetSpec('redirect', name, children=(parse_dataset_name(name.split('-')[1], train),))
+        ds_dir_name = None
+        for i_cfg in _IMAGINE_CONFIGS:
+            idx = name.find(i_cfg)
+            if idx > 0:
+                ds_dir_name = os.path.join(name[:idx - 1], i_cfg, name[idx + len(i_cfg) + 1:])
+                break
+        assert ds_dir_name is not None
+        return DatasetSpec('split_folder', name, dir_name=ds_dir_name)
+    elif name.startswith('random-'):
+        if name.endswith('-normal') or train:
+            return DatasetSpec('random', name)
+        # validation of random-<dataset> uses the real dataset
+        return DatasetSpec('random', name, children=(parse_dataset_name(name[7:], train),))
+    elif name in ['cifar10', 'cifar100', 'mnist', 'mnist_3c', 'SVHN', 'LSUN']:
+        return DatasetSpec(name, name, dir_name=name)
     elif 'stl10' in name:
-        if train and name.endswith('train_test'):
-            return datasets.STL10(root=root,
-                                  split='train',
-                                  transform=transform,
-                                  target_transform=target_transform,
-                                  download=download) + datasets.STL10(root=root,
-                                                                      split='test',
-                                                                      transform=transform,
-                                                                      target_transform=target_transform,
-                                                                      download=download)
-        return datasets.STL10(root=root,
-                              split=split,
-                              transform=transform,
-                              target_transform=target_transform,
-                              download=download)
-    elif name == 'LSUN':
-        return datasets.LSUN(root=root,
-                             classes=split,
-                             transform=transform,
-                             target_transform=target_transform)
+        return DatasetSpec('stl10', name, dir_name=name)
     elif name.startswith('folder'):
-        ds = datasets.ImageFolder(root=root,
-                                  transform=transform,
-                                  target_transform=target_transform)
-        if limit or class_ids:
-            ds = limit_ds(ds, limit, per_class=per_class_limit, shuffle=shuffle_before_limit, seed=limit_shuffle_seed,
-                          allowed_classes=class_ids)
-        return ds
-    elif name in ['imagenet', 'cats_vs_dogs', 'places365_standard'] or any(i in name for i in ['imagine-', '-raw']):
-        if train:
-            root = os.path.join(root, 'train')
-        else:
-            root = os.path.join(root, 'val')
-        ds = datasets.ImageFolder(root=root,
-                                  transform=transform,
-                                  target_transform=target_transform)
-        if limit or class_ids:
-            if 'no_dd' in name:
-                ds = limit_ds(ds, limit * len(ds.classes), per_class=False, shuffle=shuffle_before_limit,
-                                             seed=limit_shuffle_seed)
-            else:
-                ds=limit_ds(ds, limit,per_class=per_class_limit,shuffle=shuffle_before_limit,seed=limit_shuffle_seed,allowed_classes=class_ids)
-        return ds
-    elif name.startswith('DomainNet-'):
-        ds = datasets.ImageFolder(root=root,
-                                    transform=transform,
-                                    target_transform=target_transform)
-        if limit or class_ids:
-            return limit_ds(ds, limit=limit, per_class=per_class_limit, shuffle=shuffle_before_limit, seed=limit_shuffle_seed, allowed_classes=class_ids)
+        return DatasetSpec('folder', name, dir_name=name)
+    elif name in ['imagenet', 'cats_vs_dogs', 'places365_standard']:
+        return DatasetSpec('split_folder', name, dir_name=name)
+    elif hasattr(datasets, name):
+        return DatasetSpec('torchvision', name, dir_name=name)
+    return DatasetSpec('unknown', name)
+
+
+# base datasets built without transforms, shared by all views within the process
+_BASE_DATASETS = {}
+
+
+def clear_dataset_cache():
+    _BASE_DATASETS.clear()
+
+
+def _build_base_dataset(kind, name, root, train, split, download):
+    if kind == 'mmap':
+        return MemmapImageDataset(root, 'train' if train else 'val')
+    if kind == 'shards':
+        return ShardedImageDataset(root, 'train' if train else 'val', shuffle=train)
+    if kind in ['cifar10', 'cifar100']:
+        return getattr(datasets, kind.upper())(root=root, train=train, download=download)
+    if kind in ['mnist', 'mnist_3c']:
+        return datasets.MNIST(root=root, train=train, download=download)
+    if kind == 'SVHN':
+        return datasets.SVHN(root=root, split='test' if not train else split, download=download)
+    if kind == 'stl10':
+        if train and name.endswith('train_test'):
+            return datasets.STL10(root=root, split='train', download=download) + \
+                   datasets.STL10(root=root, split='test', download=download)
+        return datasets.STL10(root=root, split=split, download=download)
+    if kind == 'LSUN':
+        return datasets.LSUN(root=root, classes=split)
+    if kind == 'folder':
+        return IndexedImageFolder(root=root)
+    if kind == 'split_folder':
+        return IndexedImageFolder(root=os.path.join(root, 'train' if train else 'val'))
+    if kind == 'torchvision':
+        return getattr(datasets, name)(root=root, split=train, download=download)
+    raise ValueError(f'unknown dataset kind {kind}')
+
+
+def _dataset_view(base, transform, target_transform):
+    # shallow copy sharing the sample lists / memory maps of the base, only the transforms differ
+    if isinstance(base, torch.utils.data.ConcatDataset):
+        view = copy.copy(base)
+        view.datasets = [_dataset_view(d, transform, target_transform) for d in base.datasets]
+        return view
+    view = object.__new__(type(base))
+    view.__dict__.update(base.__dict__)
+    view.transform = transform
+    view.target_transform = target_transform
+    if isinstance(base, datasets.VisionDataset):
+        has_transform = transform is not None or target_transform is not None
+        view.transforms = datasets.vision.StandardTransform(transform, target_transform) if has_transform else None
+    return view
+
+
+def get_base_dataset(spec, train=True, split='train', download=True, datasets_path=__DATASETS_DEFAULT_PATH):
+    root = os.path.join(datasets_path, spec.dir_name)
+    key = (spec.kind, spec.name, os.path.abspath(root), train, split)
+    if key not in _BASE_DATASETS:
+        _BASE_DATASETS[key] = _build_base_dataset(spec.kind, spec.name, root, train, split, download)
+    return _BASE_DATASETS[key]
+
+
+def get_dataset(name, split='train', transform=None,
+                target_transform=None, download=True, datasets_path=__DATASETS_DEFAULT_PATH,
+                limit=None,shuffle_before_limit=False,limit_shuffle_seed=None,class_ids=None,
+                per_class_limit=True):
+    train = (split == 'train')
+    spec = parse_dataset_name(name, train)
+    if spec.kind in ['concat', 'redirect']:
+        ds = None
+        for child in spec.children:
+            kwargs = dict(limit=limit, shuffle_before_limit=shuffle_before_limit, class_ids=None,
+                          per_class_limit=True, limit_shuffle_seed=None)
+            kwargs.update(spec.child_kwargs)
+            ds_ = _get_dataset_from_spec(child, split, transform, target_transform, download,
+                                         __DATASETS_DEFAULT_PATH, **kwargs)
+            ds = ds_ if ds is None else ds + ds_
         return ds
+    return _get_dataset_from_spec(spec, split, transform, target_transform, download, datasets_path, limit,
+                                  shuffle_before_limit, limit_shuffle_seed, class_ids, per_class_limit)
 
-    elif name.startswith('random-'):
-        if name.endswith('-normal'):
+
+def _get_dataset_from_spec(spec, split, transform, target_transform, download, datasets_path, limit=None,
+                           shuffle_before_limit=False, limit_shuffle_seed=None, class_ids=None, per_class_limit=True):
+    train = (split == 'train')
+    if spec.kind in ['concat', 'redirect']:
+        # nested specs resolve through get_dataset to keep the argument reset of the redirect
+        return get_dataset(spec.name, split, transform, target_transform, download, datasets_path, limit,
+                           shuffle_before_limit, limit_shuffle_seed, class_ids, per_class_limit)
+    if spec.kind == 'unknown':
+        return None
+    if spec.class_ids is not None:
+        class_ids = spec.class_ids
+    if spec.kind == 'random':
+        if spec.name.endswith('-normal'):
             mean, std = [0., 0., 0.], [1., 1., 1.]
             return RandomDatasetGenerator([3, 512, 512], mean, std, limit=limit or 5000, transform=transform,
                                           train=train)
-
-        ds_name = name[7:]
+        ds_name = spec.name[7:]
         if ds_name in _DATASET_META_DATA:
             meta = _DATASET_META_DATA[ds_name]
             nclasses, data_shape, mean, std = meta.get_attrs().values()
         else:
             raise NotImplementedError
-
         limit = limit or 1000
         if per_class_limit:
             limit = limit * nclasses
-
         if train:
             return RandomDatasetGenerator(data_shape,mean,std,limit=limit,transform=transform,train=train)
-        else:
-            return get_dataset(name[7:],split, transform, target_transform,download, limit=limit,
-                               shuffle_before_limit=shuffle_before_limit, datasets_path=__DATASETS_DEFAULT_PATH)
+        return _get_dataset_from_spec(spec.children[0], split, transform, target_transform, download,
+                                      __DATASETS_DEFAULT_PATH, limit=limit, shuffle_before_limit=shuffle_before_limit)
 
-    elif hasattr(datasets,name):
-        return getattr(datasets,name)(root=root,
-                                split=train,
-                                transform=transform,
-                                target_transform=target_transform,
-                                download=download)
+    ds = _dataset_view(get_base_dataset(spec, train, split, download, datasets_path), transform, target_transform)
+    if spec.kind in ['cifar10', 'cifar100', 'mnist', 'mnist_3c', 'SVHN', 'stl10', 'LSUN', 'torchvision']:
+        # limits are not applied to the torchvision datasets
+        return ds
+    if not (limit or class_ids):
+        return ds
+    if spec.kind == 'shards':
+        return ds.limit(limit, per_class=per_class_limit, shuffle=shuffle_before_limit, seed=limit_shuffle_seed,
+                        allowed_classes=class_ids)
+    if spec.kind == 'split_folder' and 'no_dd' in spec.name:
+        return limit_ds(ds, limit * len(ds.classes), per_class=False, shuffle=shuffle_before_limit,
+                        seed=limit_shuffle_seed)
+    return limit_ds(ds, limit, per_class=per_class_limit, shuffle=shuffle_before_limit, seed=limit_shuffle_seed,
+                    allowed_classes=class_ids)
 
 
 # def balance_image_folder_ds(dataset, n_samples=None,per_class=True,shuffle=False,seed=None,class_ids=None):
@@ -259,42 +304,353 @@ def get_dataset(name, split='train', transform=None,
 #     dataset.samples = samps
 #     return dataset
 
-def limit_ds(dataset, limit=None, per_class=True, shuffle=False, seed=0, allowed_classes=None):
-    if not hasattr(dataset,'targets'):
-        if hasattr(dataset,'labels'):
-            dataset.targets=dataset.labels
-        else:
-            assert 0, 'dataset not supported'
-
-    id_reg_per_class = {}
-    global_sample_count = 0
-    # map id to class label
-    for e, t in enumerate(dataset.targets):
-        if allowed_classes and t not in allowed_classes:
-            continue
-        global_sample_count += 1
-        if t in id_reg_per_class:
-            id_reg_per_class[t] += [e]
+class IndexedImageFolder(datasets.VisionDataset):
+    """ImageFolder replacement that reads the sample list from an on-disk index instead of scanning the tree.
+    the index (relative paths blob + offsets, int32 labels, class names) is keyed by the root path and the
+    mtimes of the root and class directories, and is memory mapped on load. changes nested below the class
+    directories do not invalidate the index, delete the cache entry (or pass rebuild=True) in that case.
+    """
+    def __init__(self, root, transform=None, target_transform=None, loader=datasets.folder.default_loader,
+                 extensions=datasets.folder.IMG_EXTENSIONS, cache_dir=_FOLDER_INDEX_CACHE, rebuild=False):
+        super(IndexedImageFolder, self).__init__(root, transform=transform, target_transform=target_transform)
+        self.loader = loader
+        self.extensions = extensions
+        self.cache_dir = cache_dir
+        self._index_prefix = self._get_index_prefix()
+        if rebuild or not os.path.isfile(self._index_prefix + '.classes.json'):
+            self._build_index()
+        self._load_index()
+
+    def _get_index_prefix(self):
+        root = os.path.abspath(self.root)
+        key = [root, os.stat(root).st_mtime_ns]
+        with os.scandir(root) as it:
+            key += sorted((e.name, e.stat().st_mtime_ns) for e in it if e.is_dir())
+        key = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:20]
+        return os.path.join(self.cache_dir, f'{os.path.basename(root)}-{key}')
+
+    def _build_index(self):
+        classes, class_to_idx = datasets.folder.find_classes(self.root)
+        samples = datasets.folder.make_dataset(self.root, class_to_idx, self.extensions)
+        paths = [os.path.relpath(p, self.root).encode() for p, _ in samples]
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in paths], out=offsets[1:])
+        blob = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # the class file is written last and marks a complete index
+        for suffix, array in [('.paths.npy', blob), ('.offsets.npy', offsets),
+                              ('.labels.npy', np.array([t for _, t in samples], dtype=np.int32))]:
+            with open(self._index_prefix + suffix + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(self._index_prefix + suffix + '.tmp', self._index_prefix + suffix)
+        with open(self._index_prefix + '.classes.json.tmp', 'w') as f:
+            json.dump(classes, f)
+        os.replace(self._index_prefix + '.classes.json.tmp', self._index_prefix + '.classes.json')
+
+    def _load_index(self):
+        with open(self._index_prefix + '.classes.json') as f:
+            self.classes = json.load(f)
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self._paths = np.load(self._index_prefix + '.paths.npy', mmap_mode='r')
+        self._offsets = np.load(self._index_prefix + '.offsets.npy', mmap_mode='r')
+        self.targets = np.load(self._index_prefix + '.labels.npy', mmap_mode='r')
+        self._samples = None
+
+    def __getstate__(self):
+        # workers re-map the index files instead of receiving pickled copies
+        state = self.__dict__.copy()
+        for k in ['_paths', '_offsets', 'targets', '_targets_array', '_samples']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_index()
+
+    def get_path(self, index):
+        rel_path = bytes(self._paths[self._offsets[index]:self._offsets[index + 1]]).decode()
+        return os.path.join(self.root, rel_path)
+
+    @property
+    def samples(self):
+        # decoded once on first access, the index itself stays memory mapped
+        if self._samples is None:
+            self._samples = [(self.get_path(i), int(t)) for i, t in enumerate(self.targets)]
+        return self._samples
+
+    imgs = samples
+
+    def __getitem__(self, index):
+        sample = self.loader(self.get_path(index))
+        target = int(self.targets[index])
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class MemmapImageDataset(torch.utils.data.Dataset):
+    """Decoded images stored as one uint8 (N,H,W,C) memory mapped array with an int64 label array,
+    see convert_dataset.py for the layout. samples are fetched in batches (__getitems__) and transform is applied
+    once per uint8 (N,C,H,W) batch, e.g. get_transform(name, batched=True).
+    """
+    def __init__(self, root, split='train', transform=None, target_transform=None):
+        self.root = root
+        self.split = split
+        self.transform = transform
+        self.target_transform = target_transform
+        self._load()
+
+    def _load(self):
+        self.data = np.load(os.path.join(self.root, f'{self.split}_images.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(self.root, f'{self.split}_labels.npy'), mmap_mode='r')
+        with open(os.path.join(self.root, 'classes.json')) as f:
+            self.classes = json.load(f)
+
+    def __getstate__(self):
+        # workers re-map the arrays instead of receiving pickled copies
+        state = self.__dict__.copy()
+        for k in ['data', 'targets', '_targets_array']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def __repr__(self):
+        return f'MemmapImageDataset(root={self.root}, split={self.split}, samples={len(self)}, shape={self.data.shape[1:]})'
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitems__(self, indices):
+        ids = np.asarray(indices)
+        batch = torch.from_numpy(np.ascontiguousarray(self.data[ids])).permute(0, 3, 1, 2)
+        if self.transform is not None:
+            batch = self.transform(batch)
+        targets = [int(t) for t in self.targets[ids]]
+        if self.target_transform is not None:
+            targets = [self.target_transform(t) for t in targets]
+        return list(zip(batch, targets))
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+
+def stream_loader(fileobj):
+    return Image.open(fileobj).convert('RGB')
+
+
+class ShardedImageDataset(torch.utils.data.IterableDataset):
+    """Encoded images packed into sequentially read tar shards, see convert_dataset.py for the layout:
+        <root>/<split>-%05d.tar     members '<stream index>.<ext>' followed by '<stream index>.cls'
+        <root>/<split>_index.json   shard names and sample counts, class names
+        <root>/<split>_labels.npy   labels in stream order
+    the epoch stream is split into contiguous ranges between distributed replicas and loader workers, a worker
+    only opens the shards overlapping its range. when shuffling, ranges are equal so replicas run the same
+    number of steps.
+    shuffling permutes the shard order per epoch and mixes samples through a buffer of `shuffle_buffer` samples.
+    also exposes the sampler interface used by the training loop (set_epoch, num_samples, state_dict).
+    """
+    def __init__(self, root, split='train', transform=None, target_transform=None, loader=stream_loader,
+                 shuffle=False, shuffle_buffer=1000, seed=0, num_replicas=1, rank=0):
+        self.root = root
+        self.split = split
+        self.transform = transform
+        self.target_transform = target_transform
+        self.loader = loader
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # mid epoch resume is not supported for streams, see skip
+        self.start = 0
+        with open(os.path.join(root, f'{split}_index.json')) as f:
+            index = json.load(f)
+        self.shards = [os.path.join(root, s['name']) for s in index['shards']]
+        self.shard_counts = np.array([s['count'] for s in index['shards']], dtype=np.int64)
+        self.shard_offsets = np.concatenate([[0], np.cumsum(self.shard_counts)])
+        self.classes = index['classes']
+        self.targets = np.load(os.path.join(root, f'{split}_labels.npy'), mmap_mode='r')
+        # stream indices kept by limit(), None keeps everything
+        self.keep = None
+
+    def __repr__(self):
+        return f'ShardedImageDataset(root={self.root}, split={self.split}, shards={len(self.shards)}, samples={len(self)})'
+
+    def limit(self, limit=None, per_class=True, shuffle=False, seed=0, allowed_classes=None):
+        # same selection as limit_ds, applied as a filter on the stream
+        subset = limit_ds(self, limit, per_class=per_class, shuffle=shuffle, seed=seed, allowed_classes=allowed_classes)
+        self.keep = np.zeros(len(self.targets), dtype=bool)
+        self.keep[subset.indices.numpy()] = True
+        self.classes = subset.classes
+        return self
+
+    def _shard_kept_counts(self):
+        if self.keep is None:
+            return self.shard_counts
+        return np.add.reduceat(self.keep, self.shard_offsets[:-1]) if len(self.keep) else self.shard_counts * 0
+
+    def _num_workers(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return 1, 0
+        return worker_info.num_workers, worker_info.id
+
+    @property
+    def num_samples(self):
+        # samples yielded by this replica per epoch
+        return int(self._shard_kept_counts().sum()) // self.num_replicas
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, n):
+        if n:
+            warnings.warn(f'{self.__class__.__name__} can not resume mid epoch, restarting epoch {self.epoch}')
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+
+    def _iter_shard(self, shard_id, skip=0, take=None):
+        # sequential read of a single shard, yields (stream index, encoded image) of the kept samples [skip, skip+take)
+        with open(self.shards[shard_id], 'rb', buffering=1 << 23) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+            for member in tar:
+                key, ext = os.path.splitext(member.name)
+                if not member.isfile() or ext == '.cls':
+                    continue
+                index = int(key)
+                if self.keep is not None and not self.keep[index]:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                if take is not None:
+                    if take == 0:
+                        return
+                    take -= 1
+                yield index, tar.extractfile(member).read()
+
+    def _decode(self, index, data):
+        img = self.loader(io.BytesIO(data))
+        target = int(self.targets[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+    def _worker_stream(self):
+        # this worker's contiguous range of the epoch stream (shards in epoch order, kept samples only)
+        num_workers, worker_id = self._num_workers()
+        total_workers = self.num_replicas * num_workers
+        global_worker = self.rank * num_workers + worker_id
+        kept = self._shard_kept_counts()
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.shards))
+        total = int(kept.sum())
+        if self.shuffle:
+            # equal ranges so every replica runs the same number of steps, the remainder is dropped
+            quota = total // total_workers
+            lo, hi = global_worker * quota, (global_worker + 1) * quota
         else:
-            id_reg_per_class[t] = [e]
+            lo, hi = total * global_worker // total_workers, total * (global_worker + 1) // total_workers
+        start = 0
+        for shard_id in order:
+            end = start + int(kept[shard_id])
+            if start < hi and end > lo:
+                skip = max(lo - start, 0)
+                yield from self._iter_shard(shard_id, skip, min(hi, end) - start - skip)
+            start = end
+            if start >= hi:
+                break
+
+    def __iter__(self):
+        num_workers, worker_id = self._num_workers()
+        rng = random.Random(hash((self.seed, self.epoch, self.rank * num_workers + worker_id)))
+        buffer = []
+        for sample in self._worker_stream():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            if buffer:
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+            yield self._decode(*sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(*sample)
+
+
+def get_targets(dataset):
+    # labels as a numpy array, computed once and cached on the dataset object
+    targets = getattr(dataset, '_targets_array', None)
+    if targets is None:
+        if not hasattr(dataset,'targets'):
+            if hasattr(dataset,'labels'):
+                dataset.targets=dataset.labels
+            else:
+                assert 0, 'dataset not supported'
+        targets = np.asarray(dataset.targets, dtype=np.int64)
+        dataset._targets_array = targets
+    return targets
+
+
+def limit_ds(dataset, limit=None, per_class=True, shuffle=False, seed=0, allowed_classes=None):
+    targets = get_targets(dataset)
+    if allowed_classes is not None:
+        allowed_classes = list(allowed_classes)
+
+    sample_ids = np.arange(len(targets))
+    if allowed_classes:
+        sample_ids = sample_ids[np.isin(targets, allowed_classes)]
+    global_sample_count = len(sample_ids)
+    sample_targets = targets[sample_ids]
+    # group sample ids by class, the stable sort keeps the dataset order within each class
+    order = sample_ids[np.argsort(sample_targets, kind='stable')]
+    counts = np.bincount(sample_targets) if global_sample_count else np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    # classes are emitted in order of first appearance
+    classes, first_seen = np.unique(sample_targets, return_index=True)
+    classes = classes[np.argsort(first_seen)]
 
     ids = []
+    perms = {}
     # shuffle and clip each class
-    for t in id_reg_per_class.keys():
-        class_ids = torch.tensor(id_reg_per_class[t])
+    for t in classes:
+        class_ids = torch.from_numpy(order[offsets[t]:offsets[t + 1]])
+        class_size = len(class_ids)
 
         if shuffle:
-            class_ids = class_ids[torch.randperm(len(class_ids), generator=torch.Generator().manual_seed(seed))]
+            # every class uses a generator with the same seed, permutations only depend on the class size
+            if class_size not in perms:
+                perms[class_size] = torch.randperm(class_size, generator=torch.Generator().manual_seed(seed))
+            class_ids = class_ids[perms[class_size]]
 
         if limit is not None:
             lim = limit
             if limit >= 1 and not per_class:
                 # update limit to per class value
-                lim = max(limit // len(id_reg_per_class), 1)
+                lim = max(limit // len(classes), 1)
             elif 0<limit<1:
                 # limit is given as a ratio from each class
-                lim = max(int(limit * len(id_reg_per_class[t])), 1)
-                print(f'clipping {limit}: {lim}/{len(id_reg_per_class[t])} ({len(id_reg_per_class[t])/ global_sample_count:0.4f})')
+                lim = max(int(limit * class_size), 1)
+                print(f'clipping {limit}: {lim}/{class_size} ({class_size/ global_sample_count:0.4f})')
             class_ids = class_ids[:lim]
 
         ids.append(class_ids)
@@ -303,7 +659,7 @@ def limit_ds(dataset, limit=None, per_class=True, shuffle=False, seed=0, allowed
     ids = torch.cat(ids)
 
     ds = torch.utils.data.Subset(dataset,ids)
-    ds.targets = torch.tensor(dataset.targets)[ids]
+    ds.targets = torch.from_numpy(targets[ids.numpy()])
     if allowed_classes:
         ds.classes = [c for i, c in enumerate(dataset.classes) if i in allowed_classes]
     else:
@@ -311,6 +667,303 @@ def limit_ds(dataset, limit=None, per_class=True, shuffle=False, seed=0, allowed
 
     return ds
 
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """Random sampler whose order depends only on (seed, epoch), so training can resume in the middle of an epoch.
+    num_samples is the number of samples each replica draws per epoch, replicas take interleaved slices of the
+    same permutation. skip() drops the first samples of the next iteration only.
+    """
+    def __init__(self, data_source, num_samples=None, replacement=False, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.replacement = replacement
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = num_samples or len(data_source) // num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, num_samples):
+        self.start = num_samples
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        n = len(self.data_source)
+        total = self.num_samples * self.num_replicas
+        if self.replacement:
+            ids = torch.randint(n, (total,), generator=generator)
+        else:
+            ids = torch.cat([torch.randperm(n, generator=generator) for _ in range((total + n - 1) // n)])[:total]
+        ids = ids[self.rank::self.num_replicas]
+        start, self.start = self.start, 0
+        return iter(ids[start:].tolist())
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+
+
+class TensorBank(object):
+    """Small dataset decoded and transformed once into a single in-memory tensor.
+    used for calibration where the same few images per class are resampled many times.
+    """
+    def __init__(self, dataset, dtype=torch.float16, batch_size=256, num_workers=4, pin_memory=None):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                             num_workers=num_workers, drop_last=False)
+        data, targets = [], []
+        for x, y in loader:
+            data.append(x.to(dtype))
+            targets.append(torch.as_tensor(y))
+        self.data = torch.cat(data)
+        self.targets = torch.cat(targets)
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        if pin_memory:
+            self.data = self.data.pin_memory()
+            self.targets = self.targets.pin_memory()
+        self.classes = getattr(dataset, 'classes', None)
+
+    def __len__(self):
+        return self.data.size(0)
+
+    def __repr__(self):
+        return f'TensorBank(samples={len(self)}, shape={tuple(self.data.shape[1:])}, dtype={self.data.dtype})'
+
+    def loader(self, batch_size, num_batches, transform=None, generator=None):
+        return TensorBankLoader(self, batch_size, num_batches, transform=transform, generator=generator)
+
+
+class TensorBankLoader(object):
+    # samples batches with replacement from a TensorBank, indices for all batches are drawn at once
+    def __init__(self, bank, batch_size, num_batches, transform=None, generator=None):
+        self.bank = bank
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.transform = transform
+        self.generator = generator
+        self.sampler = None
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        ids = torch.randint(len(self.bank), (self.num_batches, self.batch_size), generator=self.generator)
+        for batch_ids in ids:
+            inputs = self.bank.data[batch_ids]
+            if self.transform is not None:
+                inputs = self.transform(inputs)
+            yield inputs, self.bank.targets[batch_ids]
+
+
+class RandomBatchLoader(object):
+    """Gaussian noise batches generated directly in the model input shape and dtype, optionally on the device,
+    replaces a DataLoader over RandomDatasetGenerator without worker processes. every batch is seeded from
+    (seed, epoch, rank, batch index) so the stream is reproducible and resumable, the loader also acts as its
+    own sampler (set_epoch, skip, num_samples, state_dict).
+    """
+    def __init__(self, shape, mean, std, num_samples, batch_size, nclasses=1, dtype=torch.float32, device='cpu',
+                 seed=0, transform=None, num_replicas=1, rank=0):
+        self.shape = tuple(shape)
+        self.mean = torch.tensor(mean, dtype=dtype, device=device).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=dtype, device=device).view(1, -1, 1, 1)
+        self.batch_size = batch_size
+        self.nclasses = nclasses
+        self.dtype = dtype
+        self.device = torch.device(device)
+        self.seed = seed
+        self.transform = transform
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = num_samples // num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    @property
+    def sampler(self):
+        return self
+
+    def __repr__(self):
+        return f'RandomBatchLoader(shape={self.shape}, samples={self.num_samples}, batch_size={self.batch_size}, ' \
+               f'device={self.device})'
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, num_samples):
+        self.start = num_samples
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+
+    def __iter__(self):
+        generator = torch.Generator(self.device)
+        base_seed = ((self.seed * 1000003 + self.epoch) * 1009 + self.rank) * 1000003
+        start, self.start = self.start // self.batch_size, 0
+        for i in range(start, len(self)):
+            generator.manual_seed(base_seed + i)
+            inputs = torch.randn((self.batch_size,) + self.shape, generator=generator, dtype=self.dtype,
+                                 device=self.device).mul_(self.std).add_(self.mean)
+            targets = torch.randint(self.nclasses, (self.batch_size,), generator=generator, device=self.device)
+            if self.transform is not None:
+                inputs = self.transform(inputs)
+            yield inputs, targets
+
+
+def get_random_loader(name, batch_size, input_size=None, limit=None, per_class_limit=True, num_samples=None, **kwargs):
+    # same names and sample counts as get_dataset('random-*', 'train')
+    assert name.startswith('random-'), f'{name} is not a random dataset'
+    if name.endswith('-normal'):
+        mean, std, nclasses, shape = [0., 0., 0.], [1., 1., 1.], 1, (3, 224, 224)
+        num_samples = num_samples or limit or 5000
+    else:
+        ds_name = name[7:]
+        if ds_name not in _DATASET_META_DATA:
+            raise NotImplementedError
+        meta = _DATASET_META_DATA[ds_name]
+        mean, std, nclasses, shape = meta.mean, meta.std, meta.nclasses, meta.shape
+        limit = limit or 1000
+        num_samples = num_samples or (limit * nclasses if per_class_limit else limit)
+    if input_size:
+        shape = (shape[0], input_size, input_size)
+    return RandomBatchLoader(shape, mean, std, num_samples, batch_size, nclasses=nclasses, **kwargs)
+
+
+class DevicePrefetcher(object):
+    """Wraps any batch iterable and prepares up to `depth` batches ahead on a background thread:
+    pins host memory, starts non blocking copies (on a side stream for cuda), then applies
+    `transform` and the dtype cast to the inputs. on cpu this is a plain double buffer.
+    tensors that are already on the target device pass through the loop's own .to() calls untouched.
+    """
+    def __init__(self, loader, device, dtype=None, depth=2, transform=None, pin_memory=None, inputs_only=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.depth = depth
+        self.transform = transform
+        self.pin_memory = self.device.type == 'cuda' if pin_memory is None else pin_memory
+        # only move the first element of every batch, e.g. when labels are consumed on the host
+        self.inputs_only = inputs_only
+        # seconds the consumer spent waiting on the producer thread
+        self.stall_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, item):
+        # sampler, batch_size, dataset... of the wrapped loader
+        if item == 'loader':
+            raise AttributeError(item)
+        return getattr(self.loader, item)
+
+    def _to_device(self, x):
+        if isinstance(x, torch.Tensor):
+            if self.pin_memory and x.device.type == 'cpu' and not x.is_pinned():
+                x = x.pin_memory()
+            return x.to(self.device, non_blocking=True)
+        if isinstance(x, (list, tuple)):
+            return type(x)(self._to_device(v) for v in x)
+        return x
+
+    def _prepare(self, batch):
+        if not isinstance(batch, (list, tuple)):
+            batch = [batch]
+            single = True
+        else:
+            single = False
+        batch = list(batch)
+        if self.inputs_only:
+            batch[0] = self._to_device(batch[0])
+        else:
+            batch = self._to_device(batch)
+        inputs = batch[0]
+        if self.transform is not None:
+            inputs = self.transform(inputs)
+        if self.dtype is not None and isinstance(inputs, torch.Tensor) and inputs.is_floating_point():
+            inputs = inputs.to(self.dtype)
+        batch[0] = inputs
+        return batch[0] if single else batch
+
+    @staticmethod
+    def _put(buffer, stop, item):
+        # gives up once the consumer is gone
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _producer(self, buffer, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self._prepare(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self._prepare(batch)
+                if not self._put(buffer, stop, (batch, event, None)):
+                    return
+        except Exception as e:
+            self._put(buffer, stop, (None, None, e))
+            return
+        self._put(buffer, stop, (None, None, StopIteration()))
+
+    @staticmethod
+    def _record_stream(x, stream):
+        if isinstance(x, torch.Tensor):
+            if x.device.type == 'cuda':
+                x.record_stream(stream)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                DevicePrefetcher._record_stream(v, stream)
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._producer, args=(buffer, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                batch, event, error = buffer.get()
+                self.stall_time += time.time() - start
+                if error is not None:
+                    if isinstance(error, StopIteration):
+                        return
+                    raise error
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the batch was allocated on the side stream, keep its memory alive for the consumer stream
+                    self._record_stream(batch, current)
+                yield batch
+        finally:
+            # the consumer may stop early (e.g. a sample limit), release the producer
+            stop.set()
+            thread.join()
+
+
 _imagenet_dogs = {
  151: 'Chihuahua',
  152: 'Japanese spaniel',
@@ -9,7 +9,7 @@ import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 import models
-from data import get_dataset
+from data import get_dataset, DevicePrefetcher
 from preprocess import get_transform
 from utils.log import setup_logging, ResultsLog, save_checkpoint
 from utils.meters import AverageMeter, accuracy
@@ -143,7 +143,7 @@ def main():
     train_data = get_dataset(args.dataset, 'train', transform['train'])
     train_loader = torch.utils.data.DataLoader(
         train_data,
-        batch_size=args.batch_size, shuffle=True,
+        batch_size=args.batch_size, shuffle=not isinstance(train_data, torch.utils.data.IterableDataset),
         num_workers=args.workers, pin_memory=True,drop_last=True)
     val_data = get_dataset(args.dataset, 'val', transform['eval'])
     val_loader = torch.utils.data.DataLoader(
@@ -351,7 +351,7 @@ def forward(data_loader, model, criterion, epoch=0, training=True, optimizer=Non
     top5 = AverageMeter()
 
     end = time.time()
-    for i, (inputs, target) in enumerate(data_loader):
+    for i, (inputs, target) in enumerate(DevicePrefetcher(data_loader, args.device, dtype)):
         # measure data loading time
         data_time.update(time.time() - end)
         target = target.to(args.device)
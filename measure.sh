@@ -1 +0,0 @@
-#!/usr/bin/env bash
\ No newline at end of file
@@ -0,0 +1,151 @@
+import torch as th
+
+# online meters with an associative merge, meters measured on disjoint shards of the data (other processes, or data
+# that arrives later) are combined into the meter a single pass over all the data would produce.
+# the interface follows utils.meters.OnlineMeter/MeterDict as used by adversarial_compare (mean, cov, inv_cov,
+# get_distribution_histogram), the utils meters keep no mergeable state.
+
+
+class MergeableOnlineMeter():
+    """mean and (co)variance of [batch, nchannels] observations, combined per batch with Chan's parallel update.
+    percentiles are the observation weighted average of the per batch quantiles (the batch based estimate) and
+    the `number_edge_samples` lowest and highest observations per channel extend the histogram tails.
+    merge(other) is exact for all statistics as long as the shards are split on batch boundaries.
+    """
+    def __init__(self, batched=True, track_percentiles=False, per_channel=False, target_percentiles=None,
+                 number_edge_samples=0, track_cov=False):
+        assert batched, 'observations are [batch, nchannels] tensors'
+        self.track_percentiles = track_percentiles
+        self.per_channel = per_channel
+        self.target_percentiles = target_percentiles
+        self.number_edge_samples = number_edge_samples
+        self.track_cov = track_cov
+        self.n = 0
+        self._mean = None
+        # sum of squared deviations, [C, C] with track_cov, [C] otherwise
+        self._m2 = None
+        self._cov = None
+        self._quantile_sum = None
+        self._quantile_weight = 0
+        self.edge_low = self.edge_high = None
+
+    def _as_rows(self, x):
+        x = x.detach().double()
+        if x.dim() == 1:
+            x = x.unsqueeze(1)
+        if not self.per_channel:
+            x = x.reshape(-1, 1)
+        return x
+
+    def update(self, x):
+        x = self._as_rows(x)
+        batch = MergeableOnlineMeter(track_percentiles=self.track_percentiles, per_channel=True,
+                                     target_percentiles=self.target_percentiles,
+                                     number_edge_samples=self.number_edge_samples, track_cov=self.track_cov)
+        batch.n = x.shape[0]
+        batch._mean = x.mean(0)
+        centered = x - batch._mean
+        batch._m2 = centered.t() @ centered if self.track_cov else centered.pow(2).sum(0)
+        if self.track_percentiles:
+            percentiles = self.target_percentiles.to(x.device, x.dtype)
+            batch._quantile_sum = th.quantile(x, percentiles, dim=0) * batch.n
+            batch._quantile_weight = batch.n
+        if self.number_edge_samples:
+            k = min(self.number_edge_samples, batch.n)
+            batch.edge_low = x.topk(k, 0, largest=False)[0]
+            batch.edge_high = x.topk(k, 0)[0]
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self._mean, self._m2 = other.n, other._mean.clone(), other._m2.clone()
+            self._quantile_sum, self._quantile_weight = other._quantile_sum, other._quantile_weight
+            self.edge_low, self.edge_high = other.edge_low, other.edge_high
+            self._cov = None
+            return self
+        n = self.n + other.n
+        delta = other._mean.to(self._mean.device) - self._mean
+        correction = th.outer(delta, delta) if self.track_cov else delta.pow(2)
+        self._m2 = self._m2 + other._m2.to(self._m2.device) + correction * (self.n * other.n / n)
+        self._mean = self._mean + delta * (other.n / n)
+        self.n = n
+        self._cov = None
+        if self._quantile_sum is not None:
+            self._quantile_sum = self._quantile_sum + other._quantile_sum.to(self._quantile_sum.device)
+            self._quantile_weight += other._quantile_weight
+        if self.edge_low is not None:
+            k = self.number_edge_samples
+            low = th.cat([self.edge_low, other.edge_low.to(self.edge_low.device)])
+            high = th.cat([self.edge_high, other.edge_high.to(self.edge_high.device)])
+            self.edge_low = low.topk(min(k, low.shape[0]), 0, largest=False)[0]
+            self.edge_high = high.topk(min(k, high.shape[0]), 0)[0]
+        return self
+
+    @property
+    def mean(self):
+        return self._mean.float()
+
+    @property
+    def var(self):
+        m2 = self._m2.diagonal() if self.track_cov else self._m2
+        return (m2 / max(self.n - 1, 1)).float()
+
+    @property
+    def std(self):
+        return self.var.sqrt()
+
+    @property
+    def cov(self):
+        # an assigned covariance (e.g. a second pass estimate) overrides the tracked one until the next update
+        if self._cov is not None:
+            return self._cov
+        assert self.track_cov, 'covariance is not tracked'
+        return (self._m2 / max(self.n - 1, 1)).float()
+
+    @cov.setter
+    def cov(self, cov):
+        self._cov = cov
+
+    def inv_cov(self, sample_channels=None):
+        cov = self.cov
+        if sample_channels is not None:
+            cov = cov[sample_channels][:, sample_channels]
+        return th.linalg.pinv(cov.double(), hermitian=True).float()
+
+    def get_distribution_histogram(self):
+        percentiles = self.target_percentiles.double().cpu()
+        quantiles = (self._quantile_sum / self._quantile_weight).cpu()
+        if self.edge_low is not None:
+            # empirical ranks of the extreme observations beyond the tracked percentiles
+            ranks = th.arange(1, self.edge_low.shape[0] + 1, dtype=th.double) / (self.n + 1)
+            low, high = ranks < percentiles[0], (1 - ranks) > percentiles[-1]
+            percentiles = th.cat([ranks[low], percentiles, (1 - ranks[high]).flip(0)])
+            quantiles = th.cat([self.edge_low.cpu()[low], quantiles, self.edge_high.cpu()[high].flip(0)])
+        return percentiles.float(), quantiles.float()
+
+
+def _default_meter_factory(k, v):
+    return MergeableOnlineMeter(per_channel=True)
+
+
+class MergeableMeterDict(dict):
+    # {name: meter}, meters are created by meter_factory(name, value) on the first update
+    def __init__(self, meter_factory=_default_meter_factory):
+        super().__init__()
+        self.meter_factory = meter_factory
+
+    def update(self, values):
+        for k, v in values.items():
+            if k not in self:
+                self[k] = self.meter_factory(k, v)
+            self[k].update(v)
+
+    def merge(self, other):
+        for k, meter in other.items():
+            if k in self:
+                self[k].merge(meter)
+            else:
+                self[k] = meter
+        return self
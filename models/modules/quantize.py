@@ -44,9 +44,12 @@ class UniformQuantize(InplaceFunction):
 
         num_chunks = input.shape[
             0] if num_chunks is None else num_chunks
+        # reduced precision inputs (autocast) are quantized in fp32 and cast back
+        low_precision = input.dtype in (torch.float16, torch.bfloat16) and not out_half
+        input_fp32 = input.float() if low_precision else input
         if min_value is None or max_value is None:
             B = input.shape[0]
-            y = input.view(max(B // num_chunks,1), -1)
+            y = input_fp32.view(max(B // num_chunks,1), -1)
         if min_value is None:
             min_value = y.min(-1)[0].mean(-1)  # C
             #min_value = float(input.view(input.size(0), -1).min(-1)[0].mean())
@@ -61,9 +64,9 @@ class UniformQuantize(InplaceFunction):
 
         if ctx.inplace:
             ctx.mark_dirty(input)
-            output = input
+            output = input_fp32
         else:
-            output = input.clone()
+            output = input_fp32 if low_precision else input.clone()
 
         qmin = 0.
         qmax = 2.**num_bits - 1.
@@ -100,6 +103,8 @@ class UniformQuantize(InplaceFunction):
             output.add_(-qmin).mul_(scale).add_(min_value)  # dequantize
         if out_half and num_bits <= 16:
             output = output.half()
+        elif low_precision:
+            output = input.copy_(output) if ctx.inplace else output.to(input.dtype)
         return output
 
     @staticmethod
@@ -220,7 +225,8 @@ class QuantMeasure(nn.Module,QuantNode):
 
     def forward(self, input):
         # todo
-        input_ = input.detach()
+        # statistics are accumulated in fp32 also when running under autocast
+        input_ = input.detach().float()
 
         if self.training:
             min_value = input_.view(
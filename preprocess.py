@@ -74,9 +74,59 @@ def inception_color_preproccess(input_size, normalize=__imagenet_stats):
         transforms.Normalize(**normalize)
     ])
 
+def batch_pad_random_crop(input_size, scale_size=None, normalize=__imagenet_stats):
+    if type(input_size) is tuple:
+        input_size = input_size[0]
+    padding = int((scale_size - input_size) / 2)
+    return transforms.Compose([
+        BatchToFloat(),
+        BatchRandomCrop(padding),
+        BatchRandomHorizontalFlip(),
+        BatchNormalize(**normalize),
+    ])
+
+
+def batch_scale_crop(input_size, normalize=__imagenet_stats):
+    return transforms.Compose([
+        BatchToFloat(),
+        BatchCenterCrop(input_size),
+        BatchNormalize(**normalize),
+    ])
+
+
+def batch_inception_preproccess(input_size, normalize=__imagenet_stats, color=False):
+    t_list = [
+        BatchToFloat(),
+        BatchRandomResizedCrop(input_size),
+        BatchRandomHorizontalFlip(),
+    ]
+    if color:
+        t_list += [
+            BatchColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
+            BatchLighting(0.1, __imagenet_pca['eigval'], __imagenet_pca['eigvec']),
+        ]
+    return transforms.Compose(t_list + [BatchNormalize(**normalize)])
+
+
+# per sample augmentations applied to normalized batches, selected by name through get_transform(batched=True)
+_BATCH_AUGMENTATIONS = {
+    'cutout': lambda: BatchCutout(),
+    'normal': lambda: BatchRandomNoise('normal'),
+    'uniform': lambda: BatchRandomNoise('uniform'),
+    'ghost': lambda: BatchImgGhosting(),
+}
+
+
+def get_batch_augmentations(names):
+    return [_BATCH_AUGMENTATIONS[a]() for a in names if a != 'color']
+
+
 from data import _DATASET_META_DATA
 def get_transform(name='imagenet', input_size=None,
-                  scale_size=None, normalize=None, augment=True):
+                  scale_size=None, normalize=None, augment=True, batched=False, batch_augment=()):
+    # batched transforms take uint8 (N,C,H,W) batches, see data.MemmapImageDataset
+    if batched:
+        return get_batch_transform(name, input_size, scale_size, normalize, augment, batch_augment)
     if 'imagenet' in name or name in ['imaginet','randomnet','cats_vs_dogs']:
         normalize = normalize or __imagenet_stats
         scale_size = scale_size or 256
@@ -115,6 +165,58 @@ def get_transform(name='imagenet', input_size=None,
                               scale_size=scale_size, normalize=normalize))
 
 
+def _batch_imagenet_like(name):
+    return 'imagenet' in name or name in ['imaginet', 'randomnet', 'cats_vs_dogs']
+
+
+def _batch_small_images(name):
+    # fixed size datasets, decoded images can be stacked as is
+    return any([i in name for i in ['cifar100', 'cifar10', 'stl10', 'SVHN', 'mnist']])
+
+
+def has_batch_transform(name):
+    return _batch_imagenet_like(name) or _batch_small_images(name)
+
+
+def get_batch_transform(name, input_size=None, scale_size=None, normalize=None, augment=True, batch_augment=()):
+    # batch_augment: names from _BATCH_AUGMENTATIONS appended after normalization,
+    # 'color' adds jitter and lighting before normalization (imagenet only)
+    extra = get_batch_augmentations(batch_augment)
+    if _batch_imagenet_like(name):
+        normalize = normalize or __imagenet_stats
+        input_size = input_size or 224
+        if augment:
+            transform = batch_inception_preproccess(input_size, normalize=normalize, color='color' in batch_augment)
+        else:
+            # stored images are already resized to scale_size, see convert_dataset.py
+            transform = batch_scale_crop(input_size, normalize=normalize)
+    elif _batch_small_images(name):
+        assert 'color' not in batch_augment, 'color augmentation is only defined for imagenet statistics'
+        input_size = input_size or (28 if 'mnist' in name else 32)
+        default_meta = _DATASET_META_DATA['mnist' if 'mnist' in name else 'cifar10']
+        normalize = normalize or _DATASET_META_DATA.get(name, default_meta).get_normalization()
+        if augment:
+            scale_size = scale_size or (32 if 'mnist' in name else 40)
+            transform = batch_pad_random_crop(input_size, scale_size=scale_size, normalize=normalize)
+        else:
+            transform = batch_scale_crop(input_size, normalize=normalize)
+    else:
+        raise NotImplementedError(f'no batched transform for {name}')
+    if extra:
+        transform = transforms.Compose([transform] + extra)
+    return transform
+
+
+def get_decode_transform(name, scale_size=None):
+    # per image decoding to the uint8 (C,H,W) layout taken by get_batch_transform, e.g. for data.TensorBank.
+    # images share a fixed size so they can be stacked, only the fixed size datasets are kept at their resolution
+    if _batch_small_images(name):
+        return transforms.PILToTensor()
+    scale_size = scale_size or 256
+    return transforms.Compose([transforms.Resize(scale_size), transforms.CenterCrop(scale_size),
+                               transforms.PILToTensor()])
+
+
 class Lighting(object):
     """Lighting noise(AlexNet - style PCA - based noise)"""
 
@@ -296,3 +398,193 @@ class Cutout(object):
         mask = mask.expand_as(img)
         img = img * mask
         return img
+
+class BatchRandomHorizontalFlip(object):
+    """flips a random half of an (N,C,H,W) batch"""
+    def __init__(self, p=0.5, generator=None):
+        self.p = p
+        self.generator = generator
+
+    def __call__(self, batch):
+        flip = torch.rand(batch.size(0), generator=self.generator) < self.p
+        if flip.any():
+            batch = batch.clone()
+            batch[flip] = batch[flip].flip(-1)
+        return batch
+
+
+class BatchToFloat(object):
+    """uint8 (N,C,H,W) batch to float in [0,1], the batched counterpart of ToTensor"""
+    def __call__(self, batch):
+        # the first step of every batched transform, decoded images are expected (e.g. '-mmap' datasets)
+        assert batch.dtype == torch.uint8 and batch.dim() == 4, \
+            f'batched transforms take uint8 (N,C,H,W) batches, got {batch.dtype} {tuple(batch.shape)}'
+        return batch.float().div_(255)
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, batch):
+        return (batch - self.mean.to(batch.device)) / self.std.to(batch.device)
+
+
+class BatchCenterCrop(object):
+    def __init__(self, size):
+        self.size = size if type(size) is tuple else (size, size)
+
+    def __call__(self, batch):
+        h, w = batch.shape[-2:]
+        y, x = (h - self.size[0]) // 2, (w - self.size[1]) // 2
+        return batch[..., y:y + self.size[0], x:x + self.size[1]]
+
+
+class BatchCutout(Cutout):
+    """Cutout applied independently to every sample of an (N,C,H,W) batch, one hole slot at a time"""
+    def __call__(self, batch):
+        n, _, h, w = batch.shape
+        device = batch.device
+        n_holes = torch.randint(self.max_num_holes, (n, 1, 1), device=device)
+        rows = torch.arange(h, device=device).view(1, h, 1)
+        cols = torch.arange(w, device=device).view(1, 1, w)
+        mask = torch.ones((n, h, w), dtype=torch.bool, device=device)
+        for k in range(self.max_num_holes - 1):
+            hight = torch.randint(1, int(h * self.ratio), (n, 1, 1), device=device)
+            width = torch.randint(1, int(w * self.ratio), (n, 1, 1), device=device)
+            y = torch.randint(h, (n, 1, 1), device=device)
+            x = torch.randint(w, (n, 1, 1), device=device)
+            hole = (rows >= y - hight // 2) & (rows < y + hight // 2) & \
+                   (cols >= x - width // 2) & (cols < x + width // 2) & (k < n_holes)
+            mask &= ~hole
+        return batch * mask.unsqueeze(1).to(batch.dtype)
+
+
+class BatchRandomCrop(object):
+    """zero pads an (N,C,H,W) batch and takes an independent random crop of the original size from each sample"""
+    def __init__(self, padding=4, generator=None):
+        self.padding = padding
+        self.generator = generator
+
+    def __call__(self, batch):
+        n, c, h, w = batch.shape
+        padded = torch.nn.functional.pad(batch, [self.padding] * 4)
+        oy = torch.randint(2 * self.padding + 1, (n, 1), generator=self.generator)
+        ox = torch.randint(2 * self.padding + 1, (n, 1), generator=self.generator)
+        rows = (oy + torch.arange(h)).to(batch.device)
+        cols = (ox + torch.arange(w)).to(batch.device)
+        ids = torch.arange(n, device=batch.device).view(n, 1, 1)
+        # advanced indexing on dims 0,2,3 puts the channel dim last
+        return padded.permute(0, 2, 3, 1)[ids, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+
+class BatchRandomResizedCrop(object):
+    """RandomResizedCrop with an independent box per sample of an (N,C,H,W) float batch,
+    all crops are resampled to the output size by a single roi_align call"""
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), generator=None):
+        self.size = size if type(size) is tuple else (size, size)
+        self.scale = scale
+        self.ratio = ratio
+        self.generator = generator
+
+    def __call__(self, batch):
+        from torchvision.ops import roi_align
+        n, _, h, w = batch.shape
+        area = h * w * torch.empty(n).uniform_(*self.scale, generator=self.generator)
+        log_ratio = torch.empty(n).uniform_(np.log(self.ratio[0]), np.log(self.ratio[1]), generator=self.generator)
+        aspect = torch.exp(log_ratio)
+        # boxes falling outside the image are clamped instead of resampled as in the per image version
+        cw = torch.sqrt(area * aspect).clamp(1, w)
+        ch = torch.sqrt(area / aspect).clamp(1, h)
+        x1 = torch.rand(n, generator=self.generator) * (w - cw)
+        y1 = torch.rand(n, generator=self.generator) * (h - ch)
+        boxes = torch.stack([torch.arange(n, dtype=torch.float), x1, y1, x1 + cw, y1 + ch], 1)
+        return roi_align(batch, boxes.to(batch), self.size, spatial_scale=1., sampling_ratio=2, aligned=True)
+
+
+def _batch_grayscale(batch):
+    # (N,3,H,W) -> (N,1,H,W) luma, broadcasts against the color channels
+    weights = torch.tensor([0.299, 0.587, 0.114], dtype=batch.dtype, device=batch.device).view(1, 3, 1, 1)
+    return (batch * weights).sum(1, keepdim=True)
+
+
+def _batch_alpha(batch, var):
+    return torch.empty((batch.size(0), 1, 1, 1), dtype=batch.dtype, device=batch.device).uniform_(0, var)
+
+
+class BatchSaturation(Saturation):
+    def __call__(self, batch):
+        return batch.lerp(_batch_grayscale(batch).expand_as(batch), _batch_alpha(batch, self.var))
+
+
+class BatchBrightness(Brightness):
+    def __call__(self, batch):
+        return batch * (1 - _batch_alpha(batch, self.var))
+
+
+class BatchContrast(Contrast):
+    def __call__(self, batch):
+        mean = _batch_grayscale(batch).mean((1, 2, 3), keepdim=True)
+        return batch.lerp(mean.expand_as(batch), _batch_alpha(batch, self.var))
+
+
+class BatchColorJitter(RandomOrder):
+    """ColorJitter with per sample factors, the order of the ops is drawn once per batch"""
+    def __init__(self, brightness=0.4, contrast=0.4, saturation=0.4):
+        self.transforms = []
+        if brightness != 0:
+            self.transforms.append(BatchBrightness(brightness))
+        if contrast != 0:
+            self.transforms.append(BatchContrast(contrast))
+        if saturation != 0:
+            self.transforms.append(BatchSaturation(saturation))
+
+
+class BatchLighting(Lighting):
+    def __call__(self, batch):
+        if self.alphastd == 0:
+            return batch
+        alpha = torch.empty((batch.size(0), 3), dtype=batch.dtype, device=batch.device).normal_(0, self.alphastd)
+        eigval = self.eigval.to(batch)
+        eigvec = self.eigvec.to(batch)
+        # rgb[n, i] = sum_j eigvec[i, j] * alpha[n, j] * eigval[j]
+        rgb = (alpha * eigval) @ eigvec.t()
+        return batch + rgb.view(-1, 3, 1, 1)
+
+
+class BatchRandomNoise(RandomNoise):
+    """RandomNoise with the noise of every sample scaled by that sample's norm"""
+    def __call__(self, batch):
+        if self.type == 'uniform':
+            noise = torch.empty_like(batch).uniform_(-1.7321, 1.7321)
+        else:
+            noise = torch.randn_like(batch)
+        norm_signal = batch.flatten(1).norm(dim=1).view(-1, 1, 1, 1)
+        norm_noise = noise.flatten(1).norm(dim=1).view(-1, 1, 1, 1)
+        return batch * (1 - self.ratio) + noise * (self.ratio * norm_signal / norm_noise)
+
+
+class BatchImgGhosting(ImgGhosting):
+    """ghosts a random subset of the batch with an exponential moving average of the preceding samples.
+    the moving average is carried between batches and computed for the whole batch by one matmul"""
+    def __call__(self, batch):
+        n = batch.size(0)
+        flat = batch.flatten(1)
+        steps = torch.arange(n, device=batch.device)
+        # residual_i = m * residual_{i-1} + (1 - m) * x_{i-1}, unrolled into a lower triangular weight matrix
+        lag = (steps.view(-1, 1) - 1 - steps.view(1, -1)).clamp(min=0).to(flat)
+        weights = (1 - self.ghost_moment) * self.ghost_moment ** lag * (steps.view(-1, 1) > steps.view(1, -1))
+        has_residual = steps > 0
+        if self.residual is not None and self.residual.shape == flat.shape[1:]:
+            residual = weights @ flat + (self.ghost_moment ** steps.to(flat)).view(-1, 1) * self.residual.to(flat)
+            has_residual[0] = True
+        else:
+            # as in the per image version the first sample initializes the moving average
+            weights[1:, 0] = self.ghost_moment ** lag[1:, 0]
+            residual = weights @ flat
+        self.residual = (self.ghost_moment * residual[-1] + (1 - self.ghost_moment) * flat[-1]).detach()
+        # the moving average is never reset, residual_init_rate of the per image version is unused
+        ghost = has_residual & (torch.rand(n, device=batch.device) < self.ratio)
+        gamma = self.fuse_distribution.sample((n,)).to(flat).view(-1, 1) * ghost.view(-1, 1).to(flat)
+        return (flat * (1 - gamma) + gamma * residual).view_as(batch)
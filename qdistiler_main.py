@@ -2,9 +2,12 @@ import argparse
 import os
 #import subprocess
 import time
+import random
 import logging
+import numpy as np
 import torch
 import shutil
+import weakref
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.parallel
@@ -12,14 +15,16 @@ import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 import torch.distributed as dist
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from torch.utils.data.distributed import DistributedSampler
 from utils.absorb_bn import search_absorbe_bn
 from utils.mixup import MixUp
 import models
-from data import get_dataset
+from data import get_dataset,TensorBank,ResumableRandomSampler,DevicePrefetcher,RandomBatchLoader,get_random_loader,_DATASET_META_DATA
 from torchvision.transforms import Compose
 from torchvision import models as tvmodels
-from preprocess import get_transform,RandomNoise,Cutout,ImgGhosting
+from preprocess import get_transform,RandomNoise,Cutout,ImgGhosting,get_batch_augmentations,BatchNormalize,get_batch_transform,get_decode_transform,has_batch_transform
 from utils.log import setup_logging, ResultsLog, save_checkpoint
 from utils.meters import AverageMeter, accuracy
 from utils.optim import OptimRegime
@@ -52,6 +57,8 @@ parser.add_argument('--print-freq', '-pf', default=100, type=int,
                     metavar='N', help='print frequency (default: 10)')
 parser.add_argument('--ckpt-freq', '-cf', default=10, type=int,
                     metavar='N', help='save checkpoint frequency (default: 10)')
+parser.add_argument('--ckpt-steps', default=0, type=int,
+                    metavar='N', help='save a resumable training state every N training steps (default: 0, only at epoch end)')
 parser.add_argument('--seed', default=123, type=int,
                     help='random seed (default: 123)')
 ####OP MOD
@@ -107,9 +114,15 @@ parser.add_argument('--calibration-set-size', default=500, type=int,
                     help='limit number of examples per class for calibration (default: 500, use entire ds)')
 parser.add_argument('--shuffle-calibration-steps', default=200, type=int,
                     help='number of calibration steps')
+parser.add_argument('--calibration-bank', action='store_true',
+                    help='decode the calibration subset once into an in-memory tensor bank and augment batches on tensors')
 parser.add_argument('--recalibrate', action='store_true',
                     help='use training examples mixup')
-parser.add_argument('--distill-aug', nargs='+', type=str,help='use intermediate layer loss',choices=['cutout','ghost','normal'],default=None)
+parser.add_argument('--distill-aug', nargs='+', type=str,
+                    help='per sample batch augmentations of the distillation inputs (default cutout), only for batched '
+                         "training data ('-mmap' and 'random-' datasets) and the calibration tensor bank, "
+                         'other datasets use per image cutout',
+                    choices=['cutout','ghost','normal'],default=None)
 parser.add_argument('--mixup', action='store_true',
                     help='use training examples mixup')
 parser.add_argument('--mixup_rate', default=0.5,
@@ -134,10 +147,25 @@ parser.add_argument('-b', '--batch-size', default=256, type=int,
                     metavar='N', help='mini-batch size (default: 256)')
 parser.add_argument('-c', '--batch-chunks', default=1, type=int,
                     metavar='N', help='split mini-batch to N chunks (default: 1)')
+parser.add_argument('--autocast', default=None, choices=['bf16', 'fp16'],
+                    help='run student and teacher forwards under autocast with fp32 master weights,'
+                         ' bf16 is supported on cpu (fp16 runs without loss scaling)')
+parser.add_argument('--overlap-teacher', action='store_true',
+                    help='run the teacher forward of the next batch chunk in a worker thread while the student'
+                         ' processes the current chunk (ignored with mixup)')
 parser.add_argument('-r','--overwrite-regime',default=None, help='rewrite regime with external list of dicts "[{},{}...]"')
 ####MISC
 parser.add_argument('--pretrain', action='store_true',
                     help='preform layerwise pretraining session before full network distillation')
+parser.add_argument('--pretrain-freeze-prev', action='store_true',
+                    help='layerwise pretraining trains one module at a time while all previous modules are frozen')
+parser.add_argument('--pretrain-cache-mb', default=4096, type=int,
+                    help='memory budget (MB) for caching frozen prefix activations during layerwise pretraining'
+                         ' with --pretrain-freeze-prev, batches beyond the budget are recomputed (0 disables the cache).'
+                         ' cached batches keep the augmentations drawn when they were first computed, every stage'
+                         ' and epoch replays the same augmented samples for the cached part')
+parser.add_argument('--pretrain-cache-dir', default='', type=str,
+                    help='keep the pretraining activation cache in memory mapped files under this directory')
 parser.add_argument('--train-first-conv', action='store_true',
                     help='allow first conv to train')
 parser.add_argument('--use-learned-temperature', action='store_true',
@@ -182,8 +210,8 @@ parser.add_argument('--local_rank', default=-1, type=int,
                     help='rank of distributed processes')
 parser.add_argument('--dist-init', default='env://', type=str,
                     help='init used to set up distributed training')
-parser.add_argument('--dist-backend', default='nccl', type=str,
-                    help='distributed backend')
+parser.add_argument('--dist-backend', default=None, type=str,
+                    help='distributed backend (default: nccl for cuda devices, gloo for cpu)')
 
 def set_default_regime(model,lr=1e-3,momentum=0.9,dampning=0.1,warmup=(5,1e-8,'cos'),drops=[(40,1,'linear'),(15,1e-1,'cos'),(10,1e-1,'cos')],
                        steps_per_epoch=400,epochs=80,weight_decay=None):
@@ -289,18 +317,27 @@ def main():
     dtype = torch_dtypes.get(args.dtype)
     torch.manual_seed(args.seed)
     time_stamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    distributed = args.local_rank >= 0 or args.world_size > 1
-    is_not_master = distributed and args.local_rank > 0
+    # processes launched with torchrun/torch.distributed.launch expose the world size through the environment
+    distributed = args.local_rank >= 0 or args.world_size > 1 or int(os.environ.get('WORLD_SIZE', 1)) > 1
     if distributed:
+        use_cuda = 'cuda' in args.device and torch.cuda.is_available()
+        if args.dist_backend is None:
+            args.dist_backend = 'nccl' if use_cuda else 'gloo'
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_init,
                                 world_size=args.world_size, rank=args.local_rank)
         args.local_rank = dist.get_rank()
         args.world_size = dist.get_world_size()
-        if args.dist_backend == 'mpi':
+        if not use_cuda:
+            # cpu processes share the machine, split the cores evenly between the local processes
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+            args.device_ids = None
+        elif args.dist_backend == 'mpi':
             # If using MPI, select all visible devices
             args.device_ids = list(range(torch.cuda.device_count()))
         else:
-            args.device_ids = [args.local_rank]
+            args.device_ids = [int(os.environ.get('LOCAL_RANK', args.local_rank)) % torch.cuda.device_count()]
+    is_not_master = distributed and args.local_rank > 0
 
     # create model config
     logging.info("creating model %s", args.model)
@@ -421,7 +458,11 @@ def main():
         else:
             exp_group_path = os.path.join(save_calibrated_path,args.exp_group)
 
-    save_path = os.path.join(save_calibrated_path, time_stamp + opt)
+    if args.resume:
+        # a resumed run keeps writing to the directory of the run it continues
+        save_path = args.resume.rstrip('/') if os.path.isdir(args.resume) else os.path.dirname(args.resume)
+    else:
+        save_path = os.path.join(save_calibrated_path, time_stamp + opt)
     if not os.path.exists(save_path) and not is_not_master:
         os.makedirs(save_path)
 
@@ -443,6 +484,8 @@ def main():
         cudnn.benchmark = True
     else:
         args.device_ids = None
+    if distributed:
+        logging.info(f'distributed training: rank {args.local_rank}/{args.world_size} backend {args.dist_backend}')
 
     logging.info('rewriting calibration resample flag to True')
     args.calibration_resample = True
@@ -495,7 +538,8 @@ def main():
     logging.info("creating apprentice model with configuration: %s", student_model_config)
     model = model_builder(**student_model_config)
     # add bias terms to the student model since we partially/entirely absorbed them in the teacher
-    if args.fresh_bn or (args.absorb_bn and from_model_zoo):
+    bn_absorbed = args.fresh_bn or (args.absorb_bn and from_model_zoo)
+    if bn_absorbed:
         search_absorbe_bn(model, remove_bn=not args.freeze_bn)
     if not args.no_quantize and from_model_zoo:
         #apply quantization on arbitrary models
@@ -523,11 +567,16 @@ def main():
 
     # Data loading code
     # todo mharoush: add distillation specific transforms
+    # '-mmap' datasets hold decoded uint8 images and are transformed a whole batch at a time, other datasets keep
+    # the per image transforms in the loader workers
+    batched = train_dataset_name.endswith('-mmap')
+    assert not args.distill_aug or batched or train_dataset_name.startswith('random-'), \
+        f"--distill-aug needs batched training data ('-mmap' or 'random-' datasets), got {train_dataset_name}"
     default_transform = {
         'train': get_transform(val_dataset_name,
-                               input_size=args.input_size, augment=True),
+                               input_size=args.input_size, augment=True, batched=batched),
         'eval': get_transform(val_dataset_name,
-                              input_size=args.input_size, augment=False)
+                              input_size=args.input_size, augment=False, batched=batched)
     }
     transform = getattr(model, 'input_transform', default_transform)
     # if args.distill_aug:
@@ -540,13 +589,29 @@ def main():
     #         trans = Compose([trans, Cutout()])
     #     if 'mixup' in args.distill_aug:
     #
-    transform.update({'train' : Compose([transform['train'], Cutout()])})
+    if batched:
+        # batched augmentations draw independent parameters per sample, default to cutout as the per image path
+        transform.update({'train': Compose([transform['train']] + get_batch_augmentations(args.distill_aug or ['cutout']))})
+    else:
+        transform.update({'train' : Compose([transform['train'], Cutout()])})
     if args.mixup:
         mixer = MixUp()
         mixer.to(args.device)
     else:
         mixer = None
-    train_data = get_dataset(train_dataset_name, 'train', transform['train'],limit=args.dist_set_size)
+    num_replicas, rank = (args.world_size, args.local_rank) if distributed else (1, 0)
+    if train_dataset_name.startswith('random-'):
+        # noise batches are generated in the model input shape on the device, no dataset or worker processes
+        meta = _DATASET_META_DATA.get(train_dataset_name[7:], _DATASET_META_DATA.get(model_ds_config, _DATASET_META_DATA['imagenet']))
+        random_transform = Compose([BatchNormalize(**meta.get_normalization())] +
+                                   get_batch_augmentations(args.distill_aug or ['cutout']))
+        train_data = get_random_loader(train_dataset_name, args.batch_size, input_size=args.input_size or meta.shape[-1],
+                                       limit=args.dist_set_size,
+                                       num_samples=args.steps_per_epoch * args.batch_size if args.steps_per_epoch > 0 else None,
+                                       dtype=dtype, device=args.device, seed=args.seed, transform=random_transform,
+                                       num_replicas=num_replicas, rank=rank)
+    else:
+        train_data = get_dataset(train_dataset_name, 'train', transform['train'],limit=args.dist_set_size)
     logging.info(f'train dataset {train_data}')
     if is_not_master and args.steps_per_epoch:
         ## this ensures that all procesees work on the same sampled sub set data but with different samples per batch
@@ -555,19 +620,39 @@ def main():
 
     # todo p3:
     #   2. in-batch augmentation
-    if args.steps_per_epoch > 0:
+    # sample order depends only on the seed and epoch so that a run can be resumed mid epoch
+    if isinstance(train_data, RandomBatchLoader):
+        sampler = train_loader = train_data
+    elif isinstance(train_data, torch.utils.data.IterableDataset):
+        # '-shards' streams split and shuffle themselves and stand in for the sampler
+        if args.steps_per_epoch > 0:
+            logging.warning('steps per epoch is ignored for streamed datasets, sampling without replacement')
+        train_data.seed, train_data.num_replicas, train_data.rank = args.seed, num_replicas, rank
+        sampler = train_data
+    elif args.steps_per_epoch > 0:
         logging.info(f'total steps per epoch {args.steps_per_epoch}')
         logging.info('setting random sampler with replacement for training dataset')
-        sampler = torch.utils.data.RandomSampler(train_data,replacement=True,num_samples=args.steps_per_epoch*args.batch_size)
+        sampler = ResumableRandomSampler(train_data, num_samples=args.steps_per_epoch*args.batch_size, replacement=True,
+                                         seed=args.seed, num_replicas=num_replicas, rank=rank)
     else:
-        sampler = None
-
-    train_loader = torch.utils.data.DataLoader(
-        train_data,sampler=sampler,
-        batch_size=args.batch_size, shuffle=(sampler is None),
-        num_workers=args.workers, pin_memory=not distributed,drop_last=True)
-
-    val_data = get_dataset(val_dataset_name, 'val', transform['eval'])
+        if distributed:
+            logging.info('setting distributed sampler for training dataset')
+        sampler = ResumableRandomSampler(train_data, seed=args.seed, num_replicas=num_replicas, rank=rank)
+
+    # worker seeds are drawn from this generator when an epoch starts, its state is part of the training state
+    loader_generator = torch.Generator()
+    loader_generator.manual_seed(args.seed + rank)
+    if not isinstance(train_data, RandomBatchLoader):
+        train_loader = torch.utils.data.DataLoader(
+            train_data,sampler=None if sampler is train_data else sampler,
+            batch_size=args.batch_size, shuffle=False,
+            num_workers=args.workers, pin_memory=not distributed,drop_last=True, generator=loader_generator)
+
+    if val_dataset_name.endswith('-mmap') == batched:
+        val_transform = transform['eval']
+    else:
+        val_transform = get_transform(val_dataset_name, input_size=args.input_size, augment=False, batched=not batched)
+    val_data = get_dataset(val_dataset_name, 'val', val_transform)
     val_loader = torch.utils.data.DataLoader(
         val_data,
         batch_size=args.batch_size, shuffle=False,
@@ -636,6 +721,7 @@ def main():
     valid_criterion = criterion
 
     # optionally resume from a checkpoint
+    training_state = None
     if args.evaluate:
         if not os.path.isfile(args.evaluate):
             parser.error('invalid checkpoint: {}'.format(args.evaluate))
@@ -648,16 +734,27 @@ def main():
     elif args.resume:
         checkpoint_file = args.resume
         if os.path.isdir(checkpoint_file):
-            results.load(os.path.join(checkpoint_file, 'results.csv'))
-            checkpoint_file = os.path.join(
-                checkpoint_file, 'model_best.pth.tar')
+            if not is_not_master:
+                results.load(os.path.join(checkpoint_file, 'results.csv'))
+            # prefer the latest full training state over the best model
+            if os.path.isfile(os.path.join(checkpoint_file, 'training_state.pth.tar')):
+                checkpoint_file = os.path.join(checkpoint_file, 'training_state.pth.tar')
+            else:
+                checkpoint_file = os.path.join(
+                    checkpoint_file, 'model_best.pth.tar')
         if os.path.isfile(checkpoint_file):
             logging.info("loading checkpoint '%s'", args.resume)
-            checkpoint = torch.load(checkpoint_file)
-            args.start_epoch = checkpoint['epoch'] - 1
+            checkpoint = torch.load(checkpoint_file, 'cpu', weights_only=False)
+            if 'optimizer' in checkpoint:
+                # restored after the optimizer is created
+                training_state = checkpoint
+                args.start_epoch = checkpoint['epoch']
+            else:
+                args.start_epoch = checkpoint['epoch'] - 1
             best_prec1 = checkpoint['best_prec1']
-            if args.fresh_bn or (args.absorb_bn and from_model_zoo):
-                search_absorbe_bn(model, remove_bn=not args.fresh_bn)
+            # the student is absorbed when it is created, the saved weights must come from the same model
+            assert checkpoint.get('bn_absorbed', bn_absorbed) == bn_absorbed, \
+                f"checkpoint bn absorption ({checkpoint['bn_absorbed']}) does not match the absorb bn flags"
             model.load_state_dict(checkpoint['state_dict'])
             logging.info("loaded checkpoint '%s' (epoch %s)",
                          checkpoint_file, checkpoint['epoch'])
@@ -678,14 +775,19 @@ def main():
             model.load_state_dict(teacher_checkpoint, strict=False)
         #freeze_dropout(model)
         model.to(args.device, dtype)
-        model,loss_avg,acc = calibrate(model,train_dataset_name,transform,val_loader=val_loader,logging=logging,resample=args.shuffle_calibration_steps,sample_per_class=args.calibration_set_size)
+        model,loss_avg,acc = calibrate(model,train_dataset_name,transform,val_loader=val_loader,logging=logging,
+                                       resample=args.shuffle_calibration_steps,sample_per_class=args.calibration_set_size,
+                                       distributed=distributed,use_bank=args.calibration_bank)
 
         student_checkpoint= teacher_checkpoint.copy()
         student_checkpoint.update({'config': student_model_config, 'state_dict': model.state_dict(),
                                    'epoch': 0,'regime':None, 'best_prec1': acc})
-        logging.info("saving apprentice checkpoint")
-        save_checkpoint(student_checkpoint, path=save_calibrated_path,filename='calibrated_checkpoint')
+        if not is_not_master:
+            logging.info("saving apprentice checkpoint")
+            save_checkpoint(student_checkpoint, path=save_calibrated_path,filename='calibrated_checkpoint')
         if args.recalibrate:
+            if is_not_master:
+                exit(0)
             print(f'reported calibration\t loss-{loss_avg:.3f} top1-{acc:.2f}', )
             if args.exp_group:
                 logging.info(f'appending experiment result summary to {args.exp_group} experiment')
@@ -714,6 +816,9 @@ def main():
 
     optimizer = OptimRegime(model, regime)
     logging.info('start training with regime-\n'+('{}\n'*len(regime)).format(*[p for p in regime]))
+    if training_state is not None:
+        load_training_state(training_state, optimizer, sampler, mixer, loader_generator, distributed)
+        logging.info(f"resuming training from epoch {training_state['epoch']} step {training_state['step']}")
     if args.otf:
         logging.info('updating batch norm learnable modifiers in student model')
         state = model.state_dict().copy()
@@ -729,11 +834,11 @@ def main():
                 state[k] = teacher_params.pop(0)
         model.load_state_dict(state)
     model.to(args.device, dtype)
-    if args.pretrain:
+    if args.pretrain and training_state is None:
         ## layerwise training freeze all previous layers first
         #pretrain(model,teacher,train_loader,optimizer,pre_train_criterion,True,4)
         ## fine tune
-        pretrain(model, teacher, train_loader, optimizer, pre_train_criterion,False,3, aux = aux,loss_scale = loss_scale)
+        pretrain(model, teacher, train_loader, optimizer, pre_train_criterion,args.pretrain_freeze_prev,3, aux = aux,loss_scale = loss_scale)
 
     if args.quant_once:
         with torch.no_grad():
@@ -742,7 +847,17 @@ def main():
             #set_bn_is_train(model, False, logging)
             pass
 
+    training_state_path = os.path.join(save_path, 'training_state.pth.tar')
+    def on_step(epoch, step):
+        # called on every rank, the rng states of all ranks are gathered by the master
+        if args.ckpt_steps > 0 and step % args.ckpt_steps == 0:
+            save_training_state(training_state_path, model, optimizer, epoch, step, sampler, mixer, best_prec1,
+                                epoch_loader_rng, bn_absorbed, distributed, is_not_master)
+
     for epoch in range(args.start_epoch , args.epochs):
+        sampler.set_epoch(epoch)
+        # the epoch's worker seeds are reproduced from this state when resuming mid epoch
+        epoch_loader_rng = loader_generator.get_state()
         ## train for one epoch
         ## absorb bn after absorb bn steps of training
         # if not args.absorb_bn and -1 < args.absorb_bn_step == args.steps_per_epoch*epoch:
@@ -762,7 +877,7 @@ def main():
             train_loss, train_prec1, train_prec5 = train(
                 train_loader, model, CE, epoch, optimizer,
                 loss_scale=loss_scale, mixer=mixer, quant_freeze_steps=args.quant_freeze_steps,
-                dr_weight_freeze=not args.free_w_range, distributed=distributed)
+                dr_weight_freeze=not args.free_w_range, distributed=distributed, on_step=on_step)
         else:
             if args.freeze_bn_running_estimators:
                 logging.info('saving initial bn parameters for all batch normalization')
@@ -771,7 +886,10 @@ def main():
                 train_loader, model, criterion, epoch, optimizer, teacher, aux=aux, ce=CE, loss_scale=loss_scale,
                 aux_loss_scale=aux_loss_scale, mixer=mixer, quant_freeze_steps=args.quant_freeze_steps,
                 dr_weight_freeze=not args.free_w_range, distributed=distributed,
-                aux_depth_scale=not args.uniform_aux_depth_scale)
+                aux_depth_scale=not args.uniform_aux_depth_scale, on_step=on_step)
+        save_training_state(training_state_path, model, optimizer, epoch + 1,
+                            (epoch + 1) * (sampler.num_samples // args.batch_size), sampler, mixer, best_prec1,
+                            loader_generator.get_state(), bn_absorbed, distributed, is_not_master)
 
         if (epoch +1) % repeat == 0 and is_not_master == False:
             # evaluate on validation set
@@ -804,7 +922,8 @@ def main():
                 'config': student_model_config,
                 'state_dict': model.state_dict(),
                 'best_prec1': best_prec1,
-                'regime': regime
+                'regime': regime,
+                'bn_absorbed': bn_absorbed
             }, is_best, path=save_path,save_freq=args.ckpt_freq)
             logging.info('\n Epoch: {0}\t'
                          'Training Loss {train_loss:.4e} \t'
@@ -873,23 +992,19 @@ def main():
 
 def forward(data_loader, model, criterion, epoch=0, training=True, optimizer=None,teacher=None,aux=None,ce=None,
             aux_start=0,loss_scale = 1.0,aux_loss_scale=1.0,quant_freeze_steps=0,mixer=None,distributed=False,
-            aux_depth_scale=True):
+            aux_depth_scale=True,on_step=None):
+    modules = model._modules
     if aux:
-        model = SubModules(model)
         teacher = SubModules(teacher) if teacher else None
-
-    modules = model._modules
     if distributed:
-        model = nn.parallel.DistributedDataParallel(model,
-                                                     device_ids=args.device_ids,
-                                                     output_device=args.device_ids[0])
-        teacher = nn.parallel.DistributedDataParallel(teacher,
-                                                     device_ids=args.device_ids,
-                                                     output_device=args.device_ids[0]) if teacher else None
-        mixer = nn.parallel.DistributedDataParallel(mixer,
-                                                     device_ids=args.device_ids,
-                                                     output_device=args.device_ids[0]) if mixer else None
-    elif args.device_ids and len(args.device_ids) > 1 and not isinstance(model,nn.DataParallel):
+        # wrap once per model, teacher and mixer are never trained so each process keeps a plain replica
+        if training:
+            model = get_distributed_model(model, aux=aux is not None)
+        elif aux:
+            model = SubModules(model)
+    elif aux:
+        model = SubModules(model)
+    if not distributed and args.device_ids and len(args.device_ids) > 1 and not isinstance(model,nn.DataParallel):
         #aux = torch.nn.DataParallel(aux) if aux else None
         model = torch.nn.DataParallel(model, args.device_ids)
         teacher = torch.nn.DataParallel(teacher, args.device_ids) if teacher else None
@@ -920,181 +1035,230 @@ def forward(data_loader, model, criterion, epoch=0, training=True, optimizer=Non
         steps_per_epoch = data_loader.sampler.num_samples//data_loader.batch_size
     else:
         steps_per_epoch = len(data_loader)
+    # a resumed sampler skips the steps already done in this epoch
+    first_step = getattr(data_loader.sampler, 'start', 0) // data_loader.batch_size
+
+    # the teacher forward of the next chunk overlaps the student forward/backward of the current one,
+    # mixup keeps per-chunk state so chunks must be mixed in order and overlap is disabled
+    overlap_teacher = args.overlap_teacher and teacher and not mixer and args.batch_chunks > 1
+    # the executor is shut down (waiting for a pending teacher forward) on exit, also when a step raises
+    with ThreadPoolExecutor(1) if overlap_teacher else nullcontext() as teacher_pool:
+        for i, (inp, lab) in enumerate(DevicePrefetcher(data_loader, args.device, dtype), first_step):
+            if training:
+                steps = epoch * steps_per_epoch + i
+                if -1 < quant_freeze_steps < steps and _once:
+                    logging.info('releasing model quant parameters')
+                    freeze_quant_params(model, freeze=False, include_param_dyn_range=True, momentum=0.9999, logger=logging)
+                    _once = 0
+            # measure data loading time
+            data_time.update(time.time() - end)
+            chunks = list(zip(inp.chunk(args.batch_chunks),lab.chunk(args.batch_chunks)))
+            # meter updates are kept on device and synced once per step
+            step_meters = []
+            if teacher_pool:
+                next_target = teacher_pool.submit(teacher_forward, teacher, chunks[0][0])
+            for c, (inputs, labels) in enumerate(chunks):
+                aux_loss = torch.zeros((), device=args.device)
+                if mixer:
+                    with torch.no_grad():
+                        inputs = mixer(inputs,[args.mixup_rate,inputs.size(0),True])
+                if teacher_pool:
+                    target_future = next_target
+                    if c + 1 < len(chunks):
+                        next_target = teacher_pool.submit(teacher_forward, teacher, chunks[c + 1][0])
+                with autocast():
+                    output_ = float_outputs(model(inputs))
+
+                if teacher:
+                    if teacher_pool:
+                        target_ = target_future.result()
+                    else:
+                        target_ = teacher_forward(teacher, inputs)
+                    if aux:
+                        aux_outputs, aux_targets=output_[aux_start:-1],target_[aux_start:-1]
+
+                        for k,(output__,target__) in enumerate(zip(aux_outputs,aux_targets)):
+                            if isinstance(aux,nn.KLDivLoss) or isinstance(aux,nn.DataParallel) and isinstance(aux._modules['module'],nn.KLDivLoss):
+                                with torch.no_grad():
+                                    ## divide by temp factor to increase entropy todo register as model learnable param
+                                    a_t = F.softmax(target__,-1)
+                                a_o = F.log_softmax(output__,-1)
+                            else:
+                                a_o = output__
+                                a_t = target__
+
+                            if aux_depth_scale:
+                                num_outputs_for_aux = (len(output_) - aux_start - 1)
+                                depth_scale=2*(k-aux_start +1)/(num_outputs_for_aux**2+num_outputs_for_aux)
+                            else:
+                                depth_scale=1.0
+
+                            aux_loss += aux(a_o, a_t)*depth_scale
+
+                        step_meters.append((aux_loss_mtr, aux_loss, inputs.size(0)))
+                        #keep last module output for final loss
+                        output_ = output_[-1]
+                        target_ = target_[-1]
+
+
+                    if args.use_learned_temperature:
+                        assert hasattr(model,'tau')
+                        target_ /= model.tau
+                        output_ /= model.tau
+                    else:
+                        target_ /= args.fixed_distillation_temperature
+                        output_ /= args.fixed_distillation_temperature
 
-    for i, (inp, lab) in enumerate(data_loader):
-        if training:
-            steps = epoch * steps_per_epoch + i
-            if -1 < quant_freeze_steps < steps and _once:
-                logging.info('releasing model quant parameters')
-                freeze_quant_params(model, freeze=False, include_param_dyn_range=True, momentum=0.9999, logger=logging)
-                _once = 0
-        # measure data loading time
-        data_time.update(time.time() - end)
-        inp = inp.to(args.device, dtype=dtype)
-        lab = lab.to(args.device)
-        for c, (inputs, labels) in enumerate(zip(inp.chunk(args.batch_chunks),lab.chunk(args.batch_chunks))):
-            aux_loss = torch.tensor(0.).to(args.device)
-            if mixer:
-                with torch.no_grad():
-                    inputs = mixer(inputs,[args.mixup_rate,inputs.size(0),True])
-            output_ = model(inputs)
-
-            if teacher:
-                with torch.no_grad():
-                    target_ = teacher(inputs)
-                if aux:
-                    aux_outputs, aux_targets=output_[aux_start:-1],target_[aux_start:-1]
-
-                    for k,(output__,target__) in enumerate(zip(aux_outputs,aux_targets)):
-                        if isinstance(aux,nn.KLDivLoss) or isinstance(aux,nn.DataParallel) and isinstance(aux._modules['module'],nn.KLDivLoss):
-                            with torch.no_grad():
-                                ## divide by temp factor to increase entropy todo register as model learnable param
-                                a_t = F.softmax(target__,-1)
-                            a_o = F.log_softmax(output__,-1)
-                        else:
-                            a_o = output__
-                            a_t = target__
-
-                        if aux_depth_scale:
-                            num_outputs_for_aux = (len(output_) - aux_start - 1)
-                            depth_scale=2*(k-aux_start +1)/(num_outputs_for_aux**2+num_outputs_for_aux)
-                        else:
-                            depth_scale=1.0
-
-                        aux_loss += aux(a_o, a_t)*depth_scale
-
-                    aux_loss_mtr.update(float(aux_loss),inputs.size(0))
-                    #keep last module output for final loss
-                    output_ = output_[-1]
-                    target_ = target_[-1]
-
+                    if mixer and args.mix_target:
+                        target_ = mixer(target=target_)
 
-                if args.use_learned_temperature:
-                    assert hasattr(model,'tau')
-                    target_ /= model.tau
-                    output_ /= model.tau
+                    ## normal distillation extract target
+                    if isinstance(criterion, nn.KLDivLoss):
+                        with torch.no_grad():
+                            target = F.softmax(target_, -1)
+                        output = F.log_softmax(output_, -1)
+                    else:
+                        target = target_
+                        output = output_
                 else:
-                    target_ /= args.fixed_distillation_temperature
-                    output_ /= args.fixed_distillation_temperature
+                    ## use real labels as targets
+                    target = labels
+                    output = output_
 
                 if mixer and args.mix_target:
-                    target_ = mixer(target=target_)
-
-                ## normal distillation extract target
-                if isinstance(criterion, nn.KLDivLoss):
                     with torch.no_grad():
-                        target = F.softmax(target_, -1)
-                    output = F.log_softmax(output_, -1)
-                else:
-                    target = target_
-                    output = output_
-            else:
-                ## use real labels as targets
-                target = labels
-                output = output_
+                        target = mixer.mix_target(target)
 
-            if mixer and args.mix_target:
-                with torch.no_grad():
-                    target = mixer.mix_target(target)
-
-            if args.order_weighted_loss and training:
-                with torch.no_grad():
-                    target,ids = torch.sort(target,descending=True)
-                    ids_ = torch.cat([s + k * target.size(1) for k, s in enumerate(ids)])
-                output_flat = output.flatten()
-                output = output_flat[ids_].reshape((target.size(0),target.size(1)))
-                # using 1 / ni**2 scaling where ni is the ranking of the element i
-                # normalization with pi**2 / 6
-                with torch.no_grad():
-                    #normalizing_sorting_scale=torch.sqrt(0.607927/(torch.arange(1,1001).to(target.device)**2).float()).unsqueeze(0)
-                    normalizing_sorting_scale = torch.sqrt(
-                      1 / (torch.arange(1, 1001,dtype=torch.float)* torch.log(torch.tensor([target.size(1)],dtype=torch.float)))
+                if args.order_weighted_loss and training:
+                    with torch.no_grad():
+                        target,ids = torch.sort(target,descending=True)
+                        ids_ = torch.cat([s + k * target.size(1) for k, s in enumerate(ids)])
+                    output_flat = output.flatten()
+                    output = output_flat[ids_].reshape((target.size(0),target.size(1)))
+                    # using 1 / ni**2 scaling where ni is the ranking of the element i
+                    # normalization with pi**2 / 6
+                    with torch.no_grad():
+                        #normalizing_sorting_scale=torch.sqrt(0.607927/(torch.arange(1,1001).to(target.device)**2).float()).unsqueeze(0)
+                        normalizing_sorting_scale = torch.sqrt(
+                          1 / (torch.arange(1, 1001,dtype=torch.float)* torch.log(torch.tensor([target.size(1)],dtype=torch.float)))
 
-                    ).unsqueeze(0).to(target.device)
-                    target = torch.mul(target,normalizing_sorting_scale)
-                output = torch.mul(output,normalizing_sorting_scale)
+                        ).unsqueeze(0).to(target.device)
+                        target = torch.mul(target,normalizing_sorting_scale)
+                    output = torch.mul(output,normalizing_sorting_scale)
 
-            loss = aux_loss*aux_loss_scale + criterion(output, target) * loss_scale
+                loss = aux_loss*aux_loss_scale + criterion(output, target) * loss_scale
 
-            if ce:
-                loss = loss + ce(output,labels)
+                if ce:
+                    loss = loss + ce(output,labels)
 
-            if args.ranking_loss and training:
-                topk=5
-                with torch.no_grad():
-                    _,ids = torch.sort(target,descending=True)
-                output_flat = output.flatten()
-                x1,x2=None,None
-                for k in range(topk):
+                if args.ranking_loss and training:
+                    topk=5
                     with torch.no_grad():
-                        ids_top1= ids[:,k:k+1]
-                        ids_rest= ids[:,k+1:]
-                        #calculate flat ids for slicing
-                        ids_top1_= torch.cat([s + r * target.size(1) for r, s in enumerate(ids_top1)])
-                        ids_rest_ = torch.cat([s + r * target.size(1) for r, s in enumerate(ids_rest)])
-                    if x1 is None:
-                        x1 = output_flat[ids_top1_].unsqueeze(1).repeat(1,target.size(1)-1)
-                        x2 = output_flat[ids_rest_].reshape((target.size(0),-1))
+                        _,ids = torch.sort(target,descending=True)
+                    output_flat = output.flatten()
+                    x1,x2=None,None
+                    for k in range(topk):
+                        with torch.no_grad():
+                            ids_top1= ids[:,k:k+1]
+                            ids_rest= ids[:,k+1:]
+                            #calculate flat ids for slicing
+                            ids_top1_= torch.cat([s + r * target.size(1) for r, s in enumerate(ids_top1)])
+                            ids_rest_ = torch.cat([s + r * target.size(1) for r, s in enumerate(ids_rest)])
+                        if x1 is None:
+                            x1 = output_flat[ids_top1_].unsqueeze(1).repeat(1,target.size(1)-1)
+                            x2 = output_flat[ids_rest_].reshape((target.size(0),-1))
+                        else:
+                            x1 = torch.cat(x1,output_flat[ids_top1_].unsqueeze(1).repeat(1, target.size(1) - k - 1))
+                            x2 = torch.cat(x2,output_flat[ids_rest_].reshape((target.size(0), -1)))
+                    gt = torch.ones_like(x2)
+                    ranking_loss = nn.MarginRankingLoss()(x1,x2,gt)
+                    step_meters.append((ranking_loss_mtr, ranking_loss, inputs.size(0)))
+                    loss = loss + ranking_loss
+
+                if args.batch_chunks > 1:
+                    loss = loss / args.batch_chunks
+
+                if regularizer is not None and c==args.batch_chunks-1:
+                    loss += regularizer(model)
+                step_meters.append((losses, loss, inputs.size(0)))
+
+                if training:
+                    if c==0:
+                        optimizer.zero_grad()
+                    ##accumulate gradients
+                    if distributed and c < args.batch_chunks - 1:
+                        # gradients are reduced between processes only once, on the last chunk
+                        with model.no_sync():
+                            loss.backward()
                     else:
-                        x1 = torch.cat(x1,output_flat[ids_top1_].unsqueeze(1).repeat(1, target.size(1) - k - 1))
-                        x2 = torch.cat(x2,output_flat[ids_rest_].reshape((target.size(0), -1)))
-                gt = torch.ones_like(x2)
-                ranking_loss = nn.MarginRankingLoss()(x1,x2,gt)
-                ranking_loss_mtr.update(float(ranking_loss),inputs.size(0))
-                loss = loss + ranking_loss
-
-            if args.batch_chunks > 1:
-                loss = loss / args.batch_chunks
-
-            if regularizer is not None and c==args.batch_chunks-1:
-                loss += regularizer(model)
-            losses.update(float(loss), inputs.size(0))
+                        loss.backward()
+                # measure accuracy and record loss, only defined for class scores over integer labels
+                if output.dim() == 2 and output.size(1) >= 5 and labels.dim() == 1:
+                    prec1, prec5 = accuracy(output.detach(), labels, topk=(1, 5))
+                    step_meters += [(top1, prec1, inputs.size(0)), (top5, prec5, inputs.size(0))]
+            sync_meters(step_meters)
+
+            if i % args.print_freq == 0:
+                logging.info('{phase} - Epoch: [{0}][{1}/{2}]  \t{steps}'
+                             'Loss {loss.avg:.4e} ({loss.std:.3f}) \t'
+                             'Prec@1 {top1.avg:.3f} ({top1.std:.3f}) \t'
+                             'Prec@5 {top5.avg:.3f} ({top5.std:.3f})'.format(
+                    epoch, i, len(data_loader),
+                    phase='TRAINING' if training else 'EVALUATING',
+                    steps=f'Train steps: {steps}\t' if training else '',
+                    loss=losses, top1=top1, top5=top5)+
+                             f'\taux_loss {aux_loss_mtr.avg:0.4f}({aux_loss_mtr.std:0.3f})'
+                             f'\tranking loss {ranking_loss_mtr.avg:0.4f}({ranking_loss_mtr.std:0.3f})')
 
             if training:
-                if c==0:
-                    optimizer.zero_grad()
-                ##accumulate gradients
-                loss.backward()
-            # measure accuracy and record loss
-            try:
-                prec1, prec5 = accuracy(output.detach(), labels, topk=(1, 5))
-                top1.update(prec1.item(), inputs.size(0))
-                top5.update(prec5.item(), inputs.size(0))
-            except:
-                pass
-
-        if i % args.print_freq == 0:
-            logging.info('{phase} - Epoch: [{0}][{1}/{2}]  \t{steps}'
-                         'Loss {loss.avg:.4e} ({loss.std:.3f}) \t'
-                         'Prec@1 {top1.avg:.3f} ({top1.std:.3f}) \t'
-                         'Prec@5 {top5.avg:.3f} ({top5.std:.3f})'.format(
-                epoch, i, len(data_loader),
-                phase='TRAINING' if training else 'EVALUATING',
-                steps=f'Train steps: {steps}\t' if training else '',
-                loss=losses, top1=top1, top5=top5)+
-                         f'\taux_loss {aux_loss_mtr.avg:0.4f}({aux_loss_mtr.std:0.3f})'
-                         f'\tranking loss {ranking_loss_mtr.avg:0.4f}({ranking_loss_mtr.std:0.3f})')
-
-        if training:
-            #post gradient accumulation step
-            optimizer.update(epoch, steps)
-            optimizer.step()
-        # elif teacher and i == 0:
-        #     compare_activations(model,teacher,inputs[:64])
+                #post gradient accumulation step
+                optimizer.update(epoch, steps)
+                optimizer.step()
+                if on_step is not None:
+                    on_step(epoch, steps + 1)
+            # elif teacher and i == 0:
+            #     compare_activations(model,teacher,inputs[:64])
+
+            # measure elapsed time
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % args.print_freq == 0:
+                logging.info('Time {batch_time.avg:.3f} ({batch_time.std:.3f})\t'
+                             'Data {data_time.avg:.3f} ({data_time.std:.3f})\t'.format(batch_time=batch_time,
+                                                                                       data_time=data_time))
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+    return losses.avg, top1.avg, top5.avg
 
-        if i % args.print_freq == 0:
-            logging.info('Time {batch_time.avg:.3f} ({batch_time.std:.3f})\t'
-                         'Data {data_time.avg:.3f} ({data_time.std:.3f})\t'.format(batch_time=batch_time,
-                                                                                   data_time=data_time))
+_AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+def autocast():
+    device_type = 'cuda' if 'cuda' in str(args.device) else 'cpu'
+    return torch.autocast(device_type, dtype=_AUTOCAST_DTYPES.get(args.autocast, torch.bfloat16),
+                          enabled=args.autocast is not None)
 
-    return losses.avg, top1.avg, top5.avg
+def float_outputs(output):
+    # losses and metrics are computed in fp32 regardless of the autocast dtype
+    if args.autocast is None:
+        return output
+    if isinstance(output, (list, tuple)):
+        return [float_outputs(o) for o in output]
+    return output.float() if output.is_floating_point() else output
+
+def teacher_forward(teacher,inputs):
+    # grad and autocast modes are thread local, set them here since this may run in the overlap worker thread
+    with torch.no_grad(), autocast():
+        return float_outputs(teacher(inputs))
+
+def sync_meters(step_meters):
+    # a single device to host copy for all values recorded during the step
+    if step_meters:
+        values = torch.stack([v.detach().float().reshape(()) for _, v, _ in step_meters]).tolist()
+        for (meter, _, n), v in zip(step_meters, values):
+            meter.update(v, n)
 
 def train(data_loader, model, criterion, epoch, optimizer,teacher=None,aux=None,ce=None,aux_start = 0,loss_scale=1.0,
-          aux_loss_scale=1.0,quant_freeze_steps=-1,mixer=None,dr_weight_freeze=True,distributed=False,aux_depth_scale=True):
+          aux_loss_scale=1.0,quant_freeze_steps=-1,mixer=None,dr_weight_freeze=True,distributed=False,aux_depth_scale=True,
+          on_step=None):
     # switch to train mode
     model.train()
     if hasattr(data_loader.sampler, 'num_samples'):
@@ -1129,8 +1293,59 @@ def train(data_loader, model, criterion, epoch, optimizer,teacher=None,aux=None,
     return forward(data_loader, model, criterion, epoch, training=True, optimizer=optimizer, teacher=teacher,
                    aux=aux, ce=ce,aux_start=aux_start,loss_scale=loss_scale, aux_loss_scale=aux_loss_scale,
                    quant_freeze_steps=quant_freeze_steps, mixer=mixer, distributed=distributed,
-                   aux_depth_scale=aux_depth_scale)
-
+                   aux_depth_scale=aux_depth_scale, on_step=on_step)
+
+
+def get_rng_state(loader_rng=None):
+    # loader_rng is the state of the train DataLoader generator the worker seeds are drawn from
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None, 'loader': loader_rng}
+
+def set_rng_state(state, loader_generator=None):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if loader_generator is not None and state.get('loader') is not None:
+        loader_generator.set_state(state['loader'])
+
+def save_training_state(path, model, optimizer, epoch, step, sampler, mixer=None, best_prec1=0, loader_rng=None,
+                        bn_absorbed=False, distributed=False, is_not_master=False):
+    # everything needed to continue training from the exact step, written atomically to survive preemption.
+    # called on all ranks, every rank has its own rng streams and the master saves them as a per rank list
+    rng = [get_rng_state(loader_rng)]
+    if distributed:
+        rng = [None] * dist.get_world_size()
+        dist.all_gather_object(rng, get_rng_state(loader_rng))
+    if is_not_master:
+        return
+    state = {'epoch': epoch, 'step': step, 'state_dict': model.state_dict(),
+             'optimizer': optimizer.optimizer.state_dict(), 'sampler': sampler.state_dict(),
+             'mixer': mixer.state_dict() if mixer is not None else None, 'rng': rng,
+             'quant_freeze_steps': args.quant_freeze_steps, 'absorb_bn_step': args.absorb_bn_step,
+             'bn_absorbed': bn_absorbed, 'best_prec1': best_prec1}
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def load_training_state(state, optimizer, sampler, mixer=None, loader_generator=None, distributed=False):
+    optimizer.optimizer.load_state_dict(state['optimizer'])
+    if mixer is not None and state['mixer'] is not None:
+        mixer.load_state_dict(state['mixer'])
+    args.quant_freeze_steps = state['quant_freeze_steps']
+    args.absorb_bn_step = state['absorb_bn_step']
+    # older states hold the master rng only
+    rng = state['rng'] if isinstance(state['rng'], list) else [state['rng']]
+    rank = dist.get_rank() if distributed else 0
+    if rank >= len(rng):
+        logging.warning(f'training state holds rng states for {len(rng)} ranks, rank {rank} reuses rank 0 state')
+    set_rng_state(rng[rank] if rank < len(rng) else rng[0], loader_generator)
+    sampler.load_state_dict(state['sampler'])
+    sampler.set_epoch(state['epoch'])
+    steps_per_epoch = sampler.num_samples // args.batch_size
+    sampler.skip((state['step'] - state['epoch'] * steps_per_epoch) * args.batch_size)
+    # regime hyper-parameters are a function of the step, set them before the first resumed step
+    optimizer.update(state['epoch'], state['step'])
 
 def validate(data_loader, model, criterion, epoch,teacher=None,loss_scale=1.0,distributed=False):
     # switch to evaluate mode
@@ -1167,6 +1382,9 @@ def pretrain(model,teacher,data,optimizer,criterion,freeze_prev=True,epochs=5,au
     t_mod.to(args.device)
     aux_start=0
     defrost_list = []
+    # with a frozen prefix each stage only needs the prefix outputs, cache them instead of recomputing every step
+    cache = PrefixActivationCache(data, args.pretrain_cache_mb * 2 ** 20, args.pretrain_cache_dir) \
+        if freeze_prev and args.pretrain_cache_mb > 0 else None
     for i,(sv, tv) in enumerate(zip(model._modules.values(), teacher._modules.values())):
         # switch to eval mode
         if freeze_prev:
@@ -1176,6 +1394,8 @@ def pretrain(model,teacher,data,optimizer,criterion,freeze_prev=True,epochs=5,au
                     if p.requires_grad:
                         p.requires_grad = False
                         defrost_list.append(p)
+        if cache is not None and i > 0:
+            cache.advance(mod[-1], t_mod[-1])
 
         t_mod.add_module(str(i), tv)
         t_mod.eval()
@@ -1194,14 +1414,124 @@ def pretrain(model,teacher,data,optimizer,criterion,freeze_prev=True,epochs=5,au
         else:
             logging.info(f'tuning params for module {sv.__str__()}')
 
+        if cache is not None:
+            stage_data, stage_mod, stage_t_mod = cache, nn.Sequential(PrefixSelect(0), sv), nn.Sequential(PrefixSelect(1), tv)
+            stage_t_mod.eval()
+        else:
+            stage_data, stage_mod, stage_t_mod = data, mod, t_mod
         for e in range(epochs):
-            train_loss, _ ,_ = train(data, mod, criterion, 0, optimizer=optimizer, teacher=t_mod,aux=aux,aux_start = aux_start,loss_scale=loss_scale)
+            train_loss, _ ,_ = train(stage_data, stage_mod, criterion, 0, optimizer=optimizer, teacher=stage_t_mod,aux=aux,aux_start = aux_start,loss_scale=loss_scale)
             logging.info('\nPre-training Module {} - Epoch: {}\tTraining Loss {train_loss:.5f}'.format(i,e + 1, train_loss=train_loss))
+    if cache is not None:
+        cache.clear()
     # defrost model
     # model.train()
     for p in defrost_list:
         p.requires_grad = True
 
+# selects the student (0) or teacher (1) activations from a stacked cached batch
+class PrefixSelect(nn.Module):
+    def __init__(self,index):
+        super(PrefixSelect,self).__init__()
+        self.index = index
+
+    def forward(self, input):
+        return input[:,self.index]
+
+class PrefixActivationCache(object):
+    """Loader over the outputs of the frozen student and teacher prefixes during layerwise pretraining.
+    yields (stacked activations, labels) where the student and teacher outputs are stacked on dim 1.
+    batches are cached up to max_bytes, the remaining steps draw fresh data from data_loader and recompute the
+    prefix. advance() pushes the cached batches through one more frozen module, so every stage costs a single
+    module forward instead of a forward through the whole prefix. the cached activations freeze the augmentations
+    of the batches they were computed from, the input augmentations can't be re-applied to intermediate outputs.
+    """
+    def __init__(self,data_loader,max_bytes,cache_dir=''):
+        self.data_loader = data_loader
+        self.batch_size = data_loader.batch_size
+        self.sampler = None
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.student_prefix = nn.Sequential()
+        self.teacher_prefix = nn.Sequential()
+        self.entries = []
+        self.nbytes = 0
+        self._loader_iter = None
+        self._stage = 0
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _next_raw_batch(self):
+        try:
+            return next(self._loader_iter)
+        except (StopIteration, TypeError):
+            self._loader_iter = iter(self.data_loader)
+            return next(self._loader_iter)
+
+    def _store(self,x,lab):
+        x = x.detach().cpu()
+        nbytes = x.nelement() * (4 if self.cache_dir else x.element_size())
+        if self.nbytes + nbytes > self.max_bytes:
+            return False
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f'stage{self._stage}_batch{len(self.entries)}.npy')
+            store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=tuple(x.shape))
+            store[:] = x.float().numpy()
+            store.flush()
+            x = path
+            del store
+        self.nbytes += nbytes
+        self.entries.append((x,lab))
+        return True
+
+    def _load(self,x):
+        if torch.is_tensor(x):
+            return x
+        return torch.from_numpy(np.array(np.load(x, mmap_mode='r')))
+
+    def _release(self,x):
+        if not torch.is_tensor(x):
+            os.remove(x)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            if i < len(self.entries):
+                x, lab = self.entries[i]
+                yield self._load(x), lab
+            else:
+                # evicted or not yet computed, recompute the prefix on fresh data
+                inp, lab = self._next_raw_batch()
+                inp = inp.to(args.device, dtype=dtype)
+                with torch.no_grad():
+                    x = torch.stack([self.student_prefix(inp), self.teacher_prefix(inp)], 1)
+                self._store(x, lab)
+                yield x, lab
+
+    def advance(self,student_module,teacher_module):
+        self.student_prefix.add_module(str(len(self.student_prefix)), student_module)
+        self.teacher_prefix.add_module(str(len(self.teacher_prefix)), teacher_module)
+        entries, self.entries, self.nbytes = self.entries, [], 0
+        self._stage += 1
+        for k, (x, lab) in enumerate(entries):
+            x_ = self._load(x).to(args.device, dtype=dtype)
+            self._release(x)
+            with torch.no_grad():
+                y = torch.stack([student_module(x_[:, 0]), teacher_module(x_[:, 1])], 1)
+            if not self._store(y, lab):
+                # outputs outgrew the budget, the rest of the batches will be recomputed
+                for x, _ in entries[k + 1:]:
+                    self._release(x)
+                break
+        logging.info(f'activation cache holds {len(self.entries)}/{len(self)} batches ({self.nbytes / 2 ** 20:.1f}MB)')
+
+    def clear(self):
+        for x, _ in self.entries:
+            self._release(x)
+        self.entries, self.nbytes = [], 0
+
 #todo replace with forward hook?
 # sequential model with intermidiate output collection, usefull when using aux loss and runing data parallel model
 class SubModules(nn.Sequential):
@@ -1217,28 +1547,82 @@ class SubModules(nn.Sequential):
                 output.append(input)
         return output
 
-def calibrate(model,dataset,transform,calib_criterion=None,resample=200,batch_size=256,workers=4,val_loader=None,sample_per_class=-1,logging=None):
+# model -> {aux: DistributedDataParallel wrapper}, kept outside the model so deepcopy/pickle of a model never
+# carries its wrappers along. the wrappers reference their model, entries last for the training run
+_DISTRIBUTED_MODELS = weakref.WeakKeyDictionary()
+def get_distributed_model(model,aux=False):
+    # building DistributedDataParallel broadcasts parameters and allocates gradient buckets, do it once per model
+    wrappers = _DISTRIBUTED_MODELS.setdefault(model, {})
+    if aux not in wrappers:
+        wrappers[aux] = nn.parallel.DistributedDataParallel(SubModules(model) if aux else model,
+                                                            device_ids=args.device_ids,
+                                                            find_unused_parameters=aux)
+    return wrappers[aux]
+
+def sync_quant_measurements(model):
+    # running_min/max are averages of the per sample min/max (like running_mean/var), not extrema, so the ranks are
+    # combined by a mean weighted by their number of measurements rather than ReduceOp.MIN/MAX. all processes end up
+    # with identical quantization ranges, equal to a single process measuring all the calibration batches
+    for m in model.modules():
+        if isinstance(m,QuantMeasure):
+            num_measurements = m.num_measurements.clone()
+            dist.all_reduce(m.num_measurements)
+            for buff in (m.running_min, m.running_max, m.running_mean, m.running_var):
+                buff.mul_(num_measurements)
+                dist.all_reduce(buff)
+                buff.div_(m.num_measurements.clamp(min=1))
+
+def calibrate(model,dataset,transform,calib_criterion=None,resample=200,batch_size=256,workers=4,val_loader=None,sample_per_class=-1,logging=None,distributed=False,
+              use_bank=False):
     if logging:
         logging.info("set measure mode")
     # set_bn_is_train(model,False)
     set_measure_mode(model, True, logger=logging)
     if logging:
         logging.info("calibrating model to get quant params")
-    calibration_data = get_dataset(dataset, 'train', transform['train'],limit=sample_per_class,shuffle_before_limit=False)
+    use_bank = use_bank and resample > 0
+    if use_bank and not has_batch_transform(dataset):
+        if logging:
+            logging.warning(f'no batched transform for {dataset}, calibrating without the tensor bank')
+        use_bank = False
+    # the tensor bank holds the decoded uint8 images, the train augmentations are applied on the batch tensors
+    if use_bank:
+        # the batched counterpart of transform['train'], imagenet crops are drawn from the 256 center crop the bank
+        # is decoded to (as for -mmap datasets) rather than from the full image
+        batch_transform = get_batch_transform(dataset, input_size=args.input_size, augment=True,
+                                              batch_augment=args.distill_aug or ['cutout'])
+        decode_transform = None if dataset.endswith('-mmap') else get_decode_transform(dataset)
+        calibration_data = get_dataset(dataset, 'train', decode_transform, limit=sample_per_class, shuffle_before_limit=False)
+        calibration_data = TensorBank(calibration_data, dtype=torch.uint8, num_workers=workers)
+    else:
+        calibration_data = get_dataset(dataset, 'train', transform['train'], limit=sample_per_class, shuffle_before_limit=False)
     if logging:
         logging.info(f'calibration dataset {calibration_data}')
 
     # calibration_data = limitDS(calibration_data, sample_per_class)
-    if resample>0:
-        cal_sampler = torch.utils.data.RandomSampler(calibration_data, replacement=True,
-                                                     num_samples=resample * batch_size)
+    world_size = dist.get_world_size() if distributed else 1
+    generator = None
+    if distributed:
+        # each process draws a different subset, the total number of calibration samples is unchanged
+        generator = torch.Generator()
+        generator.manual_seed(args.seed + dist.get_rank())
+    if use_bank:
+        calibration_loader = calibration_data.loader(batch_size, resample // world_size, transform=batch_transform,
+                                                     generator=generator)
     else:
-        cal_sampler = None
+        if resample>0:
+            cal_sampler = torch.utils.data.RandomSampler(calibration_data, replacement=True,
+                                                         num_samples=resample * batch_size // world_size,
+                                                         generator=generator)
+        elif distributed:
+            cal_sampler = DistributedSampler(calibration_data, shuffle=True, seed=args.seed)
+        else:
+            cal_sampler = None
 
-    calibration_loader = torch.utils.data.DataLoader(
-        calibration_data, sampler=cal_sampler,
-        batch_size=batch_size, shuffle=cal_sampler is None,
-        num_workers=workers, pin_memory=False, drop_last=True)
+        calibration_loader = torch.utils.data.DataLoader(
+            calibration_data, sampler=cal_sampler,
+            batch_size=batch_size, shuffle=cal_sampler is None,
+            num_workers=workers, pin_memory=False, drop_last=True)
     calib_criterion = calib_criterion or getattr(model, 'criterion', nn.CrossEntropyLoss)()
     calib_criterion.to(args.device,dtype)
     with torch.no_grad():
@@ -1248,6 +1632,8 @@ def calibrate(model,dataset,transform,calib_criterion=None,resample=200,batch_si
         logging.info('Measured float resutls on calibration data:\nLoss {loss:.4f}\t'
                      'Prec@1 {top1:.3f}\t'
                      'Prec@5 {top5:.3f}'.format(loss=losses_avg, top1=top1_avg, top5=top5_avg))
+    if distributed:
+        sync_quant_measurements(model)
     set_measure_mode(model, False, logger=logging)
     if val_loader:
         if logging:
@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List
+
+# python job scheduler for experiment sweeps.
+# jobs are packed onto cpu cores and a memory budget, dependencies form a DAG (e.g. measure before evaluate)
+# and jobs whose config hash is already in the results store are skipped.
+
+parser = argparse.ArgumentParser(description='experiment sweep scheduler')
+parser.add_argument('--script', default='qdistiler_main.py', type=str,
+                    help='script launched for every grid point')
+parser.add_argument('--base', default='{}', type=str,
+                    help='flags shared by all jobs "{flag: value,...}", True marks a store_true flag, None/"@" omits the flag')
+parser.add_argument('--grid', default='{}', type=str,
+                    help='swept flags "{flag: [values],...}", the sweep is the cartesian product')
+parser.add_argument('--cores', default=os.cpu_count(), type=int,
+                    help='total cpu cores available to the sweep')
+parser.add_argument('--mem', default=0, type=int,
+                    help='total memory budget in MB (default: 0, no memory accounting)')
+parser.add_argument('--job-cores', default=1, type=int,
+                    help='cpu cores reserved per job')
+parser.add_argument('--job-mem', default=0, type=int,
+                    help='memory reserved per job in MB')
+parser.add_argument('--retries', default=0, type=int,
+                    help='number of times a failed job is relaunched')
+parser.add_argument('--results-dir', default='sweep_results', type=str,
+                    help='results store, one record per finished config hash')
+parser.add_argument('--dry-run', action='store_true',
+                    help='print the jobs that would run and exit')
+
+
+def expand_grid(base: Dict, grid: Dict) -> List[Dict]:
+    keys = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        cfg = dict(base)
+        cfg.update(zip(keys, values))
+        configs.append(cfg)
+    return configs
+
+
+def config_hash(config: Dict) -> str:
+    # callables are serialized by their repr, drop object addresses so the hash is stable between runs
+    serialized = re.sub(r' at 0x[0-9a-fA-F]+', '', json.dumps(config, sort_keys=True, default=str))
+    return hashlib.sha1(serialized.encode()).hexdigest()[:16]
+
+
+def to_flags(config: Dict) -> List[str]:
+    # '@' (or None, False) drops the flag, True is a store_true flag
+    flags = []
+    for k, v in config.items():
+        flag = k if k.startswith('-') else '--' + k.replace('_', '-')
+        if v is None or v == '@' or v is False:
+            continue
+        if v is True:
+            flags.append(flag)
+        elif isinstance(v, (list, tuple)):
+            flags += [flag] + [str(x) for x in v]
+        else:
+            flags += [flag, str(v)]
+    return flags
+
+
+class Job:
+    def __init__(self, name: str, config: Dict, cmd: List[str] = None, fn: Callable = None, fn_kwargs: Dict = None,
+                 cores: int = 1, mem: int = 0, deps: List[str] = (), retries: int = 0, log_dir: str = None):
+        assert (cmd is None) != (fn is None), 'job requires either a command or a callable'
+        self.name = name
+        self.config = config
+        self.hash = config_hash(config)
+        self.cmd = cmd
+        self.fn = fn
+        self.fn_kwargs = fn_kwargs or {}
+        self.cores = cores
+        self.mem = mem
+        self.deps = list(deps)
+        self.retries = retries
+        self.log_dir = log_dir
+        self.attempts = 0
+
+    def __repr__(self):
+        return f'Job({self.name}, hash={self.hash}, cores={self.cores}, mem={self.mem}, deps={self.deps})'
+
+
+def _run_job(job: Job, core_ids: List[int]):
+    # executed inside a pool worker, pins the job to its reserved cores
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, core_ids)
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(core_ids)), MKL_NUM_THREADS=str(len(core_ids)))
+    if job.fn is not None:
+        os.environ.update(env)
+        import torch
+        torch.set_num_threads(len(core_ids))
+        job.fn(**job.fn_kwargs)
+        return 0
+    log = None
+    if job.log_dir:
+        os.makedirs(job.log_dir, exist_ok=True)
+        log = open(os.path.join(job.log_dir, f'{job.name}_{job.hash}.log'), 'a')
+    try:
+        return subprocess.run(job.cmd, env=env, stdout=log, stderr=subprocess.STDOUT if log else None).returncode
+    finally:
+        if log:
+            log.close()
+
+
+class ResultsStore:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _record_path(self, job_hash):
+        return os.path.join(self.path, f'{job_hash}.json')
+
+    def done(self, job_hash) -> bool:
+        return os.path.isfile(self._record_path(job_hash))
+
+    def record(self, job: Job):
+        with open(self._record_path(job.hash) + '.tmp', 'w') as f:
+            json.dump({'name': job.name, 'config': job.config, 'attempts': job.attempts}, f, default=str, indent=1)
+        os.replace(self._record_path(job.hash) + '.tmp', self._record_path(job.hash))
+
+
+class Scheduler:
+    def __init__(self, cores: int, mem: int = 0, store: ResultsStore = None):
+        # core ids follow the affinity of the scheduler, oversubscribed when more cores are requested than available
+        available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        self.free_cores = [available[i % len(available)] for i in range(cores)]
+        self.mem = mem
+        self.free_mem = mem
+        self.store = store
+        self.jobs = {}
+
+    def add(self, job: Job):
+        assert job.name not in self.jobs, f'duplicate job name {job.name}'
+        assert job.cores <= len(self.free_cores) and (not self.mem or job.mem <= self.mem), \
+            f'{job} does not fit the sweep resources'
+        self.jobs[job.name] = job
+        return job
+
+    def _fits(self, job):
+        return job.cores <= len(self.free_cores) and (not self.mem or job.mem <= self.free_mem)
+
+    def run(self):
+        for job in self.jobs.values():
+            for d in job.deps:
+                assert d in self.jobs, f'{job.name} depends on unknown job {d}'
+        done, failed = set(), set()
+        pending = []
+        for name, job in self.jobs.items():
+            if self.store is not None and self.store.done(job.hash):
+                logging.info(f'skipping {name}, config {job.hash} already in results store')
+                done.add(name)
+            else:
+                pending.append(name)
+        running = {}
+        with ProcessPoolExecutor(max_workers=len(self.free_cores)) as pool:
+            while pending or running:
+                # dependents of failed jobs (and their dependents) can never run
+                dropped = True
+                while dropped:
+                    dropped = [n for n in pending if any(d in failed for d in self.jobs[n].deps)]
+                    for name in dropped:
+                        logging.error(f'{name} dropped, a dependency failed')
+                        pending.remove(name)
+                        failed.add(name)
+                for name in list(pending):
+                    job = self.jobs[name]
+                    if all(d in done for d in job.deps) and self._fits(job):
+                        core_ids, self.free_cores = self.free_cores[:job.cores], self.free_cores[job.cores:]
+                        self.free_mem -= job.mem
+                        job.attempts += 1
+                        logging.info(f'launching {job} on cores {core_ids} (attempt {job.attempts})')
+                        running[pool.submit(_run_job, job, core_ids)] = (name, core_ids)
+                        pending.remove(name)
+                if not running:
+                    break
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, core_ids = running.pop(future)
+                    job = self.jobs[name]
+                    self.free_cores += core_ids
+                    self.free_mem += job.mem
+                    try:
+                        ok = future.result() == 0
+                    except Exception as e:
+                        logging.error(f'{name} raised {e!r}')
+                        ok = False
+                    if ok:
+                        logging.info(f'{name} done')
+                        done.add(name)
+                        if self.store is not None:
+                            self.store.record(job)
+                    elif job.attempts <= job.retries:
+                        logging.warning(f'{name} failed, retrying')
+                        pending.append(name)
+                    else:
+                        logging.error(f'{name} failed after {job.attempts} attempts')
+                        failed.add(name)
+        return done, failed
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parser.parse_args()
+    configs = expand_grid(literal_eval(args.base), literal_eval(args.grid))
+    store = ResultsStore(args.results_dir)
+    scheduler = Scheduler(args.cores, args.mem, store)
+    script_name = os.path.splitext(os.path.basename(args.script))[0]
+    for i, cfg in enumerate(configs):
+        cmd = [sys.executable, args.script] + to_flags(cfg)
+        scheduler.add(Job(f'{script_name}_{i}', dict(cfg, script=args.script), cmd=cmd, cores=args.job_cores,
+                          mem=args.job_mem, retries=args.retries, log_dir=os.path.join(args.results_dir, 'logs')))
+    if args.dry_run:
+        for job in scheduler.jobs.values():
+            print(job.name, job.hash, 'done' if store.done(job.hash) else ' '.join(job.cmd))
+        return
+    done, failed = scheduler.run()
+    logging.info(f'sweep finished: {len(done)} done, {len(failed)} failed')
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
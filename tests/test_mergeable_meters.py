@@ -0,0 +1,49 @@
+import pickle
+
+import torch as th
+
+from mergeable_meters import MergeableMeterDict, MergeableOnlineMeter
+
+PERCENTILES = th.tensor([0.05, 0.25, 0.5, 0.75, 0.95])
+
+
+def _meter():
+    return MergeableOnlineMeter(track_percentiles=True, per_channel=True, target_percentiles=PERCENTILES,
+                                number_edge_samples=3, track_cov=True)
+
+
+def test_merged_shards_match_single_pass():
+    th.manual_seed(0)
+    batches = th.randn(6, 50, 4) * th.tensor([1., 2., .5, 3.]) + 1
+    single = _meter()
+    for batch in batches:
+        single.update(batch)
+    # shards split on batch boundaries, merged out of order
+    shards = [_meter(), _meter(), _meter()]
+    for n, batch in enumerate(batches):
+        shards[n % 3].update(batch)
+    merged = shards[2].merge(shards[0]).merge(shards[1])
+
+    observations = batches.reshape(-1, 4)
+    assert merged.n == single.n == observations.shape[0]
+    assert th.allclose(merged.mean, observations.mean(0), atol=1e-5)
+    assert th.allclose(merged.cov, th.cov(observations.t()), atol=1e-5)
+    assert th.allclose(merged.cov, single.cov, atol=1e-5)
+    assert th.equal(merged.edge_low, observations.topk(3, 0, largest=False)[0].double())
+    for merged_stat, single_stat in zip(merged.get_distribution_histogram(), single.get_distribution_histogram()):
+        assert th.allclose(merged_stat, single_stat, atol=1e-5)
+
+
+def test_meter_dict_merge_and_pickle():
+    th.manual_seed(0)
+    a, b, single = MergeableMeterDict(), MergeableMeterDict(), MergeableMeterDict()
+    x, y = th.randn(20, 3), th.randn(30, 3)
+    a.update({'layer': x})
+    b.update({'layer': y, 'other': y})
+    single.update({'layer': x})
+    single.update({'layer': y, 'other': y})
+    merged = pickle.loads(pickle.dumps(a)).merge(pickle.loads(pickle.dumps(b)))
+    assert merged.keys() == single.keys()
+    for name, meter in single.items():
+        assert th.allclose(merged[name].mean, meter.mean)
+        assert th.allclose(merged[name].var, meter.var)
@@ -0,0 +1,67 @@
+import importlib.util
+import os
+import time
+
+import pytest
+import torch
+
+# only the modules quantize.py imports, models/__init__ would pull in every model and the whole utils tree
+for _name in ('matplotlib.pyplot', 'utils.absorb_bn', 'utils.misc', 'utils.partial_class', 'utils.module_rewriter'):
+    pytest.importorskip(_name)
+_spec = importlib.util.spec_from_file_location(
+    'quantize', os.path.join(os.path.dirname(__file__), '..', 'models', 'modules', 'quantize.py'))
+quantize = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(quantize)
+
+
+def test_bf16_input_quantized_on_fp32_grid():
+    torch.manual_seed(0)
+    x = torch.randn(16, 64).bfloat16()
+    out = quantize.quantize(x, num_bits=8, min_value=-2.5, max_value=2.5)
+    assert out.dtype == torch.bfloat16
+    assert torch.equal(out, quantize.quantize(x.float(), num_bits=8, min_value=-2.5, max_value=2.5).bfloat16())
+
+
+def _measured_conv(x, in_channels=3, out_channels=8):
+    conv = quantize.QConv2d(in_channels, out_channels, 3, padding=1)
+    # measure the input range in fp32, then run quantized
+    quantize.set_measure_mode(conv, True)
+    conv.train()
+    with torch.no_grad():
+        conv(x)
+    quantize.set_measure_mode(conv, False)
+    return conv.eval()
+
+
+def _forward_time(conv, x, autocast, repeats=10):
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=autocast):
+        conv(x)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            conv(x)
+    return (time.perf_counter() - start) / repeats
+
+
+def test_bf16_autocast_forward_matches_fp32():
+    torch.manual_seed(0)
+    x = torch.randn(16, 3, 8, 8)
+    conv = _measured_conv(x)
+    with torch.no_grad():
+        expected = conv(x)
+        # inputs arrive in bf16 from the preceding autocast ops
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            out = conv(x.bfloat16())
+    assert out.dtype == torch.bfloat16
+    torch.testing.assert_close(out.float(), expected, rtol=0, atol=0.05 * expected.abs().max().item())
+
+
+def test_bf16_autocast_forward_throughput():
+    torch.manual_seed(0)
+    x = torch.randn(32, 64, 28, 28)
+    conv = _measured_conv(x, 64, 64)
+    fp32 = min(_forward_time(conv, x, autocast=False) for _ in range(3))
+    bf16 = min(_forward_time(conv, x.bfloat16(), autocast=True) for _ in range(3))
+    print(f'quantized conv forward: fp32 {fp32 * 1e3:.2f}ms, bf16 autocast {bf16 * 1e3:.2f}ms '
+          f'(speedup {fp32 / bf16:.2f}x)')
+    # cpus without native bf16 emulate it, only a gross slowdown of the quantized path is a regression
+    assert bf16 < 3 * fp32
@@ -0,0 +1,61 @@
+import pytest
+import torch as th
+
+ac = pytest.importorskip('adversarial_compare')
+
+NUM_CLASSES, PER_CLASS = 3, 24
+
+
+def _tiny_setup():
+    th.manual_seed(0)
+    model = th.nn.Sequential(th.nn.Conv2d(3, 4, 3), th.nn.BatchNorm2d(4), th.nn.ReLU(), th.nn.AdaptiveAvgPool2d(1),
+                             th.nn.Flatten(), th.nn.Linear(4, NUM_CLASSES)).eval()
+    targets = th.arange(NUM_CLASSES).repeat_interleave(PER_CLASS)
+    ds = th.utils.data.TensorDataset(th.randn(len(targets), 3, 8, 8), targets)
+    return model, ds, targets
+
+
+def _measure(model, ds, targets, sharded):
+    class_ids = list(range(NUM_CLASSES))
+    reductions = {'spatial-mean': ac.spatial_mean}
+    batch_size = 8
+    kwargs = dict(batch_size=batch_size, num_processes=2) if sharded else \
+        dict(batch_size=batch_size, model_device='cpu', collector_device='cpu', num_workers=0)
+    measure = ac.measure_per_class_statistics_sharded if sharded else ac.measure_per_class_statistics
+    trackers = ref_stats = None
+    for part in (1, 2):
+        class_settings = []
+        for _ in class_ids:
+            cfg = ac.BatchStatsCollectorCfg(batch_size, reduction_dictionary=reductions)
+            cfg.num_edge_samples = 0
+            cfg.mergeable = True
+            class_settings.append(cfg)
+        if part == 1:
+            trackers = measure(model, ds, targets, class_ids, class_settings, part=part, **kwargs)
+        else:
+            ref_stats = measure(model, ds, targets, class_ids, class_settings, part=part, trackers=trackers, **kwargs)
+    return trackers, ref_stats
+
+
+def test_sharded_measure_matches_in_process():
+    model, ds, targets = _tiny_setup()
+    sharded_trackers, sharded = _measure(model, ds, targets, sharded=True)
+    trackers, in_process = _measure(model, ds, targets, sharded=False)
+    assert len(sharded) == len(in_process) == NUM_CLASSES
+    # the merged shard meters equal a single pass
+    for sharded_tracker, tracker in zip(sharded_trackers, trackers):
+        assert sharded_tracker.keys() == tracker.keys()
+        for name, meter in tracker.items():
+            assert sharded_tracker[name].n == meter.n
+            assert th.allclose(sharded_tracker[name].mean, meter.mean, atol=1e-5), name
+            if meter.track_cov:
+                assert th.allclose(sharded_tracker[name].cov, meter.cov, atol=1e-5), name
+    # the part 2 records hold the same observations (in shard order)
+    for sharded_stats, stats in zip(sharded, in_process):
+        assert sharded_stats.keys() == stats.keys()
+        for layer, per_reduction in stats.items():
+            for reduction_name, records in per_reduction.items():
+                for sharded_record, record in zip(sharded_stats[layer][reduction_name], records):
+                    expected = record.channel_reduction_record['mahalanobis']['record']
+                    merged = sharded_record.channel_reduction_record['mahalanobis']['record']
+                    assert th.allclose(merged.flatten().sort()[0], expected.flatten().sort()[0], atol=1e-4), (layer, reduction_name)
@@ -0,0 +1,81 @@
+import pytest
+import torch as th
+
+ac = pytest.importorskip('adversarial_compare')
+
+K, C, P, B = 5, 12, 11, 64
+
+
+def _matcher(channels, right_side=False):
+    return ac.PvalueMatcher(th.linspace(0.02, 0.98, P), th.randn(P, channels).sort(0)[0], right_side=right_side)
+
+
+def _class_stats(selection, lda):
+    # per class records as _build_ref_stat_dict produces them, optionally behind a channel selection
+    shared_inv_cov = th.eye(C) + 0.1
+    stats = []
+    for k in range(K):
+        ids = None
+        if selection == 'shared':
+            ids = th.arange(0, C, 2)
+        elif selection == 'per_class':
+            ids = th.randperm(C)[:C // 2]
+        c = C if ids is None else len(ids)
+        inv_cov = shared_inv_cov[:c, :c] if lda else th.linalg.inv(th.cov(th.randn(4 * c, c).t()))
+        spatial = _matcher(c)
+        fns = {'simes_c': ac.FunctionComposition(spatial, ac.calc_simes),
+               'fisher_c': ac.FunctionComposition(ac.FunctionComposition(spatial, ac.calc_cond_fisher),
+                                                  _matcher(1, True)),
+               'mahalanobis': ac.FunctionComposition(ac.MahalanobisDistance(th.randn(c), inv_cov),
+                                                     _matcher(1, True))}
+        ret = ac.BatchStatsCollectorRet('spatial-mean', ac.spatial_mean)
+        for name, fn in fns.items():
+            if ids is not None:
+                fn = ac.FunctionComposition(ac.ChannelSelect(ids), fn)
+            ret.channel_reduction_record[name] = {'fn': fn, 'right_side_pval': name != 'simes_c'}
+        stats.append({'layer': {'spatial-mean': [ret]}})
+    return stats
+
+
+@pytest.mark.parametrize('selection', [None, 'shared', 'per_class'])
+@pytest.mark.parametrize('lda', [False, True])
+def test_stacked_scores_match_per_class_fns(selection, lda):
+    th.manual_seed(0)
+    stats = _class_stats(selection, lda)
+    reductions = {'spatial-mean': ac.spatial_mean}
+    assert ac.StackedClassScorer.build([s['layer']['spatial-mean'][0] for s in stats], ac.spatial_mean) is not None
+    x = th.randn(B, C, 3, 3)
+    scores = ac.gen_inference_fn(stats, reductions)('layer.forward', None, (x,))['spatial-mean'][0]
+    reduced = ac.spatial_mean(x)
+    for name in ['simes_c', 'fisher_c', 'mahalanobis']:
+        expected = th.cat([s['layer']['spatial-mean'][0].channel_reduction_record[name]['fn'](reduced)
+                           for s in stats], -1)
+        assert scores[name].shape == (B, K)
+        assert th.allclose(scores[name], expected), name
+
+
+@pytest.mark.parametrize('selection', ['shared', 'per_class'])
+def test_pushed_down_selection_matches_reduced_inputs(selection):
+    # the selection is applied before the spatial reduction, stored (already reduced) inputs slice the union instead
+    th.manual_seed(1)
+    stats = _class_stats(selection, lda=False)
+    reductions = {'spatial-mean': ac.spatial_mean}
+    x = th.randn(B, C, 3, 3)
+    scores = ac.gen_inference_fn(stats, reductions)('layer.forward', None, (x,))['spatial-mean'][0]
+    stored = ac.gen_inference_fn(stats, reductions, reduced_inputs=True)(
+        'layer.forward', None, {'spatial-mean': [ac.spatial_mean(x)]})['spatial-mean'][0]
+    for name in scores:
+        assert th.allclose(scores[name], stored[name]), name
+
+
+def test_union_is_cached_per_layer():
+    fused = ac.FusedSpatialReduction({'spatial-mean': ac.spatial_mean, 'spatial-max': ac.spatial_max})
+    layers = [{'spatial-mean': th.tensor([0, 3]), 'spatial-max': th.tensor([3, 5])},
+              {'spatial-mean': th.tensor([1]), 'spatial-max': th.tensor([2, 4])}]
+    x = th.randn(4, 6, 2, 2)
+    for _ in range(2):
+        for channels in layers:
+            out = fused(x, channels)
+            for name, ids in channels.items():
+                assert th.equal(out[name], fused(x)[name][:, ids])
+    assert len(fused._unions) == len(layers)
@@ -0,0 +1,59 @@
+import time
+
+from sweep import Job, Scheduler, ResultsStore
+
+
+def _append(path, name, delay=0.):
+    time.sleep(delay)
+    with open(path, 'a') as f:
+        f.write(f'{name}\n')
+
+
+def _fail(path, name):
+    _append(path, name)
+    raise RuntimeError(f'{name} failed')
+
+
+def _log(path):
+    with open(path) as f:
+        return f.read().split()
+
+
+def test_dependents_run_after_their_dependencies(tmp_path):
+    log = str(tmp_path / 'log')
+    scheduler = Scheduler(cores=2)
+    # the dependent is added first and a free core is available, it still has to wait for the slow measure job
+    scheduler.add(Job('eval', {'eval': 0}, fn=_append, fn_kwargs=dict(path=log, name='eval'), deps=['measure']))
+    scheduler.add(Job('measure', {'measure': 0}, fn=_append, fn_kwargs=dict(path=log, name='measure', delay=0.5)))
+    scheduler.add(Job('other', {'other': 0}, fn=_append, fn_kwargs=dict(path=log, name='other')))
+    done, failed = scheduler.run()
+    assert done == {'measure', 'eval', 'other'} and not failed
+    order = _log(log)
+    assert order.index('measure') < order.index('eval')
+
+
+def test_failures_propagate_to_dependents(tmp_path):
+    log = str(tmp_path / 'log')
+    scheduler = Scheduler(cores=1)
+    scheduler.add(Job('measure', {'measure': 1}, fn=_fail, fn_kwargs=dict(path=log, name='measure'), retries=1))
+    scheduler.add(Job('eval', {'eval': 1}, fn=_append, fn_kwargs=dict(path=log, name='eval'), deps=['measure']))
+    scheduler.add(Job('report', {'report': 1}, fn=_append, fn_kwargs=dict(path=log, name='report'), deps=['eval']))
+    scheduler.add(Job('other', {'other': 1}, fn=_append, fn_kwargs=dict(path=log, name='other')))
+    done, failed = scheduler.run()
+    assert done == {'other'}
+    assert failed == {'measure', 'eval', 'report'}
+    # retried once, dependents never launched
+    assert sorted(_log(log)) == ['measure', 'measure', 'other']
+
+
+def test_recorded_jobs_are_skipped(tmp_path):
+    log = str(tmp_path / 'log')
+    store = ResultsStore(str(tmp_path / 'results'))
+    job = Job('measure', {'measure': 2}, fn=_append, fn_kwargs=dict(path=log, name='measure'))
+    store.record(job)
+    scheduler = Scheduler(cores=1, store=store)
+    scheduler.add(job)
+    scheduler.add(Job('eval', {'eval': 2}, fn=_append, fn_kwargs=dict(path=log, name='eval'), deps=['measure']))
+    done, failed = scheduler.run()
+    assert done == {'measure', 'eval'} and not failed
+    assert _log(log) == ['eval']